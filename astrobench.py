@@ -0,0 +1,471 @@
+'''
+AstroBench -- Benchmark of the AstroPhoto pipeline on synthetic star fields
+Copyright (c) 2015-2016, Emanuele Laface (Emanuele.Laface@gmail.com)
+
+All rights reserved.
+
+Redistribution and use, with or without modification, are permitted provided that the following conditions are met:
+Redistributions must retain the above copyright notice, this list of conditions and the following disclaimer.
+Neither the name of the AstroPhoto Author nor the names of any contributors may be used to endorse or promote
+products derived from this software without specific prior written permission.
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES,
+INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED.
+IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY,
+OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS;
+OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+
+import sys
+import os
+import time
+import argparse
+import subprocess
+import shutil
+import tempfile
+import collections
+import json
+import resource
+import numpy
+import scipy.ndimage
+import scipy.spatial
+import cv2
+import astropy.io.fits
+import astropy.wcs
+
+# Sky position and scale of the synthetic fields
+field_ra = 83.8
+field_dec = -5.4
+field_scale = 1.5
+
+def frame_positions(stars, frame, centre):
+  # stars are (row, column) on the reference, a frame is rotated by angle (radians) around centre
+  # and shifted by shift (rows, columns)
+  cosine = numpy.cos(frame['angle'])
+  sine = numpy.sin(frame['angle'])
+  y = stars[:,0]-centre[0]
+  x = stars[:,1]-centre[1]
+  return numpy.column_stack((sine*x+cosine*y+centre[0]+frame['shift'][0], cosine*x-sine*y+centre[1]+frame['shift'][1]))
+
+def synthetic_truth(rows, columns, frames, stars, seed):
+  rng = numpy.random.RandomState(seed)
+  margin = 40
+  truth = {'rows': rows, 'columns': columns, 'centre': [rows/2.0, columns/2.0], 'seed': seed}
+  truth['stars'] = numpy.column_stack((rng.uniform(margin, rows-margin, stars), rng.uniform(margin, columns-margin, stars), 40000.0*rng.pareto(1.5, stars)+3000.0)).tolist()
+  # Sensor defects stay in place while the sky moves
+  hot = int(rows*columns*1e-4)
+  truth['hot_pixels'] = numpy.column_stack((rng.randint(0, rows, hot), rng.randint(0, columns, hot))).tolist()
+  # A tracked sequence: a steady drift and field rotation with some tracking error on every frame
+  rotation = numpy.radians(rng.uniform(-0.05, 0.05))
+  drift = rng.uniform(-3, 3, 2)
+  truth['frames'] = [{'angle': 0.0, 'shift': [0.0, 0.0]}]
+  for i in range(1, frames):
+    truth['frames'].append({'angle': float(i*rotation+numpy.radians(rng.uniform(-0.01, 0.01))), 'shift': (i*drift+rng.uniform(-0.7, 0.7, 2)).tolist()})
+  return truth
+
+def synthetic_frame(truth, index, sigma=1.8):
+  # Background with a linear gradient and vignetting, gaussian stars, photon and read noise, hot pixels
+  rng = numpy.random.RandomState(truth['seed']*1000+index+1)
+  rows = truth['rows']
+  columns = truth['columns']
+  y = (numpy.arange(0, rows, dtype=numpy.float32)/rows-0.5)[:,None]
+  x = (numpy.arange(0, columns, dtype=numpy.float32)/columns-0.5)[None,:]
+  background = 2000.0 + 600.0*x + 300.0*y - 800.0*(x*x+y*y)
+  sky = numpy.zeros((rows, columns), dtype=numpy.float32)
+  radius = int(numpy.ceil(4*sigma))
+  stamp = numpy.arange(-radius, radius+1)
+  positions = frame_positions(numpy.array(truth['stars']), truth['frames'][index], truth['centre'])
+  for (row, column), flux in zip(positions, numpy.array(truth['stars'])[:,2]):
+    r = int(round(row))
+    c = int(round(column))
+    if r-radius < 0 or c-radius < 0 or r+radius >= rows or c+radius >= columns:
+      continue
+    profile_y = numpy.exp(-(stamp+r-row)**2/(2*sigma**2))
+    profile_x = numpy.exp(-(stamp+c-column)**2/(2*sigma**2))
+    sky[r-radius:r+radius+1, c-radius:c+radius+1] += flux/(2*numpy.pi*sigma**2)*profile_y[:,None]*profile_x[None,:]
+  rgb16 = numpy.empty((rows, columns, 3), dtype=numpy.uint16)
+  for channel, (background_color, star_color) in enumerate(((1.0, 0.9), (0.9, 1.0), (0.8, 1.1))):
+    signal = background*background_color + sky*star_color
+    signal = signal + rng.standard_normal(signal.shape).astype(numpy.float32)*numpy.sqrt(signal+100.0)
+    rgb16[:,:,channel] = numpy.clip(signal, 0, 65535)
+  hot = numpy.array(truth['hot_pixels'])
+  if len(hot) > 0:
+    rgb16[hot[:,0], hot[:,1], :] = 65535
+  return rgb16
+
+def detect_stars(rgb16, threshold=5.0):
+  # Flux weighted centroids (row, column) and fluxes of the connected groups above the local sky
+  gray = rgb16.astype(numpy.float32)
+  if gray.ndim == 3:
+    gray = gray.sum(axis=2)
+  residual = gray - cv2.blur(gray, (65, 65))
+  noise = 1.4826*numpy.median(numpy.abs(residual[::4, ::4]-numpy.median(residual[::4, ::4])))
+  labels, number = scipy.ndimage.label(residual > threshold*noise)
+  if number == 0:
+    return numpy.empty((0, 2)), numpy.empty(0)
+  index = numpy.arange(1, number+1)
+  sizes = scipy.ndimage.sum(numpy.ones(labels.shape), labels, index)
+  index = index[sizes >= 3]
+  if len(index) == 0:
+    return numpy.empty((0, 2)), numpy.empty(0)
+  residual = numpy.maximum(residual, 0)
+  return numpy.array(scipy.ndimage.center_of_mass(residual, labels, index)), numpy.array(scipy.ndimage.sum(residual, labels, index))
+
+def stand_in(arguments):
+  # Replaces solve-field: the frame is recognized among the synthetic ones by its stars and the
+  # .corr, .wcs, .new (for images) and .solved files are written from the truth of that frame.
+  # The input is a picture, a FITS reduced from the frame or a star list (.xyls), positions in
+  # the outputs count from 1 on the input as for solve-field.
+  name = os.path.splitext(arguments[-1])[0]
+  options = {}
+  for i in range(0, len(arguments)-1):
+    if arguments[i].startswith('--') and not arguments[i+1].startswith('--'):
+      options[arguments[i]] = arguments[i+1]
+  truth_file = open(os.environ['ASTROBENCH_TRUTH'])
+  truth = json.load(truth_file)
+  truth_file.close()
+  if arguments[-1].endswith('.xyls'):
+    table = astropy.io.fits.open(arguments[-1], memmap=False)[1].data
+    detected = numpy.column_stack((table.field('Y')-1, table.field('X')-1))
+    factor = float(truth['columns'])/int(options['--width'])
+  else:
+    if arguments[-1].endswith('.fits'):
+      rgb16 = astropy.io.fits.open(arguments[-1], memmap=False)[0].data
+    else:
+      rgb16 = cv2.imread(arguments[-1], cv2.IMREAD_UNCHANGED)
+    if rgb16 is None:
+      return 1
+    detected, flux = detect_stars(rgb16)
+    factor = float(truth['columns'])/rgb16.shape[1]
+  if len(detected) < 5:
+    return 0
+  # A hint or scale bounds that exclude the field make the solve fail, as they would do
+  scale = field_scale*factor
+  if not float(options.get('--scale-low', scale)) <= scale <= float(options.get('--scale-high', scale)):
+    return 0
+  if options.get('--parity', 'pos') != 'pos':
+    return 0
+  if '--ra' in options:
+    ra = numpy.radians([field_ra, float(options['--ra'])])
+    dec = numpy.radians([field_dec, float(options['--dec'])])
+    cosine = numpy.sin(dec[0])*numpy.sin(dec[1])+numpy.cos(dec[0])*numpy.cos(dec[1])*numpy.cos(ra[0]-ra[1])
+    if numpy.degrees(numpy.arccos(min(1.0, cosine))) > float(options['--radius']):
+      return 0
+  tree = scipy.spatial.cKDTree(detected)
+  stars = numpy.array(truth['stars'])
+  best = None
+  for frame in truth['frames']:
+    positions = (frame_positions(stars, frame, truth['centre'])+0.5)/factor-0.5
+    distance, index = tree.query(positions, distance_upper_bound=3.0/factor)
+    found = numpy.isfinite(distance)
+    if best is None or found.sum() > best[0].sum():
+      best = (found, index, positions, frame)
+  found, index, positions, frame = best
+  if found.sum() < 5:
+    return 0
+
+  header = astropy.io.fits.Header()
+  cosine = numpy.cos(frame['angle'])
+  sine = numpy.sin(frame['angle'])
+  scale = field_scale*factor/3600.0
+  header['CTYPE1'] = 'RA---TAN'
+  header['CTYPE2'] = 'DEC--TAN'
+  header['CRVAL1'] = field_ra
+  header['CRVAL2'] = field_dec
+  header['CRPIX1'] = (truth['centre'][1]+frame['shift'][1]+0.5)/factor+0.5
+  header['CRPIX2'] = (truth['centre'][0]+frame['shift'][0]+0.5)/factor+0.5
+  header['CD1_1'] = -scale*cosine
+  header['CD1_2'] = -scale*sine
+  header['CD2_1'] = -scale*sine
+  header['CD2_2'] = scale*cosine
+  wcs = astropy.wcs.WCS(header)
+  field = detected[index[found]]
+  reference = positions[found]
+  field_sky = wcs.all_pix2world(field[:,::-1], 0)
+  index_sky = wcs.all_pix2world(reference[:,::-1], 0)
+  # solve-field projects the index stars with the WCS fitted to the detected stars, not with the
+  # truth: the positions carry the errors of the centroids as in a real solve
+  source = reference[:,1]+1j*reference[:,0]
+  target = field[:,1]+1j*field[:,0]
+  rotation = (numpy.conj(source-source.mean())*(target-target.mean())).sum()/(numpy.abs(source-source.mean())**2).sum()
+  fitted = rotation*(source-source.mean())+target.mean()
+  reference = numpy.column_stack((fitted.imag, fitted.real))
+  columns = [('field_x', field[:,1]+1), ('field_y', field[:,0]+1), ('field_ra', field_sky[:,0]), ('field_dec', field_sky[:,1]),
+             ('index_x', reference[:,1]+1), ('index_y', reference[:,0]+1), ('index_ra', index_sky[:,0]), ('index_dec', index_sky[:,1]),
+             ('index_id', numpy.nonzero(found)[0]), ('field_id', index[found]), ('match_weight', numpy.ones(found.sum())),
+             ('FLUX', stars[found,2]), ('BACKGROUND', numpy.zeros(found.sum()))]
+  table = astropy.io.fits.BinTableHDU.from_columns([astropy.io.fits.Column(name=column, format='D', array=numpy.asarray(values, dtype=float)) for column, values in columns])
+  table.writeto(name+'.corr')
+  astropy.io.fits.PrimaryHDU(header=header).writeto(name+'.wcs')
+  if not arguments[-1].endswith('.xyls'):
+    astropy.io.fits.PrimaryHDU(header=header).writeto(name+'.new')
+  solved = open(name+'.solved', 'wb')
+  solved.write('\x01')
+  solved.close()
+  return 0
+
+def reset_peak():
+  # Linux resets the peak resident size of the process when 5 is written in clear_refs
+  try:
+    clear_refs = open('/proc/self/clear_refs', 'w')
+    clear_refs.write('5')
+    clear_refs.close()
+    return True
+  except IOError:
+    return False
+
+def peak_rss():
+  # Peak resident size in MB, since the last reset_peak when it is supported
+  try:
+    status = open('/proc/self/status')
+    for line in status:
+      if line.startswith('VmHWM:'):
+        status.close()
+        return int(line.split()[1])/1024.0
+    status.close()
+  except IOError:
+    pass
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+
+class AstroBench:
+  def __init__(self):
+    # Totals of every stage, in the order they were first run
+    self.stages = collections.OrderedDict()
+
+  def measure(self, name, function, pixels=0):
+    reset_peak()
+    start = time.time()
+    cpu = os.times()
+    result = function()
+    cpu_end = os.times()
+    stage = self.stages.setdefault(name, {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'pixels': 0, 'peak_rss_mb': 0.0})
+    stage['calls'] = stage['calls'] + 1
+    stage['wall'] = stage['wall'] + time.time() - start
+    stage['cpu'] = stage['cpu'] + (cpu_end[0]-cpu[0]) + (cpu_end[1]-cpu[1])
+    stage['pixels'] = stage['pixels'] + pixels
+    stage['peak_rss_mb'] = max(stage['peak_rss_mb'], peak_rss())
+    return result
+
+  def report(self):
+    report = collections.OrderedDict()
+    for name, stage in self.stages.items():
+      entry = collections.OrderedDict()
+      entry['calls'] = stage['calls']
+      entry['wall'] = round(stage['wall'], 4)
+      entry['cpu'] = round(stage['cpu'], 4)
+      entry['wall_per_call'] = round(stage['wall']/stage['calls'], 4)
+      entry['calls_per_second'] = round(stage['calls']/max(stage['wall'], 1e-9), 3)
+      entry['megapixels_per_second'] = round(stage['pixels']/1e6/max(stage['wall'], 1e-9), 3)
+      entry['peak_rss_mb'] = round(stage['peak_rss_mb'], 1)
+      report[name] = entry
+    return report
+
+def alignment_error(truth, index, matrix):
+  # RMS distance (pixels) between the reference position of the stars and their aligned position
+  stars = numpy.array(truth['stars'])
+  positions = frame_positions(stars, truth['frames'][index], truth['centre'])
+  aligned = positions[:,::-1].dot(numpy.asarray(matrix)[:,0:2].T) + numpy.asarray(matrix)[:,2]
+  return float(numpy.sqrt(((aligned - stars[:,1::-1])**2).sum(axis=1).mean()))
+
+def bench_main(arguments):
+  parser = argparse.ArgumentParser(description='Time every stage of the AstroPhoto pipeline on synthetic star fields, the report is JSON.')
+  parser.add_argument('--rows', type=int, default=1000)
+  parser.add_argument('--columns', type=int, default=1500)
+  parser.add_argument('--frames', type=int, default=8)
+  parser.add_argument('--stars', type=int, default=200)
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--workers', type=int, default=2, help='workers of the stack and of the batch')
+  parser.add_argument('--raw', help='a real raw file, loadRaw is timed on it once per frame')
+  parser.add_argument('--no-batch', action='store_true', help='skip the end to end batch')
+  parser.add_argument('--precision', default='uint16', choices=['uint16', 'float32'], help='working precision of the frames')
+  parser.add_argument('--align-stars', type=int, default=20, help='stars of every frame used for the alignment, above 20 they are indexed by triangles')
+  parser.add_argument('--align', default='drift', choices=['drift', 'hash'], help='alignment predicted from the frames before or matched on the star hashes')
+  parser.add_argument('--output', help='JSON report, default standard output')
+  parser.add_argument('--keep', help='work directory that is kept, default a temporary one')
+  options = parser.parse_args(arguments)
+
+  if options.keep is not None:
+    directory = os.path.abspath(options.keep)
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+  else:
+    directory = tempfile.mkdtemp(prefix='astrobench')
+  # The caches of AstroPhoto go in the work directory, never in the ones of the user
+  os.environ['ASTROPHOTO_CACHE'] = os.path.join(directory, 'cache')
+  os.environ['ASTROPHOTO_CATALOG'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ngc2000.fits')
+  os.environ['ASTROBENCH_TRUTH'] = os.path.join(directory, 'truth.json')
+  solve_field = os.path.join(directory, 'solve-field')
+  wrapper = open(solve_field, 'w')
+  wrapper.write('#!/bin/sh\nexec "%s" "%s" solve-field "$@"\n' % (sys.executable, os.path.abspath(__file__)))
+  wrapper.close()
+  os.chmod(solve_field, 0755)
+  import astrophoto
+
+  try:
+    bench = AstroBench()
+    pixels = options.rows*options.columns
+    truth = bench.measure('synthetic', lambda: synthetic_truth(options.rows, options.columns, options.frames, options.stars, options.seed))
+    truth_file = open(os.environ['ASTROBENCH_TRUTH'], 'w')
+    json.dump(truth, truth_file)
+    truth_file.close()
+    sources = []
+    for i in range(0, options.frames):
+      rgb16 = bench.measure('synthetic', lambda: synthetic_frame(truth, i), pixels)
+      source = os.path.join(directory, 'frame%03d.raw' % i)
+      astrophoto.write_dump(source, {'error': False, 'filename': os.path.join(directory, 'frame%03d.fits' % i), 'white': 65535, 'is_loaded': True, 'is_aligned': False, 'is_flat': False, 'is_solved': False, 'revision': 0, 'rgb16': rgb16, 'width': options.rows, 'height': options.columns})
+      sources.append(source)
+
+    if options.raw is not None:
+      raw_pixels = image_pixels(options.raw)
+      for i in range(0, options.frames):
+        image = astrophoto.AstroImage(options.raw)
+        bench.measure('loadRaw', image.loadRaw, raw_pixels)
+        image = astrophoto.AstroImage(options.raw)
+        bench.measure('loadRaw preview', lambda: image.loadRaw(profile='preview'), raw_pixels)
+      # The same frame as master dark and flat, only the cost of the calibration counts
+      calibration = astrophoto.AstroCalibration('bench', cache=os.path.join(directory, 'calibration'))
+      bench.measure('calibration', lambda: calibration.build('dark', [options.raw]), raw_pixels)
+      bench.measure('calibration', lambda: calibration.build('flat', [options.raw]), raw_pixels)
+      for i in range(0, options.frames):
+        image = astrophoto.AstroImage(options.raw)
+        bench.measure('loadRaw calibrated', lambda: image.loadRaw(calibration=calibration), raw_pixels)
+
+    solver = astrophoto.AstroSolver(solve_field, workers=1, cache=None)
+    live = astrophoto.AstroLiveStack(os.path.join(directory, 'live.raw'))
+    matcher = None
+    # The first frame is solved blind, the others around it
+    hint = None
+    errors = []
+    dumps = []
+    failed = 0
+    quality = astrophoto.AstroQuality()
+    ref_quality = None
+    rejected = 0
+    alignments = {}
+    for i in range(0, options.frames):
+      # The sources are read back as stage outputs would be, the aligned dumps overwrite them
+      image = astrophoto.AstroImage(sources[i], options.precision)
+      bench.measure('openFile', image.openFile, pixels)
+      # Without the cache, the scores are measured every time
+      bench.measure('quality', lambda: image.score(None), pixels)
+      if quality.reject(image.quality, ref_quality) is not None:
+        rejected = rejected + 1
+      if ref_quality is None:
+        ref_quality = image.quality
+      bench.measure('flat', image.flat, pixels)
+      bench.measure('detect', lambda: image.detect(options.align_stars), pixels)
+      bench.measure('solve', lambda: image.solve(field_scale, solver, hint, options.align_stars), pixels)
+      if not image.is_solved:
+        failed = failed + 1
+        continue
+      if hint is None:
+        hint = image.solve_hint()
+      if matcher is None:
+        # The other frames are hashed inside align, with drift only when the prediction fails
+        kind = astrophoto.star_index(options.align_stars)
+        bench.measure('stars_hash', lambda: image.stars_hash(kind))
+        matcher = bench.measure('matcher', lambda: astrophoto.AstroMatcher(image.stars, image.starsHash, image.starsSequence, i, kind=kind))
+        image.is_aligned = True
+      else:
+        index = None
+        if options.align == 'drift':
+          index = i
+        bench.measure('align', lambda: image.align(matcher, index=index), pixels)
+        if not image.is_aligned:
+          failed = failed + 1
+          continue
+        alignments[image.alignment] = alignments.get(image.alignment, 0) + 1
+        errors.append(alignment_error(truth, i, image.transform))
+      bench.measure('saveDump', image.saveDump, pixels)
+      dumps.append(sources[i])
+      bench.measure('live', lambda: live.add(image), pixels)
+
+    stacker = astrophoto.AstroStack(dumps, workers=options.workers)
+    bench.measure('stack', stacker.stack, pixels*len(dumps))
+
+    report = collections.OrderedDict()
+    report['sensor'] = [options.rows, options.columns]
+    report['frames'] = options.frames
+    report['stars'] = options.stars
+    report['workers'] = options.workers
+    report['precision'] = options.precision
+    report['align_stars'] = options.align_stars
+    report['align'] = options.align
+    report['commit'] = git_commit()
+    report['stages'] = bench.report()
+    report['failed'] = failed
+    report['rejected'] = rejected
+    report['alignments'] = alignments
+    if len(errors) > 0:
+      report['alignment_rms'] = round(float(numpy.sqrt(numpy.mean(numpy.square(errors)))), 4)
+    report['stack_error'] = stacker.error
+
+    if not options.no_batch:
+      report['batch'] = batch_run(directory, solve_field, options, truth)
+
+    report = json.dumps(report, indent=2)
+    if options.output is not None:
+      file_report = open(options.output, 'w')
+      file_report.write(report+'\n')
+      file_report.close()
+    else:
+      print report
+  finally:
+    if options.keep is None:
+      shutil.rmtree(directory, ignore_errors=True)
+  return 0
+
+def image_pixels(filename):
+  import rawpy
+  raw = rawpy.imread(filename)
+  return raw.sizes.width*raw.sizes.height
+
+def git_commit():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=open(os.devnull, 'w')).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def batch_run(directory, solve_field, options, truth):
+  # The command line batch of AstroPhoto on fresh copies of the frames, in its own process
+  batch = os.path.join(directory, 'batch')
+  if not os.path.isdir(batch):
+    os.makedirs(batch)
+  import astrophoto
+  frames = []
+  for i in range(0, options.frames):
+    frame = os.path.join(batch, 'frame%03d.raw' % i)
+    astrophoto.write_dump(frame, {'error': False, 'filename': os.path.join(batch, 'frame%03d.fits' % i), 'white': 65535, 'is_loaded': True, 'is_aligned': False, 'is_flat': False, 'is_solved': False, 'revision': 0, 'rgb16': synthetic_frame(truth, i), 'width': options.rows, 'height': options.columns})
+    frames.append(frame)
+  output = os.path.join(batch, 'final.tiff')
+  command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'astrophoto.py')] + frames
+  command = command + ['--output', output, '--workers', str(options.workers), '--solve-field', solve_field, '--pixel-size', str(field_scale), '--focal-length', '206.265', '--precision', options.precision]
+  command = command + ['--align-stars', str(options.align_stars), '--align', options.align]
+  start = time.time()
+  log = open(os.path.join(batch, 'batch.log'), 'w')
+  returncode = subprocess.call(command, stdout=log, stderr=subprocess.STDOUT)
+  log.close()
+  elapsed = time.time() - start
+  result = collections.OrderedDict()
+  result['returncode'] = returncode
+  result['wall'] = round(elapsed, 4)
+  result['frames_per_second'] = round(options.frames/elapsed, 3)
+  result['megapixels_per_second'] = round(options.frames*options.rows*options.columns/1e6/elapsed, 3)
+  # Largest resident size of the child processes, the batch and its workers are the biggest ones
+  result['peak_rss_mb'] = round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss/1024.0, 1)
+  try:
+    summary_file = open(os.path.join(batch, 'final.json'))
+    summary = json.load(summary_file)
+    summary_file.close()
+    result['stacked'] = summary['stacked']
+  except (IOError, ValueError, KeyError):
+    result['stacked'] = None
+  return result
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'solve-field':
+        sys.exit(stand_in(sys.argv[2:]))
+    sys.exit(bench_main(sys.argv[1:]))
+
+if __name__ == '__main__':
+    main()
@@ -18,25 +18,1423 @@ OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
 
 import sys
 import os
+import time
+import argparse
 import subprocess
+import shutil
+import tempfile
+import itertools
+import collections
+import functools
+import re
+import struct
+import json
 import pickle
+import signal
+import resource
+import hashlib
 import threading
+import Queue
+import multiprocessing
 import numpy
 import rawpy
 import rawpy.enhance
 import imageio
 import astropy.io.fits
 import astropy.wcs
-import astropy.modeling
+import astropy.wcs.utils
 import scipy.optimize
+import scipy.ndimage
+import scipy.spatial
 import cv2
-import matplotlib
-matplotlib.use('QT4Agg')
-import matplotlib.pyplot
 from PyQt4 import QtGui, QtCore
 
+# Sensor width and height in mm and pixel size in micrometers
+camera_list = { 'Canon 10D': [ 22.7, 15.1, 7.4], 'Canon 20D': [ 22.5, 15, 6.42], 'Canon 30D': [ 22.5, 15, 6.42],
+    'Canon 40D': [ 22.2, 14.8, 5.71], 'Canon 50D': [ 22.3, 14.9, 4.7], 'Canon 60D': [ 22.3, 14.9, 4.3],
+    'Canon 300D': [ 22.7, 15.1, 7.4], 'Canon 350D': [ 22.2, 14.8, 6.42], 'Canon 400D': [ 22.2, 14.8, 5.71],
+    'Canon 450D': [ 22.2, 14.8, 5.2], 'Canon 500D': [ 22.3, 14.9, 4.7], 'Canon 550D': [ 22.3, 14.9, 4.3],
+    'Canon 600D': [ 22.3, 14.9, 4.3], 'Canon 1000D': [ 22.2, 14.8, 5.7], 'Canon 1100D': [ 22.3, 14.7, 5.2],
+    'Canon 5D': [ 35.8, 23.9, 8.2], 'Canon 5D Mark II': [ 36, 24, 6.41], 'Canon 7D': [ 22.3, 14.9, 4.3],
+    'Canon 1Ds Mark II': [ 36, 24, 7.2], 'Canon 1D Mark III': [ 28.1, 18.7, 7.2], 'Canon 1Ds Mark III': [ 36, 24, 6.42],
+    'Nikon D3': [ 36, 23.9, 8.45], 'Nikon D3X': [ 35.9, 24, 5.9], 'Nikon D40': [ 23.7, 15.6, 7.8],
+    'Nikon D50': [ 23.7, 15.6, 7.8], 'Nikon D60': [ 23.6, 15.8, 6.08], 'Nikon D70': [ 23.7, 15.6, 7.8],
+    'Nikon D80': [ 23.6, 15.8, 6.05], 'Nikon D90': [ 23.6, 15.8, 5.5], 'Nikon D200': [ 23.6, 15.8, 6.05],
+    'Nikon D300': [ 23.6, 15.8, 5.4], 'Nikon D700': [ 36, 23.9, 8.45], 'Nikon D3000': [ 23.6, 15.8, 5.08],
+    'Nikon D3100': [ 23.1, 15.4, 5.02], 'Nikon D5000': [ 23.1, 15.4, 5.5], 'Nikon D7000': [ 23.6, 15.6, 4.78],
+    'Olympus E-5': [ 17.3, 13, 4.7] }
+
+# The 10 star pairs inside a quintuple, in the order used for the hash
+quintuple_pairs = (numpy.array([0, 0, 0, 0, 1, 1, 1, 2, 2, 3]), numpy.array([1, 2, 3, 4, 2, 3, 4, 3, 4, 4]))
+quintuple_cache = {}
+
+def quintuples(stars_number):
+  # All the 5 star combinations of stars_number stars, in lexicographic order
+  if stars_number not in quintuple_cache:
+    combinations = itertools.combinations(range(stars_number), 5)
+    sequence = numpy.fromiter(itertools.chain.from_iterable(combinations), dtype='int')
+    quintuple_cache[stars_number] = sequence.reshape(-1, 5)
+  return quintuple_cache[stars_number]
+
+def quintuple_order(stars, sequence):
+  # Stars of every quintuple sorted by their summed squared distance to the other four, relative
+  # to the largest distance: the order does not change with rotation, scale and translation
+  x = stars[:,0]
+  y = stars[:,1]
+  distance = (x[:,None]-x[None,:])**2+(y[:,None]-y[None,:])**2
+  inside = distance[sequence[:,:,None], sequence[:,None,:]]
+  weight = inside.sum(axis=2)/inside.max(axis=(1,2))[:,None]
+  return sequence[numpy.arange(sequence.shape[0])[:,None], weight.argsort(axis=1)]
+
+def triangle_hash(stars, neighbours=6, separation=0.01):
+  # Triangles of every star with the pairs of its nearest neighbours, at most
+  # stars*neighbours*(neighbours-1)/2 of them. The hash is the ratio of the two shorter sides to the
+  # longest one, the stars are ordered as the sides they face (longest first): the triangles with
+  # sides closer than separation are left out, their order would change with the noise.
+  if stars.shape[0] < 3:
+    return numpy.empty((0, 2)), numpy.empty((0, 3), dtype='int')
+  neighbours = min(neighbours, stars.shape[0]-1)
+  distance, near = scipy.spatial.cKDTree(stars[:,0:2]).query(stars[:,0:2], neighbours+1)
+  triangles = numpy.concatenate([numpy.column_stack((near[:,0], near[:,i], near[:,j])) for i, j in itertools.combinations(range(1, neighbours+1), 2)])
+  triangles = numpy.unique(numpy.sort(triangles, axis=1), axis=0)
+  points = stars[:,0:2][triangles]
+  sides = numpy.column_stack([numpy.hypot(*(points[:,(i+1)%3]-points[:,(i+2)%3]).T) for i in range(0, 3)])
+  order = sides.argsort(axis=1)[:,::-1]
+  rows = numpy.arange(triangles.shape[0])[:,None]
+  sides = sides[rows, order]
+  valid = (sides[:,2] > 0) & (sides[:,0]-sides[:,1] > separation*sides[:,0]) & (sides[:,1]-sides[:,2] > separation*sides[:,0])
+  return sides[valid,1:]/sides[valid,0:1], triangles[rows, order][valid]
+
+def star_index(number):
+  # Up to 20 stars every quintuple is hashed, C(n, 5) grows too fast for more: the triangles of
+  # neighbour stars grow with the number of stars
+  if number <= 20:
+    return 'quintuple'
+  return 'triangle'
+
+def similarity_fit(source, target):
+  # Least squares rotation, scale and shift from source to target, points are complex x+iy
+  source_center = source.mean()
+  target_center = target.mean()
+  rotation = (numpy.conj(source-source_center)*(target-target_center)).sum()/(numpy.abs(source-source_center)**2).sum()
+  return rotation, target_center - rotation*source_center
+
+def similarity_ransac(source, target, threshold=2.0, samples=2000):
+  # Every pair of correspondences (or a random subset of them) proposes a transform, the one with
+  # most points within threshold pixels wins and is refined by least squares on its inliers
+  if len(source) < 2:
+    return None, None
+  pairs = numpy.array(list(itertools.combinations(range(0, len(source)), 2)))
+  if len(pairs) > samples:
+    pairs = pairs[numpy.random.RandomState(0).choice(len(pairs), samples, replace=False)]
+  delta = source[pairs[:,1]]-source[pairs[:,0]]
+  valid = numpy.abs(delta) > 0
+  pairs = pairs[valid]
+  rotation = (target[pairs[:,1]]-target[pairs[:,0]])/delta[valid]
+  shift = target[pairs[:,0]]-rotation*source[pairs[:,0]]
+  residual = numpy.abs(rotation[:,None]*source[None,:]+shift[:,None]-target[None,:])
+  if len(pairs) == 0:
+    return None, None
+  inliers = residual[(residual < threshold).sum(axis=1).argmax()] < threshold
+  for iteration in range(0, 2):
+    if inliers.sum() < 2:
+      return None, None
+    rotation, shift = similarity_fit(source[inliers], target[inliers])
+    inliers = numpy.abs(rotation*source+shift-target) < threshold
+  return similarity_matrix(rotation, shift), inliers
+
+def similarity_matrix(rotation, shift):
+  return numpy.array([[rotation.real, -rotation.imag, shift.real], [rotation.imag, rotation.real, shift.imag]])
+
+def complex_points(points):
+  return numpy.column_stack((points.real, points.imag))
+
+class AstroMatcher:
+  def __init__(self, stars, starsHash, starsSequence, index=None, history=4, kind='quintuple', tree=None, order=None):
+    # The reference side of the matching, the tree is built once for all the frames (or given with
+    # the order of the stars, see reference_matcher). kind is the one of the hashes, see star_index.
+    # index is the position of the reference in the sequence: the transforms of the frames aligned
+    # so far (see track) predict the next ones, history is how many are used.
+    self.stars = stars
+    self.kind = kind
+    self.sequence = starsSequence
+    # Without hashes (less than 5 stars, or 3 for the triangles) nothing matches
+    if order is not None:
+      self.order = order
+    elif kind == 'quintuple' and len(starsSequence) > 0:
+      self.order = quintuple_order(stars, starsSequence)
+    else:
+      self.order = starsSequence
+    if tree is None and len(starsHash) > 0:
+      tree = scipy.spatial.cKDTree(starsHash)
+    self.tree = tree
+    self.positions = None
+    if stars.shape[0] > 0:
+      self.positions = scipy.spatial.cKDTree(complex_points(stars[:,1]+1j*stars[:,0]))
+    self.history = history
+    self.reset(index)
+
+  def reset(self, index=None):
+    # Forgets the frames aligned so far
+    self.tracks = {}
+    if index is not None:
+      self.track(index, similarity_matrix(1.0+0j, 0j))
+
+  def track(self, index, matrix):
+    self.tracks[index] = (matrix[0,0]+1j*matrix[1,0], matrix[0,2]+1j*matrix[1,2])
+
+  def predict(self, index):
+    # Transform of the frame index extrapolated, linearly in the index, from the frames aligned
+    # nearest to it: the drift and the field rotation of a sequence change slowly
+    if len(self.tracks) == 0:
+      return None
+    known = sorted(self.tracks.keys(), key=lambda i: (abs(i-index), -i))[0:self.history]
+    steps = numpy.array(known, dtype=numpy.float64)
+    values = numpy.array([self.tracks[i] for i in known])
+    value = values.mean(axis=0)
+    if steps.ptp() > 0:
+      slope = ((steps-steps.mean())[:,None]*(values-value)).sum(axis=0)/((steps-steps.mean())**2).sum()
+      value = value + slope*(index-steps.mean())
+    return similarity_matrix(value[0], value[1])
+
+  def verify(self, stars, matrix, window=5.0, bright=10, threshold=2.0, minimum=6):
+    # The brightest stars of the image moved by matrix must land within window pixels of a reference
+    # star, then all the stars within threshold refine it. Returns the refined matrix and the matched
+    # star pairs as match does, or None when the prediction is wrong.
+    if matrix is None or self.positions is None or stars.shape[0] < minimum:
+      return None, None
+    source = stars[:,1]+1j*stars[:,0]
+    target = self.stars[:,1]+1j*self.stars[:,0]
+    rotation = matrix[0,0]+1j*matrix[1,0]
+    shift = matrix[0,2]+1j*matrix[1,2]
+    brightest = stars[:,2].argsort()[::-1][0:bright]
+    distance, index = self.positions.query(complex_points(rotation*source[brightest]+shift), distance_upper_bound=window)
+    found = distance < window
+    if found.sum() < max(minimum, len(brightest)/2):
+      return None, None
+    rotation, shift = similarity_fit(source[brightest][found], target[index[found]])
+    distance, index = self.positions.query(complex_points(rotation*source+shift), distance_upper_bound=threshold)
+    found = distance < threshold
+    if found.sum() < minimum:
+      return None, None
+    rotation, shift = similarity_fit(source[found], target[index[found]])
+    return similarity_matrix(rotation, shift), numpy.column_stack((index[found], numpy.nonzero(found)[0]))
+
+  def match(self, stars, starsHash, starsSequence, tolerance=None):
+    # Every image quintuple (or triangle) close to a reference one votes for its star pairs, the pairs
+    # that win in both directions are fitted with a similarity transform. Returns the 2x3 matrix
+    # mapping (x, y) of the image on the reference and the matched star pairs, or None.
+    if tolerance is None:
+      tolerance = {'quintuple': 1e-3, 'triangle': 3e-3}[self.kind]
+    if self.tree is None or len(starsHash) == 0:
+      return None, None
+    distance, index = self.tree.query(starsHash, distance_upper_bound=tolerance)
+    found = distance < tolerance
+    if found.sum() == 0:
+      return None, None
+    order = starsSequence[found]
+    if self.kind == 'quintuple':
+      order = quintuple_order(stars, order)
+    votes = numpy.zeros((self.stars.shape[0], stars.shape[0]))
+    numpy.add.at(votes, (self.order[index[found]].ravel(), order.ravel()), 1)
+    img_stars = numpy.arange(0, stars.shape[0])
+    ref_stars = votes.argmax(axis=0)
+    mutual = (votes[ref_stars, img_stars] > 0) & (votes.argmax(axis=1)[ref_stars] == img_stars)
+    ref_stars = ref_stars[mutual]
+    img_stars = img_stars[mutual]
+    source = stars[img_stars,1]+1j*stars[img_stars,0]
+    target = self.stars[ref_stars,1]+1j*self.stars[ref_stars,0]
+    matrix, inliers = similarity_ransac(source, target)
+    if matrix is None:
+      return None, None
+    return matrix, numpy.column_stack((ref_stars[inliers], img_stars[inliers]))
+
+def reference_matcher(image, kind=None, index=None):
+  # The AstroMatcher of a reference image. Its tree is kept next to the image in a .index file and
+  # used again while the stars are the same, however many they are.
+  image.stars_hash(kind)
+  key = hashlib.sha1(image.starsKind+' '+numpy.ascontiguousarray(image.stars).tostring()).hexdigest()
+  filename = os.path.splitext(image.filename)[0]+'.index'
+  if os.path.isfile(filename):
+    try:
+      file_index = open(filename, 'rb')
+      saved = pickle.load(file_index)
+      file_index.close()
+      if saved['key'] == key:
+        return AstroMatcher(image.stars, image.starsHash, image.starsSequence, index, kind=image.starsKind, tree=saved['tree'], order=saved['order'])
+    except (IOError, EOFError, KeyError, ValueError, pickle.UnpicklingError):
+      pass
+  matcher = AstroMatcher(image.stars, image.starsHash, image.starsSequence, index, kind=image.starsKind)
+  try:
+    file_index = open(filename+'.tmp', 'wb')
+    pickle.dump({'key': key, 'tree': matcher.tree, 'order': matcher.order}, file_index, 2)
+    file_index.close()
+    os.rename(filename+'.tmp', filename)
+  except (IOError, OSError):
+    pass
+  return matcher
+
+# Layout of the .raw dump: magic, version and header length, a JSON header with the
+# scalar attributes and the description of every array, then the arrays themselves,
+# each one starting on a page boundary so that it can be mapped with numpy.memmap
+dump_magic = 'ASTRODMP'
+dump_version = 1
+dump_alignment = 4096
+
+def dump_dtype(descr):
+  # Inverse of numpy.lib.format.dtype_to_descr once the descr went through JSON
+  if isinstance(descr, basestring):
+    return numpy.dtype(str(descr))
+  fields = []
+  for field in descr:
+    if len(field) == 3:
+      fields.append((str(field[0]), dump_dtype(field[1]), tuple(field[2])))
+    else:
+      fields.append((str(field[0]), dump_dtype(field[1])))
+  return numpy.dtype(fields)
+
+def dump_header(filename):
+  # Returns None for the legacy dumps, which are a pickle of the whole object
+  file_dump = open(filename, 'rb')
+  try:
+    if file_dump.read(len(dump_magic)) != dump_magic:
+      return None
+    version, length = struct.unpack('<II', file_dump.read(8))
+    if version > dump_version:
+      raise IOError('Dump version '+str(version)+' is not supported')
+    return json.loads(file_dump.read(length))
+  finally:
+    file_dump.close()
+
+def dump_array(filename, description, mode='c'):
+  # Arrays are mapped copy-on-write, the small ones are read in memory
+  dtype = dump_dtype(description['dtype'])
+  shape = tuple(description['shape'])
+  if int(numpy.prod(shape))*dtype.itemsize < dump_alignment:
+    array = numpy.empty(shape, dtype=dtype)
+    if array.size > 0:
+      file_dump = open(filename, 'rb')
+      file_dump.seek(description['offset'])
+      array[...] = numpy.fromfile(file_dump, dtype=dtype, count=array.size).reshape(shape)
+      file_dump.close()
+    return array
+  return numpy.memmap(filename, dtype=dtype, mode=mode, offset=description['offset'], shape=shape)
+
+def read_dump(filename, header):
+  content = {}
+  for key, value in header['attributes'].items():
+    if isinstance(value, unicode):
+      value = str(value)
+    content[str(key)] = value
+  for key, description in header['arrays'].items():
+    content[str(key)] = dump_array(filename, description)
+  return content
+
+def write_dump(filename, content):
+  attributes = {}
+  arrays = []
+  for key, value in content.items():
+    if isinstance(value, numpy.ndarray):
+      if not value.dtype.hasobject:
+        arrays.append((key, numpy.ascontiguousarray(value).view(numpy.ndarray)))
+    elif isinstance(value, numpy.generic):
+      attributes[key] = value.item()
+    else:
+      try:
+        json.dumps(value)
+        attributes[key] = value
+      except (TypeError, ValueError):
+        pass
+  # The header size depends on the offsets written in it, grow it until everything fits
+  header_size = dump_alignment
+  while True:
+    offset = header_size
+    descriptions = {}
+    for key, value in arrays:
+      descriptions[key] = {'dtype': numpy.lib.format.dtype_to_descr(value.dtype), 'shape': value.shape, 'offset': offset}
+      offset = offset + (value.nbytes + dump_alignment - 1) / dump_alignment * dump_alignment
+    header = json.dumps({'attributes': attributes, 'arrays': descriptions})
+    if len(dump_magic) + 8 + len(header) <= header_size:
+      break
+    header_size = (len(dump_magic) + 8 + len(header) + dump_alignment - 1) / dump_alignment * dump_alignment
+  # Written aside and renamed, so a dump can be saved over the file it is mapped from
+  file_dump = open(filename+'.tmp', 'wb')
+  try:
+    file_dump.write(dump_magic + struct.pack('<II', dump_version, len(header)) + header)
+    for key, value in arrays:
+      file_dump.seek(descriptions[key]['offset'])
+      value.tofile(file_dump)
+  finally:
+    file_dump.close()
+  os.rename(filename+'.tmp', filename)
+
+def memory_usage():
+  # Resident and peak resident size of the process in MB, the peak only where /proc is missing
+  try:
+    status = open('/proc/self/status')
+    values = {}
+    for line in status:
+      if line.startswith('VmRSS:') or line.startswith('VmHWM:'):
+        values[line[0:5]] = int(line.split()[1])/1024.0
+    status.close()
+    return values.get('VmRSS'), values.get('VmHWM')
+  except IOError:
+    return None, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0
+
+def reset_peak():
+  # Linux resets the peak resident size of the process when 5 is written in clear_refs
+  try:
+    clear_refs = open('/proc/self/clear_refs', 'w')
+    clear_refs.write('5')
+    clear_refs.close()
+    return True
+  except IOError:
+    return False
+
+# RUSAGE_THREAD of Linux, missing from the resource module of Python 2
+rusage_thread = getattr(resource, 'RUSAGE_THREAD', 1 if sys.platform.startswith('linux') else None)
+
+def cpu_time():
+  # CPU seconds of the calling thread and 'thread' where the system counts them, otherwise of the
+  # whole process and 'process'. The threads of the libraries (OpenCV) are not in the thread time.
+  if rusage_thread is not None:
+    try:
+      usage = resource.getrusage(rusage_thread)
+      return usage.ru_utime+usage.ru_stime, 'thread'
+    except (ValueError, resource.error):
+      pass
+  times = os.times()
+  return times[0]+times[1], 'process'
+
+class AstroStage:
+  # A stage running while profiling, recorded when it ends
+  def __init__(self, profiler, name, frame, arguments):
+    self.profiler = profiler
+    self.name = name
+    self.frame = frame
+    self.arguments = arguments
+    self.peak = 0.0
+
+  def __enter__(self):
+    self.start = time.time()
+    self.cpu = cpu_time()[0]
+    self.profiler.enter(self)
+    return self
+
+  def __exit__(self, kind, value, traceback):
+    cpu, cpu_scope = cpu_time()
+    peak, peak_scope = self.profiler.leave(self)
+    self.arguments['error'] = kind is not None
+    self.profiler.record(self.name, self.frame, self.start, time.time()-self.start, cpu-self.cpu, self.arguments, peak, peak_scope, cpu_scope)
+    return False
+
+class AstroNoStage:
+  # What a disabled profiler gives instead of a stage
+  def __enter__(self):
+    return self
+
+  def __exit__(self, kind, value, traceback):
+    return False
+
+no_stage = AstroNoStage()
+
+class AstroProfiler:
+  def __init__(self, enabled=False):
+    # Wall and CPU time and memory of every stage of every frame. The CPU time is the one of the
+    # thread running the stage where it is counted (cpu_scope 'thread', see cpu_time). The peak
+    # resident size is the one during the stage (peak_scope 'stage'), the peak of the process is
+    # reset when a stage starts; where it cannot be reset it is the peak since the process started
+    # (peak_scope 'process'). Stages running at the same time in other threads add to the peak.
+    # When disabled a stage costs one attribute test.
+    self.enabled = enabled
+    self.events = []
+    self.open = []
+    self.lock = threading.Lock()
+    self.resettable = False
+
+  def enter(self, stage):
+    # The peak so far goes to the stages still open before it is reset for the new one
+    with self.lock:
+      rss, peak = memory_usage()
+      for other in self.open:
+        other.peak = max(other.peak, peak)
+      self.resettable = reset_peak()
+      self.open.append(stage)
+
+  def leave(self, stage):
+    # Peak resident size in MB during the stage and its scope
+    with self.lock:
+      rss, peak = memory_usage()
+      for other in self.open:
+        other.peak = max(other.peak, peak)
+      if stage in self.open:
+        self.open.remove(stage)
+      if self.resettable:
+        return stage.peak, 'stage'
+      return peak, 'process'
+
+  def stage(self, name, frame=None, **arguments):
+    if not self.enabled:
+      return no_stage
+    return AstroStage(self, name, frame, arguments)
+
+  def record(self, name, frame, start, wall, cpu=None, arguments=None, peak=None, peak_scope=None, cpu_scope=None):
+    # The events recorded without a stage (a frame, a solve-field run) have no peak of their own
+    if not self.enabled:
+      return
+    rss = memory_usage()[0]
+    event = {'name': name, 'frame': frame, 'start': start, 'wall': wall, 'cpu': cpu, 'cpu_scope': cpu_scope, 'rss_mb': rss, 'peak_rss_mb': peak, 'peak_scope': peak_scope, 'pid': os.getpid(), 'thread': threading.current_thread().ident}
+    if arguments:
+      event['arguments'] = arguments
+    self.events.append(event)
+
+  def drain(self):
+    # Events recorded so far, handed over by the worker processes with their outcome
+    events = self.events
+    self.events = []
+    return events
+
+  def summary(self):
+    stages = {}
+    frames = {}
+    for event in self.events:
+      stage = stages.setdefault(event['name'], {'count': 0, 'wall': 0.0, 'cpu': 0.0, 'max_wall': 0.0, 'peak_rss_mb': 0.0})
+      stage['count'] = stage['count'] + 1
+      stage['wall'] = stage['wall'] + event['wall']
+      stage['cpu'] = stage['cpu'] + (event['cpu'] or 0.0)
+      stage['max_wall'] = max(stage['max_wall'], event['wall'])
+      stage['peak_rss_mb'] = max(stage['peak_rss_mb'], event['peak_rss_mb'] or 0.0)
+      if event['frame'] is not None:
+        frame = frames.setdefault(event['frame'], {})
+        frame[event['name']] = frame.get(event['name'], 0.0) + event['wall']
+    return {'stages': stages, 'frames': frames}
+
+  def save(self, filename, format=None):
+    # format is 'json' (events and totals per stage and per frame) or 'chrome' (chrome://tracing
+    # and Perfetto), by default 'chrome' for the names ending with .trace
+    if format is None:
+      format = 'chrome' if filename.endswith('.trace') else 'json'
+    if format == 'chrome':
+      trace = []
+      for event in self.events:
+        arguments = dict(event.get('arguments', {}), frame=event['frame'], cpu=event['cpu'], cpu_scope=event.get('cpu_scope'), rss_mb=event['rss_mb'], peak_rss_mb=event['peak_rss_mb'], peak_scope=event.get('peak_scope'))
+        trace.append({'name': event['name'], 'cat': 'astrophoto', 'ph': 'X', 'ts': event['start']*1e6, 'dur': event['wall']*1e6, 'pid': event['pid'], 'tid': event['thread'], 'args': arguments})
+      content = {'traceEvents': trace, 'displayTimeUnit': 'ms'}
+    else:
+      content = self.summary()
+      content['events'] = self.events
+    file_profile = open(filename, 'w')
+    json.dump(content, file_profile, indent=1)
+    file_profile.close()
+
+# Enabled from the start when ASTROPHOTO_PROFILE names the file of the trace
+profiler = AstroProfiler(os.environ.get('ASTROPHOTO_PROFILE') is not None)
+
+def profiled(name):
+  # Method decorator, every call is a stage named name of the frame self.filename
+  def decorator(method):
+    @functools.wraps(method)
+    def call(self, *arguments, **keywords):
+      if not profiler.enabled:
+        return method(self, *arguments, **keywords)
+      with profiler.stage(name, getattr(self, 'filename', None)):
+        return method(self, *arguments, **keywords)
+    return call
+  return decorator
+
+# Solutions and bad pixel maps are kept here, it can be moved with the ASTROPHOTO_CACHE environment variable
+cache_directory = os.environ.get('ASTROPHOTO_CACHE', os.path.join(os.path.expanduser('~'), '.astrophoto'))
+
+# solve-field of astrometry.net, it can be moved with the ASTROPHOTO_SOLVE_FIELD environment variable
+solve_field = os.environ.get('ASTROPHOTO_SOLVE_FIELD', '/usr/local/astrometry/bin/solve-field')
+solve_timeout = 300
+solve_cache = os.path.join(cache_directory, 'solve')
+
+def scale_wcs(header, factor):
+  # WCS of the frame, as a string, from the header solved on the frame reduced factor times.
+  # FITS pixels count from 1 so the centre of the first reduced pixel is (factor+1)/2.
+  if factor != 1:
+    for key in header.keys():
+      if key in ('CRPIX1', 'CRPIX2'):
+        header[key] = factor*(header[key]-0.5)+0.5
+      elif re.match('^(CD[12]_[12]|CDELT[12])$', key):
+        header[key] = header[key]/float(factor)
+      elif key in ('IMAGEW', 'IMAGEH'):
+        header[key] = header[key]*factor
+      else:
+        # SIP distortion, the terms of order p+q scale with factor**(1-p-q)
+        sip = re.match('^(A|B|AP|BP)_([0-9])_([0-9])$', key)
+        if sip is not None:
+          header[key] = header[key]*float(factor)**(1-int(sip.group(2))-int(sip.group(3)))
+  return astropy.wcs.WCS(header).to_header_string(relax=True)
+
+class AstroSolveJob:
+  def __init__(self, key, rgb16, scale_low, scale_high, frame=None, hint=None, stars=None, downsample=2):
+    self.key = key
+    self.frame = frame
+    self.rgb16 = rgb16
+    self.scale_low = scale_low
+    self.scale_high = scale_high
+    self.hint = hint
+    self.stars = stars
+    # Reduction of the frame given to solve-field, a star list keeps the coordinates of the frame
+    if stars is not None:
+      self.factor = 1
+    else:
+      self.factor = downsample
+    # pending, running, solved, failed, timeout or cancelled
+    self.status = 'pending'
+    self.solution = None
+    self.returncode = None
+    self.elapsed = 0.0
+    self.cancelled = threading.Event()
+    self.done = threading.Event()
+
+  def cancel(self):
+    self.cancelled.set()
+
+  def wait(self, timeout=None):
+    self.done.wait(timeout)
+    return self.solution
+
+class AstroSolver:
+  def __init__(self, binary=None, workers=2, timeout=None, cache=solve_cache):
+    # Every job runs in a private temporary directory, so several solve-field can run side by side.
+    # Solutions are cached by frame content, scale bounds and hint, cache=None disables the cache.
+    if binary is None:
+      binary = solve_field
+    if timeout is None:
+      timeout = solve_timeout
+    self.binary = binary
+    self.timeout = timeout
+    self.cache = cache
+    self.queue = Queue.Queue()
+    self.threads = []
+    for i in range(0, max(1, workers)):
+      thread = threading.Thread(target=self.worker)
+      thread.daemon = True
+      thread.start()
+      self.threads.append(thread)
+
+  def submit(self, rgb16, scale, frame=None, hint=None, stars=None, downsample=2):
+    # frame only names the job in the profile. hint (see AstroImage.solve_hint) limits the search
+    # to the field of another frame of the session. solve-field gets stars (row, column, flux),
+    # when given, as a star list or the luminance reduced downsample times as a 16 bit FITS.
+    scale_low = scale*80.0/100.0
+    scale_high = scale*120.0/100.0
+    content = hashlib.sha1(numpy.ascontiguousarray(rgb16)).hexdigest()
+    if stars is not None:
+      content = content+' stars '+hashlib.sha1(numpy.ascontiguousarray(stars)).hexdigest()
+    else:
+      content = content+' image '+str(downsample)
+    if hint is not None:
+      content = content+' hint '+json.dumps(hint, sort_keys=True)
+    key = hashlib.sha1(content+' '+repr(scale_low)+' '+repr(scale_high)).hexdigest()
+    job = AstroSolveJob(key, rgb16, scale_low, scale_high, frame, hint, stars, downsample)
+    job.solution = self.cached(key, job.factor)
+    if job.solution is not None:
+      job.status = 'solved'
+      profiler.record('solve-field', frame, time.time(), 0.0, None, {'status': 'cached', 'key': key})
+      job.rgb16 = None
+      job.stars = None
+      job.done.set()
+    else:
+      self.queue.put(job)
+    return job
+
+  def solve(self, rgb16, scale, frame=None, hint=None, stars=None, downsample=2):
+    return self.submit(rgb16, scale, frame, hint, stars, downsample).wait()
+
+  def cached(self, key, factor):
+    if self.cache is None or not os.path.isfile(os.path.join(self.cache, key+'.corr')):
+      return None
+    try:
+      return self.solution(os.path.join(self.cache, key+'.corr'), os.path.join(self.cache, key+'.wcs'), factor)
+    except:
+      return None
+
+  def solution(self, corr, wcs, factor):
+    # Files as written by solve-field, the positions are moved to the pixels (from 0) of the frame
+    correlation = numpy.array(astropy.io.fits.open(corr, memmap=False)[1].data)
+    for column in ('field_x', 'field_y', 'index_x', 'index_y'):
+      if column in correlation.dtype.names:
+        correlation[column] = factor*(correlation[column]-0.5)-0.5
+    header = astropy.io.fits.open(wcs, memmap=False)[0].header
+    return {'correlation': correlation, 'wcs_header': scale_wcs(header, factor)}
+
+  def worker(self):
+    while True:
+      job = self.queue.get()
+      try:
+        if job.cancelled.is_set():
+          job.status = 'cancelled'
+        else:
+          self.run(job)
+      except:
+        job.status = 'failed'
+      job.rgb16 = None
+      job.stars = None
+      job.done.set()
+
+  def run(self, job):
+    start = time.time()
+    directory = tempfile.mkdtemp(prefix='astrosolve')
+    try:
+      rows, columns = job.rgb16.shape[0:2]
+      if job.stars is not None:
+        # X and Y count from 1, solve-field uses the brightest stars first
+        table = astropy.io.fits.BinTableHDU.from_columns([astropy.io.fits.Column(name='X', format='E', array=job.stars[:,1]+1),
+                                                          astropy.io.fits.Column(name='Y', format='E', array=job.stars[:,0]+1),
+                                                          astropy.io.fits.Column(name='FLUX', format='E', array=job.stars[:,2])])
+        table.writeto(os.path.join(directory, 'frame.xyls'))
+        arguments = ["--width", str(columns), "--height", str(rows), "--sort-column", "FLUX", "frame.xyls"]
+      else:
+        rows = rows/job.factor
+        columns = columns/job.factor
+        luminance = cv2.resize(job.rgb16[0:rows*job.factor, 0:columns*job.factor], (columns, rows), interpolation=cv2.INTER_AREA).mean(axis=2)
+        astropy.io.fits.PrimaryHDU(to_uint16(luminance.astype(numpy.float32))).writeto(os.path.join(directory, 'frame.fits'))
+        arguments = ["frame.fits"]
+      if job.hint is not None:
+        arguments = ["--ra", repr(job.hint['ra']), "--dec", repr(job.hint['dec']), "--radius", repr(job.hint['radius']), "--parity", job.hint['parity']] + arguments
+      job.status = 'running'
+      log = open(os.path.join(directory, 'frame.log'), 'w')
+      # solve-field starts other processes, its own process group is killed on timeout or cancel
+      process = subprocess.Popen([self.binary, "--tweak-order", "2", "--scale-units", "arcsecperpix", "--scale-low", str(job.scale_low*job.factor), "--scale-high", str(job.scale_high*job.factor), "--no-plots", "--overwrite"] + arguments, cwd=directory, stdout=log, stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+      while process.poll() is None:
+        if job.cancelled.is_set() or time.time() - start > self.timeout:
+          os.killpg(process.pid, signal.SIGKILL)
+          process.wait()
+          if job.cancelled.is_set():
+            job.status = 'cancelled'
+          else:
+            job.status = 'timeout'
+          break
+        time.sleep(0.05)
+      log.close()
+      job.returncode = process.returncode
+      if job.status == 'running':
+        if os.path.isfile(os.path.join(directory, 'frame.solved')):
+          job.solution = self.solution(os.path.join(directory, 'frame.corr'), os.path.join(directory, 'frame.wcs'), job.factor)
+          job.status = 'solved'
+          if self.cache is not None:
+            # The .corr is renamed last, it marks a complete entry
+            if not os.path.isdir(self.cache):
+              os.makedirs(self.cache)
+            shutil.copy(os.path.join(directory, 'frame.wcs'), os.path.join(self.cache, job.key+'.wcs'))
+            shutil.copy(os.path.join(directory, 'frame.corr'), os.path.join(self.cache, job.key+'.corr.tmp'))
+            os.rename(os.path.join(self.cache, job.key+'.corr.tmp'), os.path.join(self.cache, job.key+'.corr'))
+        else:
+          job.status = 'failed'
+    finally:
+      job.elapsed = time.time() - start
+      profiler.record('solve-field', job.frame, start, job.elapsed, None, {'status': job.status, 'returncode': job.returncode, 'key': job.key})
+      shutil.rmtree(directory, ignore_errors=True)
+
+# One solver per process, the worker threads do not survive a fork
+solvers = {}
+
+def default_solver():
+  if os.getpid() not in solvers:
+    solvers[os.getpid()] = AstroSolver()
+  return solvers[os.getpid()]
+
+# Deep sky catalog: a FITS table with number, RA, Dec and radius (degrees) in the first columns
+ngc_catalog = os.environ.get('ASTROPHOTO_CATALOG', '/usr/local/astrometry/extra/ngc2000.fits')
+
+class AstroCatalog:
+  def __init__(self, filename, band=1.0):
+    # Objects are sorted in declination bands of band degrees and by RA inside every band,
+    # a cone search reads only the RA window of the bands crossed by the cone
+    table = astropy.io.fits.open(filename, memmap=False)[1].data
+    number = numpy.array(table.field(0))
+    ra = numpy.array(table.field(1), dtype=float) % 360.0
+    dec = numpy.array(table.field(2), dtype=float)
+    if len(table.columns) > 3:
+      radius = numpy.array(table.field(3), dtype=float)
+    else:
+      radius = numpy.zeros(len(number))
+    self.band = band
+    self.bands_number = int(numpy.ceil(180.0/band))
+    bands = numpy.clip(((dec+90.0)/band).astype(int), 0, self.bands_number-1)
+    order = numpy.lexsort((ra, bands))
+    self.number = number[order]
+    self.ra = ra[order]
+    self.dec = dec[order]
+    self.radius = radius[order]
+    self.starts = numpy.searchsorted(bands[order], numpy.arange(0, self.bands_number+1))
+    self.vectors = self.unit(self.ra, self.dec)
+
+  def unit(self, ra, dec):
+    ra = numpy.radians(ra)
+    dec = numpy.radians(dec)
+    return numpy.column_stack((numpy.cos(dec)*numpy.cos(ra), numpy.cos(dec)*numpy.sin(ra), numpy.sin(dec)))
+
+  def cone(self, ra, dec, radius):
+    # Indices of the objects within radius degrees from ra, dec
+    first = max(0, int((dec-radius+90.0)/self.band))
+    last = min(self.bands_number-1, int((dec+radius+90.0)/self.band))
+    # Half width in RA of the cone, the whole band when the cone reaches a pole
+    if abs(dec)+radius >= 90.0:
+      ra_width = 180.0
+    else:
+      ra_width = numpy.degrees(numpy.arcsin(numpy.sin(numpy.radians(radius))/numpy.cos(numpy.radians(dec))))
+    if ra_width >= 180.0:
+      windows = [(0.0, 360.0)]
+    else:
+      low = (ra-ra_width) % 360.0
+      high = (ra+ra_width) % 360.0
+      if low <= high:
+        windows = [(low, high)]
+      else:
+        windows = [(low, 360.0), (0.0, high)]
+    candidates = []
+    for band in range(first, last+1):
+      start, stop = self.starts[band], self.starts[band+1]
+      for low, high in windows:
+        left = start + numpy.searchsorted(self.ra[start:stop], low, 'left')
+        right = start + numpy.searchsorted(self.ra[start:stop], high, 'right')
+        candidates.append(numpy.arange(left, right))
+    if len(candidates) == 0:
+      return numpy.empty(0, dtype=int)
+    candidates = numpy.concatenate(candidates)
+    inside = self.vectors[candidates].dot(self.unit(numpy.array([ra]), numpy.array([dec]))[0]) >= numpy.cos(numpy.radians(radius))
+    return candidates[inside]
+
+  def field(self, wcs, shape):
+    # Objects inside a frame of shape rows x columns: number, x, y and radius in pixels
+    rows, columns = shape[0], shape[1]
+    scale = astropy.wcs.utils.proj_plane_pixel_scales(wcs).mean()
+    center = wcs.wcs_pix2world(numpy.array([[columns/2.0, rows/2.0]]), 1)[0]
+    found = self.cone(center[0], center[1], numpy.hypot(rows, columns)/2.0*scale*1.05)
+    galaxy = numpy.empty((len(found), 4), dtype=numpy.int)
+    if len(found) == 0:
+      return galaxy
+    pixels = wcs.wcs_world2pix(numpy.column_stack((self.ra[found], self.dec[found])), 1)
+    inside = (pixels[:,0] > 0) & (pixels[:,0] < columns) & (pixels[:,1] > 0) & (pixels[:,1] < rows)
+    galaxy = galaxy[0:inside.sum()]
+    galaxy[:,0] = self.number[found][inside]
+    galaxy[:,1] = pixels[inside,0]
+    galaxy[:,2] = pixels[inside,1]
+    galaxy[:,3] = self.radius[found][inside]/scale
+    return galaxy
+
+# Catalogs are read once per process
+catalogs = {}
+
+def catalog(filename=None):
+  if filename is None:
+    filename = ngc_catalog
+  if filename not in catalogs:
+    catalogs[filename] = AstroCatalog(filename)
+  return catalogs[filename]
+
+bad_pixels_cache = os.path.join(cache_directory, 'badpixels')
+
+class AstroBadPixels:
+  def __init__(self, camera, temperature=None, cache=bad_pixels_cache):
+    # Hot and dead pixel map of a camera at a sensor temperature (rounded to 5 degrees).
+    # Every frame fed to the map votes for its candidates, a pixel is bad when it is a
+    # candidate in confirm_ratio of the frames, so stars moving between frames do not count:
+    # light frames only vote when their stars move (see frames_moved), darks always do.
+    self.camera = camera
+    self.temperature = temperature
+    if temperature is None:
+      name = camera+'_any'
+    else:
+      name = camera+'_'+str(int(5*round(temperature/5.0)))+'C'
+    self.filename = os.path.join(cache, re.sub('[^A-Za-z0-9_+-]', '_', name)+'.npz')
+    self.frames = 0
+    self.candidates = numpy.empty(0, dtype=numpy.int64)
+    self.counts = numpy.empty(0, dtype=numpy.int64)
+    self.sources = set()
+    self.load()
+
+  def load(self):
+    if os.path.isfile(self.filename):
+      try:
+        bad_pixels = numpy.load(self.filename)
+        self.frames = int(bad_pixels['frames'])
+        self.candidates = bad_pixels['candidates']
+        self.counts = bad_pixels['counts']
+        self.sources = set(str(source) for source in bad_pixels['sources'])
+      except:
+        self.frames = 0
+
+  def save(self):
+    if not os.path.isdir(os.path.dirname(self.filename)):
+      os.makedirs(os.path.dirname(self.filename))
+    file_map = open(self.filename+'.tmp', 'wb')
+    numpy.savez(file_map, frames=self.frames, candidates=self.candidates, counts=self.counts, sources=numpy.array(sorted(self.sources)))
+    file_map.close()
+    os.rename(self.filename+'.tmp', self.filename)
+
+  @profiled('badpixels')
+  def update(self, filenames):
+    # Frames already in the map are skipped, darks are the best input but light frames work
+    added = False
+    for filename in filenames:
+      source = os.path.abspath(filename)
+      if source in self.sources:
+        continue
+      candidates = rawpy.enhance.find_bad_pixels([filename], find_hot=True, find_dead=True, confirm_ratio=1.0)
+      candidates = numpy.unique(candidates[:,0].astype(numpy.int64)*65536 + candidates[:,1])
+      keys, inverse = numpy.unique(numpy.concatenate((self.candidates, candidates)), return_inverse=True)
+      self.counts = numpy.bincount(inverse, weights=numpy.concatenate((self.counts, numpy.ones(len(candidates))))).astype(numpy.int64)
+      self.candidates = keys
+      self.frames = self.frames + 1
+      self.sources.add(source)
+      added = True
+    if added:
+      self.save()
+
+  def pixels(self, confirm_ratio=0.9):
+    # Row and column of the bad pixels in the visible raw
+    confirmed = self.candidates[self.counts >= max(1, int(numpy.ceil(confirm_ratio*self.frames)))]
+    return numpy.column_stack((confirmed / 65536, confirmed % 65536))
+
+  def signature(self):
+    # Identity of the map as it is now, for the keys of the artifacts
+    return [os.path.basename(self.filename), self.frames, hashlib.sha1(self.candidates.tostring()+self.counts.tostring()).hexdigest()]
+
+  def repair(self, raw):
+    pixels = self.pixels()
+    if len(pixels) > 0:
+      rawpy.enhance.repair_bad_pixels(raw, pixels, method='median')
+
+def bad_pixels_sample(bad_pixels, filenames, frames=8):
+  # Frames spread over a session to complete a map that has seen less than frames frames
+  missing = frames - bad_pixels.frames
+  if missing <= 0 or len(filenames) == 0:
+    return []
+  step = max(1, len(filenames) / missing)
+  return filenames[::step][0:missing]
+
+def frames_moved(filenames, shift=5.0, number=50):
+  # True when most stars of every frame are more than shift pixels (of the full frame) away from
+  # the stars of the frame before. Otherwise (guided without dithering) the stars stay on the same
+  # pixels and would be voted hot pixels. The frames are decoded as previews.
+  if len(filenames) < 2:
+    return False
+  previous = None
+  for filename in filenames:
+    image = AstroImage(filename)
+    image.loadRaw(profile='preview')
+    if image.error:
+      return False
+    image.detect(number)
+    if not image.is_detected:
+      return False
+    if previous is not None:
+      distance, index = scipy.spatial.cKDTree(previous[:,0:2]).query(image.stars[:,0:2])
+      if numpy.mean(distance <= shift) >= 0.5:
+        return False
+    previous = image.stars
+  return True
+
+calibration_cache = os.path.join(cache_directory, 'calibration')
+
+def raw_black(raw):
+  return float(numpy.mean(raw.black_level_per_channel))
+
+class AstroCalibration:
+  def __init__(self, camera, exposure=None, temperature=None, cache=calibration_cache, memory=512*1024*1024, optics=None, reuse=False):
+    # Master bias, dark and flat of a camera, applied to the raw data before the demosaicing.
+    # The bias is kept per sensor temperature, the dark per exposure (seconds) and temperature
+    # (rounded to 5 degrees), the flat per camera and optics (telescope, filter or session name,
+    # the dust and vignetting change with them). The masters are combined a band of rows at a time
+    # within memory bytes. With reuse the masters in the cache are used until new frames are given,
+    # except a dark of unknown exposure; otherwise only the masters built from given frames apply.
+    self.camera = camera
+    self.exposure = exposure
+    self.temperature = temperature
+    self.cache = cache
+    self.memory = memory
+    self.optics = optics
+    self.masters = {}
+    self.sources = {}
+    if reuse:
+      for kind in ('bias', 'dark', 'flat'):
+        if kind != 'dark' or exposure is not None:
+          self.load(kind)
+
+  def master_file(self, kind):
+    name = self.camera+'_'+kind
+    if kind == 'flat' and self.optics is not None:
+      name = name+'_'+self.optics
+    if kind == 'dark':
+      if self.exposure is None:
+        name = name+'_any'
+      else:
+        name = name+'_'+('%g' % self.exposure)+'s'
+    if kind in ('bias', 'dark'):
+      if self.temperature is None:
+        name = name+'_any'
+      else:
+        name = name+'_'+str(int(5*round(self.temperature/5.0)))+'C'
+    return os.path.join(self.cache, re.sub('[^A-Za-z0-9_+-]', '_', name)+'.npz')
+
+  def load(self, kind):
+    if os.path.isfile(self.master_file(kind)):
+      try:
+        master = numpy.load(self.master_file(kind))
+        self.masters[kind] = master['master']
+        self.sources[kind] = [str(source) for source in master['sources']]
+      except:
+        self.masters.pop(kind, None)
+        self.sources.pop(kind, None)
+
+  def save(self, kind):
+    if not os.path.isdir(self.cache):
+      os.makedirs(self.cache)
+    filename = self.master_file(kind)
+    file_master = open(filename+'.tmp', 'wb')
+    numpy.savez(file_master, master=self.masters[kind], sources=numpy.array(self.sources[kind]))
+    file_master.close()
+    os.rename(filename+'.tmp', filename)
+
+  def combine(self, filenames, normalize, mode, tolerance):
+    # The visible raw data of the frames are spooled to disk and combined by bands of rows.
+    # With normalize (flats) every frame is brought to the level of the first one.
+    directory = tempfile.mkdtemp(prefix='astrocalibration')
+    try:
+      frames = []
+      blacks = []
+      shape = None
+      level = None
+      for i in range(0, len(filenames)):
+        raw = rawpy.imread(filenames[i])
+        data = raw.raw_image_visible
+        if shape is None:
+          shape = data.shape
+          colors = raw.raw_colors_visible.copy()
+        if data.shape != shape:
+          raise ValueError('Calibration frames of different sizes')
+        blacks.append(raw_black(raw))
+        if normalize:
+          frame_level = float(numpy.median(data[::8, ::8])) - blacks[-1]
+          if level is None:
+            level = frame_level
+          data = (data.astype(numpy.float32) - blacks[-1])*(level/max(frame_level, 1.0)) + blacks[-1]
+          numpy.clip(data, 0, 65535, out=data)
+        frame = os.path.join(directory, 'frame'+str(i))
+        numpy.ascontiguousarray(data, dtype=numpy.uint16).tofile(frame)
+        raw.close()
+        frames.append(numpy.memmap(frame, dtype=numpy.uint16, mode='r', shape=shape))
+      master = numpy.empty(shape, dtype=numpy.uint16)
+      rows = stack_rows(self.memory, len(frames), shape[1], 1, mode)
+      for start in range(0, shape[0], rows):
+        band = numpy.array([frame[start:start+rows] for frame in frames])[:,:,:,None]
+        master[start:start+rows] = stack_band(band, None, mode, tolerance)[:,:,0]
+      return master, numpy.mean(blacks), colors
+    finally:
+      shutil.rmtree(directory, ignore_errors=True)
+
+  @profiled('calibration')
+  def build(self, kind, filenames, mode='sigma', tolerance=3.0):
+    # kind is 'bias', 'dark' or 'flat'. The same frames of the cached master are not combined again.
+    # The flat is kept as the gain of every pixel, the ratio between the mean of its color and
+    # its value above the bias (or the black level without a bias).
+    sources = sorted(os.path.abspath(filename) for filename in filenames)
+    if len(sources) == 0:
+      return
+    if kind not in self.masters:
+      self.load(kind)
+    if kind in self.masters and sources == self.sources.get(kind):
+      return
+    master, black, colors = self.combine(sources, kind == 'flat', mode, tolerance)
+    if kind == 'flat':
+      bias = self.masters.get('bias')
+      if bias is not None and bias.shape == master.shape:
+        signal = master.astype(numpy.float32) - bias
+      else:
+        signal = master.astype(numpy.float32) - black
+      master = numpy.ones(signal.shape, dtype=numpy.float32)
+      for color in numpy.unique(colors):
+        pixels = colors == color
+        mean = signal[pixels].mean()
+        # Dead or unlit pixels are left alone
+        valid = pixels & (signal > 0.05*mean)
+        master[valid] = mean/signal[valid]
+    self.masters[kind] = master
+    self.sources[kind] = sources
+    self.save(kind)
+
+  def signature(self):
+    # The masters in use are identified by the frames they were combined from
+    return dict((kind, self.sources.get(kind)) for kind in sorted(self.masters.keys()))
+
+  def describe(self):
+    # One line per master in use: its cache file and the number of frames combined
+    lines = []
+    for kind in ('bias', 'dark', 'flat'):
+      if kind in self.masters:
+        lines.append('Master '+kind+' '+os.path.basename(self.master_file(kind))+' of '+str(len(self.sources.get(kind, [])))+' frames')
+    return lines
+
+  def apply(self, raw):
+    # In place on the visible raw data, a band of rows at a time: the dark (or the bias) is
+    # subtracted and the flat gain multiplied, the black level stays for the demosaicing
+    offset = self.masters.get('dark', self.masters.get('bias'))
+    gain = self.masters.get('flat')
+    if offset is None and gain is None:
+      return
+    data = raw.raw_image_visible
+    for master in (offset, gain):
+      if master is not None and master.shape != data.shape:
+        raise ValueError('Calibration master of a different size')
+    black = raw_black(raw)
+    for start in range(0, data.shape[0], 256):
+      stop = min(data.shape[0], start+256)
+      band = data[start:stop].astype(numpy.float32)
+      if offset is not None:
+        band -= offset[start:stop]
+      else:
+        band -= black
+      if gain is not None:
+        band *= gain[start:stop]
+      band += black
+      numpy.clip(band, 0, 65535, out=band)
+      data[start:stop] = band
+
+def flat_polynomial(mesh, centre_y, centre_x, rows, columns, order):
+  # Closed form least squares fit of a polynomial of the given order to the mesh, as separable factors.
+  # centre_y and centre_x are the pixel coordinates of the mesh cells.
+  v = (centre_y+0.5)/rows*2.0-1.0
+  u = (centre_x+0.5)/columns*2.0-1.0
+  v, u = numpy.meshgrid(v, u, indexing='ij')
+  terms = [(i, j) for i in range(0, order+1) for j in range(0, order+1-i)]
+  design = numpy.column_stack([(v**i*u**j).ravel() for i, j in terms])
+  values = mesh.ravel()
+  good = numpy.ones(values.shape, dtype=bool)
+  # Cells still dominated by stars or nebulae are rejected from the fit
+  for iteration in range(0, 3):
+    coefficients = numpy.linalg.lstsq(design[good], values[good], rcond=-1)[0]
+    residual = values - design.dot(coefficients)
+    sigma = 1.4826*numpy.median(numpy.fabs(residual[good] - numpy.median(residual[good])))
+    if sigma == 0:
+      break
+    good = numpy.fabs(residual) < 2.5*sigma
+  middle = numpy.zeros((order+1, order+1))
+  for k in range(0, len(terms)):
+    middle[terms[k]] = coefficients[k]
+  left = ((numpy.arange(rows)+0.5)/rows*2.0-1.0)[:,None]**numpy.arange(order+1)
+  right = ((numpy.arange(columns)+0.5)/columns*2.0-1.0)[:,None]**numpy.arange(order+1)
+  return left, middle, right
+
+def flat_mesh(mesh, covered_y, covered_x, rows, columns):
+  # Bicubic spline through the mesh, as separable factors: the interpolation matrices are
+  # the identity resized along one axis. The cells cover covered_y x covered_x pixels,
+  # the rest of the frame takes the values of the last row or column.
+  cells_y, cells_x = mesh.shape
+  filtered = scipy.ndimage.median_filter(mesh, size=3, mode='nearest')
+  residual = mesh - filtered
+  sigma = 1.4826*numpy.median(numpy.fabs(residual - numpy.median(residual)))
+  mesh = numpy.where(numpy.fabs(residual) > 2.5*sigma, filtered, mesh)
+  left = cv2.resize(numpy.eye(cells_y, dtype=numpy.float32), (cells_y, covered_y), interpolation=cv2.INTER_CUBIC)
+  right = cv2.resize(numpy.eye(cells_x, dtype=numpy.float32), (cells_x, covered_x), interpolation=cv2.INTER_CUBIC)
+  left = numpy.concatenate((left, numpy.repeat(left[-1:], rows-covered_y, axis=0)))
+  right = numpy.concatenate((right, numpy.repeat(right[-1:], columns-covered_x, axis=0)))
+  return left, mesh, right
+
+def histogram_peak(values, white):
+  # Mode of the values in [1, white], on 64 ADU bins and then to the unit inside the best bin
+  values = values[(values >= 1) & (values <= white)]
+  if values.size == 0:
+    return 0
+  coarse = numpy.bincount((values/64).astype(int))
+  best = coarse.argmax()*64
+  inside = values[(values >= best) & (values < best+64)]
+  return best + numpy.bincount((inside-best).astype(int), minlength=64).argmax()
+
+def star_blobs(rgb16, downsample=2, threshold=5.0, moments=False):
+  # Groups of 3 to 500 pixels above threshold times the noise on the luminance reduced downsample
+  # times, once the sky (medians of cells of 32 pixels) is removed. Returns the sky level, the noise
+  # and one row per group: flux, flux weighted centroid (row, column) and, with moments, the
+  # second moments (row row, column column, row column), in the reduced pixels.
+  rows = rgb16.shape[0]/downsample
+  columns = rgb16.shape[1]/downsample
+  luminance = cv2.resize(rgb16[0:rows*downsample, 0:columns*downsample], (columns, rows), interpolation=cv2.INTER_AREA).astype(numpy.float32).sum(axis=2)
+  cell = 32
+  cells_y = max(1, rows/cell)
+  cells_x = max(1, columns/cell)
+  cells = luminance[0:cells_y*cell, 0:cells_x*cell].reshape(cells_y, min(cell, rows), cells_x, min(cell, columns))
+  sky = numpy.median(cells.swapaxes(1, 2).reshape(cells_y, cells_x, -1), axis=2).astype(numpy.float32)
+  residual = luminance - cv2.resize(sky, (columns, rows), interpolation=cv2.INTER_LINEAR)
+  sample = residual[::2, ::2]
+  noise = 1.4826*numpy.median(numpy.abs(sample-numpy.median(sample)))
+  if noise <= 0:
+    noise = sample.std()
+  labels, count = scipy.ndimage.label(residual > threshold*noise)
+  labels = labels.ravel()
+  weights = numpy.maximum(residual, 0)
+  row = numpy.arange(0, rows, dtype=numpy.float32)[:,None]
+  column = numpy.arange(0, columns, dtype=numpy.float32)[None,:]
+  sizes = numpy.bincount(labels, minlength=count+1)[1:]
+  flux = numpy.bincount(labels, weights.ravel(), minlength=count+1)[1:]
+  found = (sizes >= 3) & (sizes <= 500) & (flux > 0)
+  flux = flux[found]
+  y = numpy.bincount(labels, (weights*row).ravel(), minlength=count+1)[1:][found]/flux
+  x = numpy.bincount(labels, (weights*column).ravel(), minlength=count+1)[1:][found]/flux
+  blobs = [flux, y, x]
+  if moments:
+    blobs.append(numpy.bincount(labels, (weights*row*row).ravel(), minlength=count+1)[1:][found]/flux - y*y)
+    blobs.append(numpy.bincount(labels, (weights*column*column).ravel(), minlength=count+1)[1:][found]/flux - x*x)
+    blobs.append(numpy.bincount(labels, (weights*row*column).ravel(), minlength=count+1)[1:][found]/flux - y*x)
+  return float(numpy.median(sky)), float(noise), numpy.column_stack(blobs)
+
+def find_stars(rgb16, number, downsample=2, threshold=5.0):
+  # Stars (row, column, flux) in the pixels of the frame, the brightest first, see star_blobs
+  sky, noise, blobs = star_blobs(rgb16, downsample, threshold)
+  stars = blobs[blobs[:,0].argsort()[::-1][0:number]][:,[1, 2, 0]]
+  stars[:,0:2] = (stars[:,0:2]+0.5)*downsample-0.5
+  return stars
+
+def frame_quality(rgb16, downsample=2, threshold=5.0):
+  # Number of stars, median FWHM (pixels of the frame) and eccentricity of their ellipses, sky
+  # level and noise (for one channel) of a frame, measured on the luminance reduced downsample times
+  sky, noise, blobs = star_blobs(rgb16, downsample, threshold, moments=True)
+  quality = {'stars': len(blobs), 'fwhm': None, 'eccentricity': None, 'background': sky/3.0, 'noise': noise/3.0}
+  if len(blobs) > 0:
+    # Axes of the ellipse of every star from the eigenvalues of its second moments
+    half = (blobs[:,3]+blobs[:,4])/2.0
+    root = numpy.sqrt(((blobs[:,3]-blobs[:,4])/2.0)**2 + blobs[:,5]**2)
+    major = numpy.maximum(half+root, 1e-6)
+    minor = numpy.clip(half-root, 1e-6, major)
+    quality['fwhm'] = float(numpy.median(2.3548*numpy.sqrt(numpy.sqrt(major*minor))))*downsample
+    quality['eccentricity'] = float(numpy.median(numpy.sqrt(1.0-minor/major)))
+  return quality
+
+quality_cache = os.path.join(cache_directory, 'quality')
+
+def quality_weight(quality):
+  # Stack weight of a frame, the signal to noise ratio of a star goes with 1/(fwhm*noise)
+  if quality is None or not quality.get('fwhm') or not quality.get('noise'):
+    return None
+  return 1.0/(quality['fwhm']*quality['noise'])**2
+
+class AstroQuality:
+  def __init__(self, min_stars=5, min_stars_ratio=0.5, max_fwhm_ratio=1.5, max_eccentricity=0.75, max_background_ratio=None):
+    # Policy that rejects a frame from its scores (see frame_quality): too few stars (absolute or
+    # as a fraction of the reference, clouds), stars too large (focus, seeing) or too elongated
+    # (wind, trailing) or a sky too bright (clouds, dawn) compared with the reference. None
+    # disables a limit.
+    self.min_stars = min_stars
+    self.min_stars_ratio = min_stars_ratio
+    self.max_fwhm_ratio = max_fwhm_ratio
+    self.max_eccentricity = max_eccentricity
+    self.max_background_ratio = max_background_ratio
+
+  def reject(self, quality, reference=None):
+    # The reason of the rejection or None for a good frame
+    if self.min_stars is not None and quality['stars'] < self.min_stars:
+      return 'Only '+str(quality['stars'])+' stars'
+    if quality['fwhm'] is None:
+      return 'No stars'
+    if self.max_eccentricity is not None and quality['eccentricity'] > self.max_eccentricity:
+      return 'Elongated stars, eccentricity %.2f' % quality['eccentricity']
+    if reference is not None and reference['fwhm'] is not None:
+      if self.min_stars_ratio is not None and quality['stars'] < self.min_stars_ratio*reference['stars']:
+        return str(quality['stars'])+' stars, '+str(reference['stars'])+' in the reference'
+      if self.max_fwhm_ratio is not None and quality['fwhm'] > self.max_fwhm_ratio*reference['fwhm']:
+        return 'FWHM %.1f, %.1f in the reference' % (quality['fwhm'], reference['fwhm'])
+      if self.max_background_ratio is not None and quality['background'] > self.max_background_ratio*reference['background']:
+        return 'Background %.0f, %.0f in the reference' % (quality['background'], reference['background'])
+    return None
+
+def display_lut(stretch, sample, white=65535):
+  # 16 to 8 bit lookup table, sample is a small picture used to place the black and white points.
+  # 'linear' maps 0..65535, 'auto' stretches between the sky and the brightest stars, 'asinh'
+  # starts from the sky and compresses the highlights.
+  values = numpy.arange(0, 65536, dtype=numpy.float32)
+  if stretch == 'linear':
+    return (values/256).astype(numpy.uint8)
+  black = numpy.percentile(sample, 0.5)
+  if stretch == 'auto':
+    top = max(numpy.percentile(sample, 99.95), black+1)
+    return (numpy.clip((values-black)/(top-black), 0, 1)*255).astype(numpy.uint8)
+  values = numpy.clip((values-black)/max(white-black, 1), 0, 1)
+  return (numpy.arcsinh(values*50)/numpy.arcsinh(50)*255).astype(numpy.uint8)
+
+def histogram_picture(histogram, width=384, height=254):
+  # RGB picture of the per channel histograms, every curve normalized on the highest bin of all
+  picture = numpy.ones((height, width, 3), dtype=numpy.uint8)*255
+  x = (numpy.arange(0, histogram.shape[1])+0.5)*width/histogram.shape[1]
+  top = max(histogram.max(), 1)
+  colors = ((255, 0, 0), (0, 160, 0), (0, 0, 255))
+  for i in range(0, histogram.shape[0]):
+    y = (height-1) - histogram[i]/top*(height-5)
+    curve = numpy.round(numpy.column_stack((x, y))).astype(numpy.int32)
+    cv2.polylines(picture, [curve], False, colors[i], 1, cv2.LINE_AA)
+  return picture
+
+warp_interpolations = {'nearest': cv2.INTER_NEAREST, 'linear': cv2.INTER_LINEAR, 'cubic': cv2.INTER_CUBIC, 'lanczos': cv2.INTER_LANCZOS4}
+
+artifacts_cache = os.path.join(cache_directory, 'artifacts')
+# The stages of a frame in the order they run, and if their artifact holds the pixels: the stars
+# are saved without them and restored above the flat frame
+artifact_stages = (('decode', True), ('flat', True), ('stars', False), ('align', True))
+file_digests = {}
+
+def file_digest(filename):
+  # SHA-1 of the content of a file, computed once per path, size and time in a process
+  stat = os.stat(filename)
+  key = (os.path.abspath(filename), stat.st_size, stat.st_mtime)
+  if key not in file_digests:
+    digest = hashlib.sha1()
+    file_digest_input = open(filename, 'rb')
+    for block in iter(lambda: file_digest_input.read(1024*1024), ''):
+      digest.update(block)
+    file_digest_input.close()
+    file_digests[key] = digest.hexdigest()
+  return file_digests[key]
+
+class AstroArtifacts:
+  def __init__(self, cache=artifacts_cache, limit=None, keep=('decode',)):
+    # Outcome of the stages of the frames, saved as dumps. An artifact is keyed by its stage, the
+    # parameters of the stage and the key of its input, the content of the file for the first stage,
+    # so a run finds the stages already done on the same frames with the same settings. Only the
+    # stages in keep are saved: the decoded frame is the one reused when the flat or the stars
+    # change, the dumps of the batch already hold the aligned frames for a new stack. The least
+    # recently used artifacts are removed beyond limit bytes, by default the size of the session.
+    self.cache = cache
+    self.limit = limit
+    self.keep = keep
+
+  def key(self, parent, stage, parameters):
+    return stage+'-'+hashlib.sha1(parent+' '+stage+' '+json.dumps(parameters, sort_keys=True)).hexdigest()
+
+  def path(self, key):
+    return os.path.join(self.cache, key+'.raw')
+
+  def stages(self, filename, settings):
+    # (stage, key, pixels) of the stages of a frame with the settings of a batch, the alignment
+    # only when the reference ('ref_id') is known
+    parameters = {}
+    parameters['decode'] = {'bad_pixels': None, 'calibration': None, 'precision': settings['precision'], 'pipeline': settings.get('pipeline', 'batch')}
+    if settings['bad_pixels'] is not None:
+      parameters['decode']['bad_pixels'] = settings['bad_pixels'].signature()
+    if settings['calibration'] is not None:
+      parameters['decode']['calibration'] = settings['calibration'].signature()
+    parameters['flat'] = {'order': settings['flat_order'], 'background': settings['flat_background']}
+    parameters['stars'] = {'stars': settings['stars'], 'number': settings['align_stars']}
+    if settings['stars'] == 'solve':
+      parameters['stars']['scale'] = settings['scale']
+      parameters['stars']['hint'] = settings['hint']
+    parameters['align'] = {'reference': settings.get('ref_id'), 'interpolation': settings['interpolation']}
+    stages = []
+    parent = file_digest(filename)
+    for stage, pixels in artifact_stages:
+      if stage == 'align' and settings.get('ref_id') is None:
+        break
+      parent = self.key(parent, stage, parameters[stage])
+      stages.append((stage, parent, pixels))
+    return stages
+
+  def load(self, key):
+    try:
+      header = dump_header(self.path(key))
+      content = read_dump(self.path(key), header)
+      # The time of the file is the last use, for the eviction
+      os.utime(self.path(key), None)
+      return content
+    except (IOError, OSError, ValueError, TypeError):
+      return None
+
+  def restore(self, image, stages):
+    # The outcome of the last stage with pixels in the cache goes in image, with the stages after
+    # it that only add to the pixels. Returns how many stages are done.
+    done = 0
+    for i in range(len(stages)-1, -1, -1):
+      if stages[i][2] and os.path.isfile(self.path(stages[i][1])):
+        content = self.load(stages[i][1])
+        if content is not None:
+          image.loadArtifact(content)
+          done = i+1
+          break
+    while done > 0 and done < len(stages) and not stages[done][2]:
+      content = self.load(stages[done][1])
+      if content is None:
+        break
+      image.loadArtifact(content)
+      done = done + 1
+    return done
+
+  def save(self, image, stage):
+    # stage is one of the tuples of stages, image has just done it. The dumps saved from now on come
+    # from this artifact, even when the stage is not kept.
+    stage, key, pixels = stage
+    if image.error:
+      return
+    image.artifact = key
+    image.artifact_stage = stage
+    if stage not in self.keep:
+      return
+    content = dict(image.__dict__)
+    if not pixels:
+      content.pop('rgb16', None)
+      content.pop('coverage', None)
+    content['artifact'] = key
+    content['artifact_stage'] = stage
+    try:
+      if not os.path.isdir(self.cache):
+        os.makedirs(self.cache)
+      write_dump(self.path(key), content)
+    except (IOError, OSError):
+      pass
+
+  def session_limit(self, frames, frame_bytes):
+    # The limit given, or the size of the stages kept of frames of frame_bytes (and 1 MB for the
+    # stars and the header of every artifact): the cache holds the last session
+    if self.limit is not None:
+      return self.limit
+    kept = [stage for stage, pixels in artifact_stages if stage in self.keep]
+    pixels = [stage for stage, pixels in artifact_stages if pixels and stage in self.keep]
+    return frames*(len(pixels)*frame_bytes + len(kept)*1024*1024)
+
+  def entries(self):
+    # Stage, key, size and last use of every artifact, the least recently used first
+    entries = []
+    if os.path.isdir(self.cache):
+      for name in os.listdir(self.cache):
+        if not name.endswith('.raw'):
+          continue
+        try:
+          stat = os.stat(os.path.join(self.cache, name))
+        except OSError:
+          continue
+        entries.append({'key': name[:-4], 'stage': name.split('-')[0], 'bytes': stat.st_size, 'used': stat.st_mtime})
+    entries.sort(key=lambda entry: entry['used'])
+    return entries
+
+  def prune(self, limit=None, stage=None, age=None):
+    # Removes the artifacts of a stage, the ones unused for age seconds and then the least recently
+    # used beyond limit bytes (the limit of the cache by default, none without one). Called once at
+    # the end of a batch. Returns the number removed.
+    if limit is None:
+      limit = self.limit
+    entries = self.entries()
+    total = sum([entry['bytes'] for entry in entries])
+    removed = 0
+    for entry in entries:
+      if (stage is not None and entry['stage'] == stage) or (age is not None and entry['used'] < time.time()-age) or (limit is not None and total > limit):
+        try:
+          os.remove(self.path(entry['key']))
+        except OSError:
+          continue
+        total = total - entry['bytes']
+        removed = removed + 1
+    return removed
+
+def to_uint16(array):
+  # 16 bit copy of a float32 working buffer for saving and display, 16 bit arrays are returned as they are
+  if array.dtype == numpy.uint16:
+    return array
+  return numpy.clip(numpy.rint(array), 0, 65535).astype(numpy.uint16)
+
 class AstroImage:
-  def __init__(self, filename):
+  def __init__(self, filename, precision='uint16'):
+    # precision is the one of the pixels while they are processed: 'uint16' rounds them after every
+    # step, 'float32' keeps them in float (twice the memory) until they are saved or displayed
     if os.path.isfile(filename):
       self.error = False
       self.filename = filename
@@ -45,215 +1443,1089 @@ class AstroImage:
       self.is_aligned = False
       self.is_flat = False
       self.is_solved = False
+      self.is_detected = False
+      # 'full' or 'preview' (see loadRaw), a preview is decoded again in full before processing
+      self.decode = 'full'
+      self.precision = precision
+      # Incremented every time the pixels change, the display cache follows it
+      self.revision = 0
     else:
       self.error = True
 
+  @profiled('loadDump')
   def loadDump(self):
     if not self.error:
+      # The precision is the one asked for this image, not the one of the dump
+      precision = self.precision
       try:
-        file_dump = open(self.filename, 'rb')
-        self.__dict__ = pickle.load(file_dump)
-        file_dump.close()
+        header = dump_header(self.filename)
+        if header is None:
+          # Migration path for the dumps saved before the versioned format
+          file_dump = open(self.filename, 'rb')
+          self.__dict__ = pickle.load(file_dump)
+          file_dump.close()
+        else:
+          self.__dict__ = read_dump(self.filename, header)
+        self.revision = self.__dict__.get('revision', 0) + 1
+        self.__dict__.setdefault('is_detected', False)
+        self.__dict__.setdefault('decode', 'full')
+        self.precision = precision
       except:
         self.error = True
 
-  def loadRaw(self):
+  def loadArtifact(self, content):
+    # The state of the image after a stage, see AstroArtifacts
+    precision = self.precision
+    revision = self.revision
+    self.__dict__.update(content)
+    self.precision = precision
+    self.revision = revision + 1
+
+  @profiled('loadRaw')
+  def loadRaw(self, bad_pixels=None, calibration=None, profile='full'):
+    # The 'preview' profile is for browsing: half size (one pixel per square of the Bayer matrix,
+    # no demosaicing), without calibration and bad pixel repair. width and height stay the ones of
+    # the full frame and the stars are given in its pixels.
     if not self.error:
       try:
-        bad_pixels = rawpy.enhance.find_bad_pixels([self.filename], find_hot=True, find_dead=True, confirm_ratio=0.9)
         raw = rawpy.imread(self.filename)
-        rawpy.enhance.repair_bad_pixels(raw, bad_pixels, method='median')
+        if profile == 'preview':
+          self.rgb16 = raw.postprocess(half_size=True, no_auto_bright=True, user_flip=False, output_bps=16)
+          self.width = raw.sizes.height
+          self.height = raw.sizes.width
+          self.decoder = (bad_pixels, calibration)
+          self.decode = 'preview'
+          self.is_loaded = True
+          self.revision = self.revision + 1
+          return
+        if calibration is not None:
+          with profiler.stage('calibrate', self.filename):
+            calibration.apply(raw)
+        if bad_pixels is None:
+          # Without a camera map the frame is scanned by itself
+          pixels = rawpy.enhance.find_bad_pixels([self.filename], find_hot=True, find_dead=True, confirm_ratio=0.9)
+          rawpy.enhance.repair_bad_pixels(raw, pixels, method='median')
+        else:
+          bad_pixels.repair(raw)
         self.rgb16 = raw.postprocess(no_auto_bright=True, user_flip=False, output_bps=16)
         self.width = self.rgb16.shape[0]
         self.height = self.rgb16.shape[1]
+        self.decode = 'full'
         self.is_loaded = True
+        self.revision = self.revision + 1
       except:
         self.error = True
 
-  def openFile(self):
+  def loadFull(self):
+    # Called by the processing steps, a preview is decoded again in full as it was asked
+    # (bad pixels and calibration) and its stars are found again on the full frame
+    if not self.error and self.decode == 'preview':
+      bad_pixels, calibration = self.decoder
+      del self.decoder
+      self.loadRaw(bad_pixels, calibration)
+      if self.is_detected:
+        self.detect()
+
+  def working(self):
+    # The pixels in the working precision, called before they are processed
+    if self.precision == 'float32' and self.rgb16.dtype != numpy.float32:
+      self.rgb16 = self.rgb16.astype(numpy.float32)
+
+  def frame_shape(self):
+    # Rows and columns of the full frame, a preview is smaller
+    if self.decode == 'preview':
+      return self.width, self.height
+    return self.rgb16.shape[0:2]
+
+  def openFile(self, bad_pixels=None, calibration=None, profile='full'):
     if not self.error:
       name, extension = os.path.splitext(self.filename)
       if extension == '.raw':
         self.loadDump()
       else:
-        self.loadRaw()
+        self.loadRaw(bad_pixels, calibration, profile)
 
+  @profiled('saveDump')
   def saveDump(self):
+    self.loadFull()
     if not self.error:
       try:
         name, extension = os.path.splitext(self.filename)
-        file_dump = open(name+'.raw', 'wb')
-        pickle.dump(self.__dict__, file_dump, pickle.HIGHEST_PROTOCOL)
-        file_dump.close()
+        write_dump(name+'.raw', self.__dict__)
       except:
         self.error = True
 
+  @profiled('saveTiff')
   def saveTiff(self):
+    self.loadFull()
     if not self.error and self.is_loaded:
       try:
         name, extension = os.path.splitext(self.filename)
-        imageio.imsave(name+'.tiff', self.rgb16)
+        imageio.imsave(name+'.tiff', to_uint16(self.rgb16))
       except:
         self.error = True
 
   def savePpm(self):
+    self.loadFull()
     if not self.error and self.is_loaded:
       try:
         name, extension = os.path.splitext(self.filename)
-        imageio.imsave(name+'.ppm', self.rgb16)
+        imageio.imsave(name+'.ppm', to_uint16(self.rgb16))
       except:
         self.error = True
 
-  def flat(self):
+  @profiled('flat')
+  def flat(self, order=2, background='polynomial'):
+    # background is a 'polynomial' of the given order or a spline 'mesh'
+    self.loadFull()
     if not self.error and not self.is_flat:
-      steps = 200
-      y = numpy.arange(10, self.width-10, steps)
-      x = numpy.arange(10, self.height-10, steps)
-      x, y = numpy.meshgrid(x,y)
-      r = self.rgb16[10:self.width-10:steps,10:self.height-10:steps,0]
-      g = self.rgb16[10:self.width-10:steps,10:self.height-10:steps,1]
-      b = self.rgb16[10:self.width-10:steps,10:self.height-10:steps,2]
-      poly_init = astropy.modeling.models.Polynomial2D(degree=2)
-      fit_poly = astropy.modeling.fitting.LevMarLSQFitter()
-      poly_r = fit_poly(poly_init, x, y, r)
-      poly_g = fit_poly(poly_init, x, y, g)
-      poly_b = fit_poly(poly_init, x, y, b)
-      y = numpy.arange(0, self.width)
-      x = numpy.arange(0, self.height)
-      x, y = numpy.meshgrid(x,y)
-      r = poly_r(x,y)
-      g = poly_g(x,y)
-      b = poly_b(x,y)
-
-      # Align approximatively the maximum of the histogram with self.white/10
-      r = (self.rgb16[:,:,0] - r)+self.white/10.0
-      g = (self.rgb16[:,:,1] - g)+self.white/10.0
-      b = (self.rgb16[:,:,2] - b)+self.white/10.0
-
-      r = r.clip(0,self.white)
-      g = g.clip(0,self.white)
-      b = b.clip(0,self.white)
-      r = r.astype(numpy.uint16)
-      g = g.astype(numpy.uint16)
-      b = b.astype(numpy.uint16)
-
-      # Fine alignment of the histogram
-      hist_r = cv2.calcHist([r],[0],None,[self.white],[0,self.white])[1:]
-      hist_g = cv2.calcHist([g],[0],None,[self.white],[0,self.white])[1:]
-      hist_b = cv2.calcHist([b],[0],None,[self.white],[0,self.white])[1:]
-      r = r + (self.white/10.0 - hist_r[:,0].argsort()[::-1][0])
-      g = g + (self.white/10.0 - hist_g[:,0].argsort()[::-1][0])
-      b = b + (self.white/10.0 - hist_b[:,0].argsort()[::-1][0])
-
-      r = r.clip(0,self.white)
-      g = g.clip(0,self.white)
-      b = b.clip(0,self.white)
-      r = r.astype(numpy.uint16)
-      g = g.astype(numpy.uint16)
-      b = b.astype(numpy.uint16)
-
-      self.rgb16[:,:,0] = r
-      self.rgb16[:,:,1] = g
-      self.rgb16[:,:,2] = b
+      self.working()
+      rows = self.rgb16.shape[0]
+      columns = self.rgb16.shape[1]
+      # Background samples: medians of cells of 64x64 pixels taken on a 4x subsample
+      step = 4
+      cell = 16
+      sample = self.rgb16[::step, ::step]
+      cells_y = max(1, sample.shape[0]/cell)
+      cells_x = max(1, sample.shape[1]/cell)
+      cells = sample[0:cells_y*cell, 0:cells_x*cell].reshape(cells_y, min(cell, sample.shape[0]), cells_x, min(cell, sample.shape[1]), 3)
+      mesh = numpy.median(cells.transpose(0, 2, 4, 1, 3).reshape(cells_y, cells_x, 3, -1), axis=3)
+      centre_y = (numpy.arange(cells_y)*cell + (cells.shape[1]-1)/2.0)*step
+      centre_x = (numpy.arange(cells_x)*cell + (cells.shape[3]-1)/2.0)*step
+      covered_y = min(rows, cells_y*cells.shape[1]*step)
+      covered_x = min(columns, cells_x*cells.shape[3]*step)
+
+      shift = self.white/10.0
+      for channel in range(0, 3):
+        if background == 'mesh':
+          left, middle, right = flat_mesh(mesh[:,:,channel], covered_y, covered_x, rows, columns)
+        else:
+          left, middle, right = flat_polynomial(mesh[:,:,channel], centre_y, centre_x, rows, columns, order)
+        left = left.astype(numpy.float32)
+        right = middle.dot(right.T).astype(numpy.float32)
+
+        # Align the maximum of the histogram with self.white/10, estimated on the subsample
+        flat_sample = sample[:,:,channel] - left[::step].dot(right[:,::step]) + shift
+        offset = 2*shift - histogram_peak(flat_sample, self.white)
+
+        # The background is evaluated and removed in place, a band of rows at a time
+        for start in range(0, rows, 256):
+          stop = min(rows, start+256)
+          band = self.rgb16[start:stop,:,channel]
+          if band.dtype != numpy.float32:
+            band = band.astype(numpy.float32)
+          band -= left[start:stop].dot(right)
+          band += offset
+          numpy.clip(band, 0, self.white, out=band)
+          if self.rgb16.dtype != numpy.float32:
+            self.rgb16[start:stop,:,channel] = band
 
       self.is_flat = True
+      self.revision = self.revision + 1
 
-  def solve(self, scale):
+  @profiled('solve')
+  def solve(self, scale, solver=None, hint=None, number=20):
+    # With the hint of a solved frame of the same field solve-field gets only the brightest stars,
+    # without it (blind solve) the reduced frame. The brightest number stars matched are kept.
+    self.loadFull()
     if not self.error and not self.is_solved:
-      name, extension = os.path.splitext(self.filename)
-      self.savePpm()
-      scale_low = str(scale*80.0/100.0)
-      scale_high = str(scale*120.0/100.0)
-      subprocess.call(["/usr/local/astrometry/bin/solve-field", "--downsample", "2", "--tweak-order", "2", "--scale-units", "arcsecperpix", "--scale-low", scale_low, "--scale-high", scale_high, "--no-plots", "--overwrite", name+".ppm"])
-      if os.path.isfile(name+'.solved'):
-        correlation = astropy.io.fits.open(name+'.corr')
-        self.correlation = correlation[1].data
-        wcs = astropy.wcs.WCS(astropy.io.fits.open(name+'.new')[0].header)
+      if solver is None:
+        solver = default_solver()
+      solution = None
+      if hint is not None:
+        solution = solver.solve(self.rgb16, scale, self.filename, hint, find_stars(self.rgb16, max(100, number)))
+      if solution is None:
+        # Without a hint, or once blind when the field is not the one of the hint (recentered,
+        # another target)
+        solution = solver.solve(self.rgb16, scale, self.filename)
+      if solution is not None:
+        self.correlation = solution['correlation']
+        self.wcs_header = solution['wcs_header']
+        wcs = astropy.wcs.WCS(astropy.io.fits.Header.fromstring(self.wcs_header))
         # Search for deep sky objects
-        galaxy = astropy.io.fits.open('/usr/local/astrometry/extra/ngc2000.fits')
-        self.galaxy = numpy.empty((1000, 4), dtype=numpy.int)
-        galaxy_num = 0
-        galaxy_scale = astropy.wcs.utils.proj_plane_pixel_scales(wcs).mean()
-        for i in galaxy[1].data:
-          galaxy_pix = wcs.wcs_world2pix(numpy.array([[i[1], i[2]]]),1)
-          if galaxy_pix[0][0] > 0 and galaxy_pix[0][0] < self.rgb16.shape[0] and galaxy_pix[0][1] > 0 and galaxy_pix[0][1] < self.rgb16.shape[1]:
-            self.galaxy[galaxy_num, 0] = i[0]
-            self.galaxy[galaxy_num, 1] = galaxy_pix[0][0]
-            self.galaxy[galaxy_num, 2] = galaxy_pix[0][1]
-            self.galaxy[galaxy_num, 3] = i[3]/galaxy_scale
-            galaxy_num = galaxy_num + 1
-        self.galaxy = self.galaxy[0:galaxy_num]
-
-        self.stars = numpy.empty((len(correlation[1].data),3))
-        for i in range(0,len(correlation[1].data)):
-            star_x = correlation[1].data[i][5]
-            star_y = correlation[1].data[i][4]
+        try:
+          self.galaxy = catalog().field(wcs, self.rgb16.shape)
+        except IOError:
+          self.galaxy = numpy.empty((0, 4), dtype=numpy.int)
+
+        self.stars = numpy.empty((len(self.correlation),3))
+        for i in range(0,len(self.correlation)):
+            star_x = self.correlation[i][5]
+            star_y = self.correlation[i][4]
             self.stars[i][0] = star_x
             self.stars[i][1] = star_y
-            self.stars[i][2] = correlation[1].data[i][11]
+            self.stars[i][2] = self.correlation[i][11]
 
         self.stars = self.stars[self.stars[:,2].argsort()[::-1]]
-        if self.stars.shape[0] > 20:
-          self.stars = self.stars[0:20]
+        if self.stars.shape[0] > number:
+          self.stars = self.stars[0:number]
 
         self.is_solved = True
+        self.is_detected = False
+
+  def solve_hint(self):
+    # Centre, radius (half diagonal, degrees) and parity of the solution, the other frames of the
+    # session are searched only there
+    if not self.is_solved:
+      return None
+    wcs = astropy.wcs.WCS(astropy.io.fits.Header.fromstring(self.wcs_header))
+    rows, columns = self.rgb16.shape[0:2]
+    sky = wcs.all_pix2world([[(columns-1)/2.0, (rows-1)/2.0], [0, 0], [columns-1, rows-1]], 0)
+    ra = numpy.radians(sky[:,0])
+    dec = numpy.radians(sky[:,1])
+    vectors = numpy.column_stack((numpy.cos(dec)*numpy.cos(ra), numpy.cos(dec)*numpy.sin(ra), numpy.sin(dec)))
+    radius = numpy.degrees(numpy.arccos(numpy.clip(vectors[1:].dot(vectors[0]), -1.0, 1.0))).max()
+    # solve-field calls 'pos' the parity of a sky seen from the Earth, a negative determinant
+    if numpy.linalg.det(wcs.pixel_scale_matrix) < 0:
+      parity = 'pos'
+    else:
+      parity = 'neg'
+    return {'ra': float(sky[0,0]), 'dec': float(sky[0,1]), 'radius': float(radius), 'parity': parity}
 
+  @profiled('detect')
+  def detect(self, number=20, downsample=2, threshold=5.0):
+    # Stars found without solve-field, the brightest number replace self.stars. A preview is
+    # already reduced 2 times, its stars are moved to the pixels of the full frame.
+    if not self.error:
+      if self.decode == 'preview':
+        stars = find_stars(self.rgb16, number, max(1, downsample/2), threshold)
+        stars[:,0:2] = (stars[:,0:2]+0.5)*2-0.5
+      else:
+        stars = find_stars(self.rgb16, number, downsample, threshold)
+      if stars.shape[0] >= 5:
+        self.stars = stars
+        self.is_detected = True
+
+  @profiled('quality')
+  def score(self, cache=quality_cache):
+    # Scores of the frame as decoded (see frame_quality) in self.quality, measured once per file:
+    # they are kept in the dumps and in the cache by path, size and time of the file
+    if self.error or hasattr(self, 'quality'):
+      return
+    filename = None
+    if cache is not None and os.path.isfile(self.filename):
+      stat = os.stat(self.filename)
+      key = hashlib.sha1(os.path.abspath(self.filename)+' '+str(stat.st_size)+' '+repr(stat.st_mtime)).hexdigest()
+      filename = os.path.join(cache, key+'.json')
+      if os.path.isfile(filename):
+        try:
+          file_quality = open(filename)
+          self.quality = json.load(file_quality)
+          file_quality.close()
+          return
+        except (IOError, ValueError):
+          pass
+    if self.decode == 'preview':
+      self.quality = frame_quality(self.rgb16, 1)
+      if self.quality['fwhm'] is not None:
+        self.quality['fwhm'] = self.quality['fwhm']*2
+    else:
+      self.quality = frame_quality(self.rgb16)
+    if filename is not None:
       try:
-        os.remove(name+'-indx.xyls')
-        os.remove(name+'.axy')
-        os.remove(name+'.corr')
-        os.remove(name+'.match')
-        os.remove(name+'.new')
-        os.remove(name+'.ppm')
-        os.remove(name+'.rdls')
-        os.remove(name+'.solved')
-        os.remove(name+'.wcs')
+        if not os.path.isdir(cache):
+          os.makedirs(cache)
+        file_quality = open(filename+'.tmp', 'w')
+        json.dump(self.quality, file_quality)
+        file_quality.close()
+        os.rename(filename+'.tmp', filename)
+      except (IOError, OSError):
+        pass
+
+  @profiled('stars_hash')
+  def stars_hash(self, kind=None):
+    # The hash is kept with the stars it was built from, so a dump reopened later does not rebuild it.
+    # kind is 'quintuple' or 'triangle', by default the one for the number of stars (see star_index).
+    if kind is None:
+      kind = star_index(self.stars.shape[0])
+    if hasattr(self, 'starsHashStars') and numpy.array_equal(self.starsHashStars, self.stars[:,0:2]) and getattr(self, 'starsKind', 'quintuple') == kind:
+      return
+    self.starsKind = kind
+    if kind == 'triangle':
+      self.starsHash, self.starsSequence = triangle_hash(self.stars)
+      self.starsHashStars = numpy.copy(self.stars[:,0:2])
+      return
+    sequence = quintuples(self.stars.shape[0])
+    first, second = quintuple_pairs
+    x = self.stars[:,0]
+    y = self.stars[:,1]
+    # numpy.power squares with pow() like the scalars of the first loop version, the ** of arrays
+    # multiplies and may differ by one bit
+    distance = numpy.power(x[:,None]-x[None,:], 2)+numpy.power(y[:,None]-y[None,:], 2)
+    distance = distance[sequence[:,first], sequence[:,second]]
+    ratios = distance/distance.max(axis=1)[:,None]
+    ratios.sort(axis=1)
+    self.starsHash = ratios
+    self.starsSequence = sequence
+    self.starsHashStars = numpy.copy(self.stars[:,0:2])
+
+  @profiled('align')
+  def align(self, matcher, interpolation='linear', index=None):
+    # matcher is the AstroMatcher of the reference. With the index of the frame in the sequence the
+    # transform predicted from the frames aligned before is checked on a few stars, the hashes of
+    # the stars are only built and matched when the prediction fails.
+    self.loadFull()
+    if not self.error and not self.is_aligned:
+      matrix = None
+      if index is not None:
+        matrix, pairs = matcher.verify(self.stars, matcher.predict(index))
+        self.alignment = 'drift'
+      if matrix is None:
+        self.stars_hash(matcher.kind)
+        matrix, pairs = matcher.match(self.stars, self.starsHash, self.starsSequence)
+        self.alignment = 'hash'
+      if matrix is None:
+        return
+      if index is not None:
+        matcher.track(index, matrix)
+      self.transform = matrix
+      self.working()
+      self.warp(matrix, interpolation)
+
+      # Re-match stars after alignment
+      self.stars = numpy.copy(matcher.stars)
+      for i in self.stars:
+        i[2] = self.rgb16[int(i[0])-30:int(i[0])+30, int(i[1])-30:int(i[1])+30, :].sum()
+
+      self.is_aligned = True
+      self.is_solved = False
+
+  @profiled('warp')
+  def warp(self, matrix, interpolation='linear'):
+    # One affine resampling into the frame size, matrix maps (x, y) of this frame on the reference.
+    # coverage marks the pixels that received data, without the ones blended with the border.
+    rows = self.rgb16.shape[0]
+    columns = self.rgb16.shape[1]
+    self.rgb16 = cv2.warpAffine(self.rgb16, matrix, (columns, rows), flags=warp_interpolations[interpolation], borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    self.coverage = cv2.warpAffine(numpy.ones((rows, columns), dtype=numpy.uint8), matrix, (columns, rows), flags=cv2.INTER_NEAREST, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    self.coverage = cv2.erode(self.coverage, numpy.ones((3, 3), dtype=numpy.uint8))
+    self.revision = self.revision + 1
+
+  def pyramid(self, width=768, height=512):
+    # Halved copies of the frame down to the display size, built once per revision of the pixels.
+    # The display cache keeps them with the previews and the histogram, it is not written in the dumps.
+    if not hasattr(self, 'display') or self.display['revision'] != self.revision:
+      pyramid = [self.rgb16]
+      while pyramid[-1].shape[0] >= 2*height and pyramid[-1].shape[1] >= 2*width:
+        pyramid.append(cv2.pyrDown(pyramid[-1]))
+      self.display = {'revision': self.revision, 'pyramid': pyramid[1:], 'previews': {}}
+    return self.display['pyramid']
+
+  def preview(self, width=768, height=512, stretch='linear'):
+    # 8 bit picture of width x height taken from the smallest level of the pyramid
+    self.pyramid(width, height)
+    key = (width, height, stretch)
+    if key not in self.display['previews']:
+      level = ([self.rgb16] + self.display['pyramid'])[-1]
+      small = to_uint16(cv2.resize(level, (width, height), interpolation=cv2.INTER_AREA))
+      self.display['previews'][key] = display_lut(stretch, small, self.white)[small]
+    return self.display['previews'][key]
+
+  def histogram(self, bins=256):
+    # Counts of bins equal intervals of 0..white per channel, from the first level of the pyramid
+    # (a quarter of the pixels) or one pixel every two rows and columns of a small frame
+    pyramid = self.pyramid()
+    if 'histogram' not in self.display or self.display['histogram'].shape[1] != bins:
+      if len(pyramid) > 0:
+        sample = pyramid[0]
+      else:
+        sample = numpy.ascontiguousarray(self.rgb16[::2, ::2])
+      self.display['histogram'] = numpy.array([cv2.calcHist([sample], [i], None, [bins], [0, self.white+1]).ravel() for i in range(0, 3)])
+    return self.display['histogram']
+
+# Band reduction shared by the stack process pool, set once per worker by stack_worker_init
+stack_worker_state = {}
+
+def stack_band(frames, coverage, mode, tolerance, weights=None):
+  # frames has shape (frames, rows, columns, channels), the result is the stacked band.
+  # coverage, when not None, has shape (frames, rows, columns) and marks the pixels with data.
+  # weights, when not None, weight the frames in the means, the median ignores them.
+  # float32 frames are accumulated in float32 and the result stays float32, 16 bit frames are
+  # accumulated in float64 and the result is 16 bit.
+  dtype = frames.dtype
+  if dtype == numpy.float32:
+    work = numpy.float32
+  else:
+    work = numpy.float64
+  if mode == 'median':
+    if coverage is None:
+      return numpy.median(frames, axis=0).astype(dtype)
+    frames = numpy.where(coverage[:,:,:,None], frames, work(numpy.nan))
+    return numpy.nan_to_num(numpy.nanmedian(frames, axis=0)).astype(dtype)
+
+  average = numpy.zeros(frames.shape[1:], dtype=work)
+  stdev = numpy.zeros(frames.shape[1:], dtype=work)
+  frame_number = 1.0
+  for i in range(0, frames.shape[0]):
+    frame = frames[i].astype(work)
+    delta = frame - average
+    if coverage is None:
+      average += delta/frame_number
+      frame -= average
+      delta *= frame
+      stdev += delta
+      frame_number = frame_number + 1.0
+    else:
+      covered = coverage[i][:,:,None]
+      average += numpy.where(covered, delta/frame_number, work(0))
+      stdev += numpy.where(covered, delta*(frame - average), work(0))
+      frame_number = frame_number + covered.astype(work)
+  stdev /= frame_number
+  numpy.sqrt(stdev, out=stdev)
+
+  if weights is None:
+    weights = numpy.ones(frames.shape[0])
+  stack = numpy.zeros(frames.shape[1:], dtype=work)
+  if mode == 'winsorized':
+    low = average - tolerance * stdev
+    high = average + tolerance * stdev
+    total = 0.0
+    for i in range(0, frames.shape[0]):
+      if coverage is None:
+        stack += numpy.clip(frames[i], low, high)*work(weights[i])
+        total = total + weights[i]
+      else:
+        stack += numpy.where(coverage[i][:,:,None], numpy.clip(frames[i], low, high)*work(weights[i]), work(0))
+        total = total + coverage[i][:,:,None]*work(weights[i])
+    stack /= numpy.maximum(total, 1e-6)
+  else:
+    count = numpy.zeros(frames.shape[1:], dtype=work)
+    for i in range(0, frames.shape[0]):
+      mask = numpy.fabs(frames[i] - average) <= tolerance * stdev
+      if coverage is not None:
+        mask = mask & coverage[i][:,:,None]
+      stack += numpy.where(mask, frames[i]*work(weights[i]), work(0))
+      count += mask*work(weights[i])
+    # The kept values are divided by their weights, which may add up to less than 1. The mean is
+    # kept where every frame is rejected
+    stack = numpy.where(count > 0, stack / numpy.where(count > 0, count, work(1)), average)
+  return stack.astype(dtype)
+
+def stack_rows(memory, frames, columns, channels, mode, workers=1, itemsize=2):
+  # Rows of a band that fit in memory bytes per worker: the band of every frame (itemsize bytes per
+  # value) plus the accumulators, float32 for float32 frames and float64 for the others
+  if itemsize == 4:
+    work = 4
+  else:
+    work = 8
+  if mode == 'median':
+    pixel_bytes = frames*(itemsize+1+work*2) + work
+  else:
+    pixel_bytes = frames*(itemsize+1) + work*8
+  return max(1, memory / workers / (columns*channels*pixel_bytes))
+
+def stack_worker_init(frames, output, shape, mode, tolerance, dtype=numpy.uint16, weights=None):
+  # frames are (filename, dtype, offset, coverage offset) of the pixel payloads, all mapped read only.
+  # The coverage offset is None for frames covered everywhere.
+  # The names of the frames are not the ones of the arguments: the list comprehension leaks them
+  stack_worker_state['frames'] = [numpy.memmap(frame_file, dtype=frame_dtype, mode='r', offset=frame_offset, shape=shape) for frame_file, frame_dtype, frame_offset, frame_coverage in frames]
+  stack_worker_state['coverage'] = []
+  for frame_file, frame_dtype, frame_offset, frame_coverage in frames:
+    if frame_coverage is None:
+      stack_worker_state['coverage'].append(None)
+    else:
+      stack_worker_state['coverage'].append(numpy.memmap(frame_file, dtype=numpy.uint8, mode='r', offset=frame_coverage, shape=shape[0:2]))
+  stack_worker_state['output'] = numpy.memmap(output, dtype=dtype, mode='r+', shape=shape)
+  stack_worker_state['mode'] = mode
+  stack_worker_state['tolerance'] = tolerance
+  stack_worker_state['weights'] = weights
+
+def stack_worker(band):
+  start, stop = band
+  frames = numpy.array([frame[start:stop] for frame in stack_worker_state['frames']])
+  coverage = None
+  if any(mask is not None for mask in stack_worker_state['coverage']):
+    coverage = numpy.ones(frames.shape[0:3], dtype=bool)
+    for i in range(0, len(stack_worker_state['coverage'])):
+      if stack_worker_state['coverage'][i] is not None:
+        coverage[i] = stack_worker_state['coverage'][i][start:stop] > 0
+  stack_worker_state['output'][start:stop] = stack_band(frames, coverage, stack_worker_state['mode'], stack_worker_state['tolerance'], stack_worker_state['weights'])
+  return band
+
+class AstroStack:
+  def __init__(self, filenames, mode='sigma', tolerance=1.5, memory=512*1024*1024, workers=None, weighted=False):
+    # mode is 'sigma' (mean with tolerance*sigma rejection), 'winsorized' or 'median'
+    # memory is the budget in bytes shared by all the workers
+    # weighted weights the frames by their quality (see quality_weight) when all the dumps have it
+    self.filenames = filenames
+    self.weighted = weighted
+    self.mode = mode
+    self.tolerance = tolerance
+    self.memory = memory
+    if workers is None:
+      workers = multiprocessing.cpu_count()
+    self.workers = max(1, workers)
+    self.error = False
+
+  def spool(self):
+    # The pixels of the versioned dumps are read in place by the workers. Legacy pickle dumps
+    # are opened once and their pixels copied in the work directory, one frame at a time.
+    self.frames = []
+    self.qualities = []
+    self.shape = None
+    for i in range(0, len(self.filenames)):
+      header = dump_header(self.filenames[i])
+      if header is not None and 'rgb16' in header['arrays']:
+        self.qualities.append(header['attributes'].get('quality'))
+        description = header['arrays']['rgb16']
+        coverage = None
+        if 'coverage' in header['arrays']:
+          coverage = header['arrays']['coverage']['offset']
+        frame = (self.filenames[i], str(dump_dtype(description['dtype']).str), description['offset'], coverage)
+        shape = tuple(description['shape'])
+      else:
+        print 'Loading '+self.filenames[i]+' for stack'
+        image = AstroImage(self.filenames[i])
+        image.openFile()
+        if image.error:
+          self.error = True
+          return
+        self.qualities.append(getattr(image, 'quality', None))
+        frame = (os.path.join(self.directory, 'frame'+str(i)), image.rgb16.dtype.str, 0, None)
+        shape = image.rgb16.shape
+        image.rgb16.tofile(frame[0])
+        del image
+      if self.shape is None:
+        self.shape = shape
+      if shape != self.shape:
+        self.error = True
+        return
+      self.frames.append(frame)
+
+  def bands(self):
+    rows, columns, channels = self.shape
+    band_rows = min(rows, stack_rows(self.memory, len(self.frames), columns, channels, self.mode, self.workers, numpy.dtype(self.dtype).itemsize))
+    return [(start, min(rows, start+band_rows)) for start in range(0, rows, band_rows)]
+
+  @profiled('stack')
+  def stack(self):
+    if len(self.filenames) == 0:
+      self.error = True
+      return
+    self.directory = tempfile.mkdtemp(prefix='astrostack')
+    try:
+      self.spool()
+      if self.error:
+        return
+      output = os.path.join(self.directory, 'output')
+      # float32 frames give a float32 stack, it becomes 16 bit when saved
+      self.dtype = numpy.uint16
+      if any(numpy.dtype(frame[1]) == numpy.float32 for frame in self.frames):
+        self.dtype = numpy.float32
+      numpy.memmap(output, dtype=self.dtype, mode='w+', shape=self.shape).flush()
+      bands = self.bands()
+      print 'Stacking '+str(len(self.frames))+' frames in '+str(len(bands))+' bands'
+      self.weights = None
+      if self.weighted:
+        weights = [quality_weight(quality) for quality in self.qualities]
+        if None not in weights:
+          self.weights = numpy.array(weights)/numpy.mean(weights)
+      init_args = (self.frames, output, self.shape, self.mode, self.tolerance, self.dtype, self.weights)
+      if self.workers == 1 or len(bands) == 1:
+        stack_worker_init(*init_args)
+        for band in bands:
+          stack_worker(band)
+      else:
+        pool = multiprocessing.Pool(min(self.workers, len(bands)), stack_worker_init, init_args)
+        try:
+          for band in pool.imap_unordered(stack_worker, bands):
+            pass
+        finally:
+          pool.terminate()
+      self.rgb16 = numpy.array(numpy.memmap(output, dtype=self.dtype, mode='r', shape=self.shape))
+    except:
+      self.error = True
+    finally:
+      stack_worker_state.clear()
+      shutil.rmtree(self.directory, ignore_errors=True)
+
+class AstroLiveStack:
+  def __init__(self, filename=None, tolerance=4.0, warmup=5, rows=256):
+    # Running mean and variance per pixel (Welford), updated by every aligned frame in bands of
+    # rows. After warmup frames a pixel further than tolerance sigma from the running mean is
+    # rejected. It is compared with statistics built from few frames and that the rejected values
+    # do not enter, so the tolerance is wider than the one of AstroStack: a narrow one keeps
+    # rejecting good values and the estimated sigma shrinks. The state is saved in filename after
+    # every frame and read back from it, frames already stacked are skipped.
+    self.filename = filename
+    self.tolerance = tolerance
+    self.warmup = warmup
+    self.rows = rows
+    self.frames = []
+    self.shape = None
+    self.error = False
+    if filename is not None and os.path.isfile(filename):
+      try:
+        state = read_dump(filename, dump_header(filename))
+        self.frames = [str(i) for i in state['frames']]
+        self.tolerance = state['tolerance']
+        self.warmup = state['warmup']
+        self.mean = numpy.array(state['mean'])
+        self.m2 = numpy.array(state['m2'])
+        self.count = numpy.array(state['count'])
+        self.rejected = numpy.array(state['rejected'])
+        self.shape = self.mean.shape
+      except:
+        self.error = True
+
+  @profiled('live')
+  def add(self, image):
+    # image is an aligned AstroImage, its coverage is used when present
+    if self.error or image.error or image.filename in self.frames:
+      return
+    if self.shape is None:
+      self.shape = image.rgb16.shape
+      self.mean = numpy.zeros(self.shape, dtype=numpy.float32)
+      self.m2 = numpy.zeros(self.shape, dtype=numpy.float32)
+      self.count = numpy.zeros(self.shape, dtype=numpy.uint16)
+      self.rejected = numpy.zeros(self.shape, dtype=numpy.uint16)
+    if image.rgb16.shape != self.shape:
+      self.error = True
+      return
+    coverage = getattr(image, 'coverage', None)
+    for start in range(0, self.shape[0], self.rows):
+      band = slice(start, min(start+self.rows, self.shape[0]))
+      frame = image.rgb16[band].astype(numpy.float32)
+      mean = self.mean[band]
+      m2 = self.m2[band]
+      count = self.count[band].astype(numpy.float32)
+      accepted = numpy.ones(frame.shape, dtype=bool)
+      if coverage is not None:
+        accepted = accepted & (coverage[band,:,None] > 0)
+      known = count >= self.warmup
+      sigma = numpy.sqrt(m2/numpy.maximum(count-1, 1))
+      outliers = known & (numpy.abs(frame-mean) > self.tolerance*sigma)
+      self.rejected[band] += accepted & outliers
+      accepted = accepted & ~outliers
+      count = count + accepted
+      delta = numpy.where(accepted, frame-mean, 0)
+      mean += delta/numpy.maximum(count, 1)
+      m2 += delta*(frame-mean)
+      self.count[band] = count
+    self.frames.append(image.filename)
+    if self.filename is not None:
+      self.save()
+
+  def save(self):
+    try:
+      write_dump(self.filename, {'frames': self.frames, 'tolerance': self.tolerance, 'warmup': self.warmup, 'mean': self.mean, 'm2': self.m2, 'count': self.count, 'rejected': self.rejected})
+    except:
+      self.error = True
+
+  def rgb16(self):
+    # The stack as it is now, pixels never covered are black
+    return numpy.clip(numpy.round(self.mean), 0, 65535).astype(numpy.uint16)
+
+# Scale, matcher of the reference and bad pixel map of a batch, set once per worker by batch_worker_init
+batch_worker_state = {}
+
+def batch_worker_init(settings):
+  batch_worker_state.update(settings)
+  if multiprocessing.current_process().name != 'MainProcess':
+    # A forked worker starts with the events of the batch, it only sends back its own
+    profiler.enabled = settings['profile']
+    profiler.events = []
+    profiler.open = []
+
+def batch_reject(outcome, quality):
+  # Applies the quality policy of the batch, True when the frame is rejected
+  if batch_worker_state['quality'] is None:
+    return False
+  reason = batch_worker_state['quality'].reject(quality, batch_worker_state['ref_quality'])
+  if reason is not None:
+    outcome['status'] = 'rejected'
+    outcome['error'] = reason
+  return reason is not None
+
+def batch_frame(filename, tracks=None):
+  # Load, flat, solve and align one frame, the outcome is reported in the batch summary. With the
+  # artifacts the stages done by an earlier run with the same settings are skipped, a dump already
+  # saved from the same artifact is not even read. tracks are the transforms of the frames already
+  # aligned by the other workers (see AstroMatcher.track), the transform of the frame is returned
+  # in the outcome as 'track'.
+  outcome = {'filename': filename, 'status': 'failed', 'dump': None}
+  start = time.time()
+  index = None
+  try:
+    artifacts = batch_worker_state['artifacts']
+    if batch_worker_state['align'] == 'drift':
+      index = batch_worker_state['frames'].index(filename)
+      if tracks is not None:
+        batch_worker_state['matcher'].tracks.update(tracks)
+    dump = os.path.splitext(filename)[0]+'.raw'
+    stages = []
+    done = 0
+    if artifacts is not None:
+      stages = artifacts.stages(filename, batch_worker_state)
+      header = None
+      if os.path.isfile(dump):
+        header = dump_header(dump)
+      if header is not None and header['attributes'].get('artifact') == stages[-1][1]:
+        outcome['cached'] = 'dump'
+        if 'quality' in header['attributes']:
+          outcome['quality'] = header['attributes']['quality']
+          if batch_reject(outcome, outcome['quality']):
+            return outcome
+        if index is not None and 'transform' in header['arrays']:
+          batch_worker_state['matcher'].track(index, dump_array(dump, header['arrays']['transform']))
+        outcome['dump'] = dump
+        outcome['status'] = 'done'
+        return outcome
+    image = AstroImage(filename, batch_worker_state['precision'])
+    if len(stages) > 0:
+      done = artifacts.restore(image, stages)
+      if done > 0:
+        outcome['cached'] = stages[done-1][0]
+    if done < 1:
+      image.openFile(batch_worker_state['bad_pixels'], batch_worker_state['calibration'])
+      if image.error:
+        outcome['error'] = 'Error opening file'
+        return outcome
+      if artifacts is not None:
+        artifacts.save(image, stages[0])
+    if batch_worker_state['quality'] is not None or batch_worker_state['weighted']:
+      image.score()
+      outcome['quality'] = image.quality
+      if batch_reject(outcome, image.quality):
+        return outcome
+    if done < 2:
+      image.flat(batch_worker_state['flat_order'], batch_worker_state['flat_background'])
+      if artifacts is not None:
+        artifacts.save(image, stages[1])
+    if done < 3:
+      if batch_worker_state['stars'] == 'detect':
+        image.detect(batch_worker_state['align_stars'])
+      else:
+        image.solve(batch_worker_state['scale'], hint=batch_worker_state['hint'], number=batch_worker_state['align_stars'])
+      if not (image.is_solved or image.is_detected):
+        outcome['error'] = 'No stars found'
+        return outcome
+      if artifacts is not None:
+        artifacts.save(image, stages[2])
+    if done < 4:
+      image.align(batch_worker_state['matcher'], batch_worker_state['interpolation'], index)
+      if not image.is_aligned:
+        outcome['error'] = 'No matching stars with the reference'
+        return outcome
+      if artifacts is not None:
+        artifacts.save(image, stages[3])
+    elif index is not None:
+      batch_worker_state['matcher'].track(index, image.transform)
+    outcome['alignment'] = getattr(image, 'alignment', None)
+    image.saveDump()
+    if image.error:
+      outcome['error'] = 'Dump failed'
+      return outcome
+    outcome['dump'] = dump
+    outcome['status'] = 'done'
+  except Exception, exception:
+    outcome['error'] = str(exception)
+  finally:
+    if index is not None and outcome['status'] == 'done' and index in batch_worker_state['matcher'].tracks:
+      outcome['track'] = batch_worker_state['matcher'].tracks[index]
+    outcome['time'] = time.time() - start
+    profiler.record('frame', filename, start, outcome['time'], None, {'status': outcome['status']})
+    if profiler.enabled and multiprocessing.current_process().name != 'MainProcess':
+      outcome['trace'] = profiler.drain()
+  return outcome
+
+class AstroBatch:
+  def __init__(self, filenames, scale, output, workers=None, stack_mode='sigma', memory=512*1024*1024, bad_pixels=None, flat_order=2, flat_background='polynomial', interpolation='linear', live=None, stars='detect', calibration=None, precision='uint16', quality=None, weighted=False, align='drift', artifacts=None, align_stars=20):
+    # The first frame is the reference for the alignment of all the others. stars is 'detect' to
+    # align on the stars found in the frames, 'solve' to run solve-field on every frame.
+    # With an AstroLiveStack every aligned frame is added to it instead of stacking the dumps at
+    # the end, the frames it already holds are not processed again.
+    # With an AstroQuality the frames it rejects, compared with the reference, are dropped before
+    # the flat, weighted weights the stack by the quality of the frames.
+    # align is 'drift' to predict the transform of every frame from the frames before it, checked
+    # on a few stars, or 'hash' to match the hashes of the stars of every frame.
+    # With AstroArtifacts the stages already done by an earlier run are skipped.
+    # align_stars is the number of stars of every frame used for the alignment, see star_index.
+    self.filenames = filenames
+    self.align_stars = align_stars
+    self.scale = scale
+    self.bad_pixels = bad_pixels
+    self.calibration = calibration
+    self.precision = precision
+    self.flat_order = flat_order
+    self.flat_background = flat_background
+    self.interpolation = interpolation
+    self.output = output
+    if workers is None:
+      workers = multiprocessing.cpu_count()
+    self.workers = max(1, workers)
+    self.stack_mode = stack_mode
+    self.memory = memory
+    self.live = live
+    self.stars = stars
+    self.quality = quality
+    self.weighted = weighted
+    self.align = align
+    self.artifacts = artifacts
+    self.outcomes = []
+    self.error = False
+
+  def settings(self):
+    # The settings of the stages, the ones of the reference are added once it is processed
+    return {'scale': self.scale, 'bad_pixels': self.bad_pixels, 'calibration': self.calibration, 'precision': self.precision, 'flat_order': self.flat_order, 'flat_background': self.flat_background, 'interpolation': self.interpolation, 'stars': self.stars, 'align_stars': self.align_stars, 'hint': None, 'artifacts': self.artifacts}
+
+  def reference(self):
+    outcome = {'filename': self.filenames[0], 'status': 'failed', 'dump': None}
+    start = time.time()
+    self.ref_image = AstroImage(self.filenames[0], self.precision)
+    stages = []
+    done = 0
+    if self.artifacts is not None and not self.ref_image.error:
+      stages = self.artifacts.stages(self.filenames[0], self.settings())
+      done = self.artifacts.restore(self.ref_image, stages)
+      if done > 0:
+        outcome['cached'] = stages[done-1][0]
+    if done < 1:
+      self.ref_image.openFile(self.bad_pixels, self.calibration)
+      if self.artifacts is not None:
+        self.artifacts.save(self.ref_image, stages[0])
+    if self.quality is not None or self.weighted:
+      self.ref_image.score()
+      outcome['quality'] = getattr(self.ref_image, 'quality', None)
+    if done < 2:
+      self.ref_image.flat(self.flat_order, self.flat_background)
+      if self.artifacts is not None:
+        self.artifacts.save(self.ref_image, stages[1])
+    if done < 3:
+      if self.stars == 'detect':
+        self.ref_image.detect(self.align_stars)
+      else:
+        self.ref_image.solve(self.scale, number=self.align_stars)
+      if self.artifacts is not None and (self.ref_image.is_solved or self.ref_image.is_detected):
+        self.artifacts.save(self.ref_image, stages[2])
+    if self.ref_image.error or not (self.ref_image.is_solved or self.ref_image.is_detected):
+      outcome['error'] = 'No stars in the reference'
+    else:
+      # The matching tree of the reference is built once, the workers inherit it
+      self.matcher = None
+      try:
+        self.matcher = reference_matcher(self.ref_image, star_index(self.align_stars), 0)
+        if self.matcher.tree is None:
+          outcome['error'] = 'Too few stars in the reference, '+str(self.ref_image.stars.shape[0])
+      except Exception, exception:
+        outcome['error'] = 'Index of the reference failed: '+str(exception)
+    if 'error' not in outcome:
+      self.ref_image.is_aligned = True
+      self.ref_image.saveDump()
+      if not self.ref_image.error:
+        outcome['dump'] = os.path.splitext(self.ref_image.filename)[0]+'.raw'
+        outcome['status'] = 'done'
+        if self.live is not None:
+          self.live.add(self.ref_image)
+    outcome['time'] = time.time() - start
+    profiler.record('frame', self.filenames[0], start, outcome['time'], None, {'status': outcome['status'], 'reference': True})
+    self.outcomes.append(outcome)
+
+  def dispatch(self, pool, filenames):
+    # Outcomes of the frames in order. A few frames per worker are in flight, every frame is sent
+    # with the transforms of all the frames aligned so far, so the drift of a worker is predicted
+    # from the whole sequence and not only from the frames it aligned itself.
+    tracks = {}
+    pending = collections.deque()
+    filenames = iter(filenames)
+    while True:
+      for filename in filenames:
+        pending.append(pool.apply_async(batch_frame, (filename, dict(tracks))))
+        if len(pending) >= 2*self.workers:
+          break
+      if len(pending) == 0:
+        return
+      outcome = pending.popleft().get()
+      if 'track' in outcome:
+        tracks[self.filenames.index(outcome['filename'])] = outcome['track']
+      yield outcome
+
+  def run(self):
+    start = time.time()
+    print 'Processing reference '+self.filenames[0]
+    self.reference()
+    if self.outcomes[0]['status'] != 'done':
+      self.error = True
+    else:
+      settings = self.settings()
+      settings.update({'matcher': self.matcher, 'profile': profiler.enabled, 'hint': self.ref_image.solve_hint(), 'quality': self.quality, 'ref_quality': getattr(self.ref_image, 'quality', None), 'weighted': self.weighted, 'align': self.align, 'frames': self.filenames})
+      # The aligned frames depend on the stars of the reference
+      settings['ref_id'] = hashlib.sha1(numpy.ascontiguousarray(self.ref_image.stars).tostring()).hexdigest()
+      filenames = self.filenames[1:]
+      if self.live is not None:
+        for filename in filenames:
+          if filename in self.live.frames:
+            self.outcomes.append({'filename': filename, 'status': 'skipped', 'dump': None, 'error': 'Already in the live stack'})
+        filenames = [filename for filename in filenames if filename not in self.live.frames]
+      if self.workers == 1:
+        batch_worker_init(settings)
+        outcomes = itertools.imap(batch_frame, filenames)
+      else:
+        pool = multiprocessing.Pool(self.workers, batch_worker_init, (settings,))
+        outcomes = self.dispatch(pool, filenames)
+      for outcome in outcomes:
+        outcome.pop('track', None)
+        print outcome['status']+' '+outcome['filename']
+        profiler.events.extend(outcome.pop('trace', []))
+        if self.live is not None and outcome['status'] == 'done':
+          image = AstroImage(outcome['dump'])
+          image.openFile()
+          self.live.add(image)
+        self.outcomes.append(outcome)
+      if self.workers > 1:
+        pool.close()
+        pool.join()
+      if self.artifacts is not None:
+        self.artifacts.prune(self.artifacts.session_limit(len(self.filenames), self.ref_image.rgb16.nbytes))
+
+      if self.live is not None:
+        print 'Live stack of '+str(len(self.live.frames))+' frames'
+        self.error = self.live.error
+        if not self.error:
+          self.ref_image.rgb16 = self.live.rgb16()
+      else:
+        dumps = [outcome['dump'] for outcome in self.outcomes if outcome['status'] == 'done']
+        print 'Stacking '+str(len(dumps))+' frames'
+        stacker = AstroStack(dumps, mode=self.stack_mode, memory=self.memory, workers=self.workers, weighted=self.weighted)
+        stacker.stack()
+        self.error = stacker.error
+        if not self.error:
+          self.ref_image.rgb16 = stacker.rgb16
+      if not self.error:
+        self.ref_image.filename = self.output
+        self.ref_image.saveTiff()
+        self.error = self.ref_image.error
+    self.elapsed = time.time() - start
+
+  def saveSummary(self, filename):
+    summary = {'output': self.output, 'error': self.error, 'elapsed': self.elapsed, 'workers': self.workers, 'frames': self.outcomes}
+    summary['stacked'] = len([outcome for outcome in self.outcomes if outcome['status'] == 'done'])
+    summary['rejected'] = len([outcome for outcome in self.outcomes if outcome['status'] == 'rejected'])
+    if self.live is not None:
+      summary['stacked'] = len(self.live.frames)
+    file_summary = open(filename, 'w')
+    json.dump(summary, file_summary, indent=2)
+    file_summary.close()
+
+def image_bytes(value):
+  # Memory held by the arrays of an image, its display cache included
+  if isinstance(value, numpy.ndarray):
+    return value.nbytes
+  if isinstance(value, dict):
+    return sum([image_bytes(i) for i in value.values()])
+  if isinstance(value, (list, tuple)):
+    return sum([image_bytes(i) for i in value])
+  return 0
+
+class AstroLoader:
+  def __init__(self, bad_pixels=None, memory=1024*1024*1024, workers=2, calibration=None, profile='full'):
+    # Frames are decoded by background threads and kept, least recently used first out, within
+    # memory bytes. An entry is only valid for the file it was decoded from (path, size and time).
+    # With profile 'preview' the raw frames are decoded for browsing, see AstroImage.loadRaw.
+    self.bad_pixels = bad_pixels
+    self.calibration = calibration
+    self.profile = profile
+    self.memory = memory
+    self.images = collections.OrderedDict()
+    self.pending = set()
+    self.lock = threading.Condition()
+    self.queue = Queue.Queue()
+    self.threads = []
+    for i in range(0, workers):
+      thread = threading.Thread(target=self.worker)
+      thread.daemon = True
+      thread.start()
+      self.threads.append(thread)
+
+  def key(self, filename):
+    try:
+      stat = os.stat(filename)
+    except OSError:
+      return None
+    return (stat.st_size, stat.st_mtime)
+
+  def load(self, filename):
+    key = self.key(filename)
+    image = AstroImage(filename)
+    image.openFile(self.bad_pixels, self.calibration, self.profile)
+    if not image.error:
+      image.pyramid()
+      # Stars for the alignment without solving, a dump may have them already
+      if not image.is_solved and not image.is_detected:
+        image.detect()
+    return key, image
+
+  def store(self, filename, key, image):
+    # Called with the lock held
+    self.images.pop(filename, None)
+    self.images[filename] = (key, image, image_bytes(image.__dict__))
+    total = sum([i[2] for i in self.images.values()])
+    while total > self.memory and len(self.images) > 1:
+      oldest, entry = self.images.popitem(last=False)
+      total = total - entry[2]
+
+  def worker(self):
+    while True:
+      filename = self.queue.get()
+      if filename is None:
+        return
+      try:
+        key, image = self.load(filename)
       except:
-        print "    Some file was not here."
-
-  def stars_hash(self):
-      hash_size = 1
-      for i in range(self.stars.shape[0], self.stars.shape[0]-5, -1):
-          hash_size = hash_size * i
-      hash_size = hash_size/120
-      index = 0
-      self.starsHash = numpy.empty(shape=(hash_size,10))
-      self.starsSequence = numpy.empty(shape=(hash_size,5), dtype='int')
-      for a in range(0,self.stars.shape[0]-4):
-          for b in range(a+1,self.stars.shape[0]-3):
-              for c in range(b+1,self.stars.shape[0]-2):
-                  for d in range (c+1,self.stars.shape[0]-1):
-                      for e in range (d+1,self.stars.shape[0]):
-                          sequence = [a,b,c,d,e]
-                          Distance=numpy.zeros(10)
-                          k=0
-                          for i in range(0,4):
-                              for j in range(i+1, 5):
-                                  Distance[k]=(self.stars[sequence[i]][0]-self.stars[sequence[j]][0])**2+(self.stars[sequence[i]][1]-self.stars[sequence[j]][1])**2
-                                  k=k+1
-                          Ratios=numpy.zeros(10)
-                          for i in range(0, 10):
-                              Ratios[i]=Distance[i]/Distance.max()
-                          Ratios.sort()
-                          self.starsHash[index]=Ratios
-                          self.starsSequence[index]=sequence
-                          index = index + 1
-
-
-  def rotate(self, angle):
-    height_pad = numpy.sqrt(self.rgb16.shape[0]**2+self.rgb16.shape[1]**2)/2.0 - self.rgb16.shape[1]/2
-    width_pad = numpy.sqrt(self.rgb16.shape[0]**2+self.rgb16.shape[1]**2)/2.0 - self.rgb16.shape[0]/2
-    self.rgb16 = numpy.lib.pad(self.rgb16,((abs(int(width_pad)),abs(int(width_pad))),(abs(int(height_pad)),abs(int(height_pad))),(0,0)), 'constant', constant_values=0)
-    matrix = cv2.getRotationMatrix2D((self.rgb16.shape[1]/2,self.rgb16.shape[0]/2),angle/numpy.pi*180,1)
-    self.rgb16 = cv2.warpAffine(self.rgb16,matrix,(self.rgb16.shape[1],self.rgb16.shape[0]))
-
-  def translate(self, x, y):
-    self.rgb16 = numpy.lib.pad(self.rgb16,((abs(int(x)),abs(int(x))),(abs(int(y)),abs(int(y))),(0,0)), 'constant', constant_values=0)
-    matrix = numpy.float32([[1,0,y],[0,1,x]])
-    self.rgb16 = cv2.warpAffine(self.rgb16,matrix,(self.rgb16.shape[1],self.rgb16.shape[0]))
-
-  def crop(self):
-    self.rgb16 = self.rgb16[self.rgb16.shape[0]/2-self.width/2:self.rgb16.shape[0]/2+self.width/2, self.rgb16.shape[1]/2-self.height/2:self.rgb16.shape[1]/2+self.height/2]
+        image = None
+      self.lock.acquire()
+      self.pending.discard(filename)
+      if image is not None:
+        self.store(filename, key, image)
+      self.lock.notify_all()
+      self.lock.release()
+
+  def prefetch(self, filenames):
+    self.lock.acquire()
+    for filename in filenames:
+      if filename not in self.images and filename not in self.pending:
+        self.pending.add(filename)
+        self.queue.put(filename)
+    self.lock.release()
+
+  def get(self, filename):
+    # The cached image is shared with the caller: once it is modified it must be invalidated
+    self.lock.acquire()
+    try:
+      while filename in self.pending:
+        self.lock.wait()
+      entry = self.images.pop(filename, None)
+      if entry is not None and entry[0] == self.key(filename):
+        self.images[filename] = entry
+        return entry[1]
+    finally:
+      self.lock.release()
+    key, image = self.load(filename)
+    self.lock.acquire()
+    self.store(filename, key, image)
+    self.lock.release()
+    return image
+
+  def invalidate(self, filename):
+    self.lock.acquire()
+    self.images.pop(filename, None)
+    self.lock.release()
+
+  def close(self):
+    # The frames still queued are dropped, the one being decoded is waited for
+    while not self.queue.empty():
+      try:
+        self.queue.get_nowait()
+      except Queue.Empty:
+        break
+    for thread in self.threads:
+      self.queue.put(None)
+    for thread in self.threads:
+      thread.join()
+    self.lock.acquire()
+    self.pending.clear()
+    self.images.clear()
+    self.lock.release()
 
 class AstroUI(QtGui.QWidget):
   
@@ -268,6 +2540,16 @@ class AstroUI(QtGui.QWidget):
     self.show_stars = False
     self.show_ref = False
     self.reference_image = None
+    self.ref_hint = None
+    self.ref_detected = False
+    self.ref_quality = None
+    self.quality = AstroQuality()
+    self.artifacts = AstroArtifacts(keep=('align',))
+    self.bad_pixels = None
+    self.calibration = None
+    self.loader = None
+    self.live = None
+    self.stretch = 'linear'
 
   def createWidgets(self):
     self.open_button = QtGui.QPushButton()
@@ -328,20 +2610,9 @@ class AstroUI(QtGui.QWidget):
     self.check_reference = QtGui.QCheckBox('Not Set', self)
 
     self.batch_button = QtGui.QPushButton("I'm Feeling Lucky")
+    self.live_check = QtGui.QCheckBox('Live stack', self)
 
-    self.camera_list = { 'Canon 10D': [ 22.7, 15.1, 7.4], 'Canon 20D': [ 22.5, 15, 6.42], 'Canon 30D': [ 22.5, 15, 6.42],
-        'Canon 40D': [ 22.2, 14.8, 5.71], 'Canon 50D': [ 22.3, 14.9, 4.7], 'Canon 60D': [ 22.3, 14.9, 4.3],
-        'Canon 300D': [ 22.7, 15.1, 7.4], 'Canon 350D': [ 22.2, 14.8, 6.42], 'Canon 400D': [ 22.2, 14.8, 5.71],
-        'Canon 450D': [ 22.2, 14.8, 5.2], 'Canon 500D': [ 22.3, 14.9, 4.7], 'Canon 550D': [ 22.3, 14.9, 4.3],
-        'Canon 600D': [ 22.3, 14.9, 4.3], 'Canon 1000D': [ 22.2, 14.8, 5.7], 'Canon 1100D': [ 22.3, 14.7, 5.2],
-        'Canon 5D': [ 35.8, 23.9, 8.2], 'Canon 5D Mark II': [ 36, 24, 6.41], 'Canon 7D': [ 22.3, 14.9, 4.3],
-        'Canon 1Ds Mark II': [ 36, 24, 7.2], 'Canon 1D Mark III': [ 28.1, 18.7, 7.2], 'Canon 1Ds Mark III': [ 36, 24, 6.42],
-        'Nikon D3': [ 36, 23.9, 8.45], 'Nikon D3X': [ 35.9, 24, 5.9], 'Nikon D40': [ 23.7, 15.6, 7.8],
-        'Nikon D50': [ 23.7, 15.6, 7.8], 'Nikon D60': [ 23.6, 15.8, 6.08], 'Nikon D70': [ 23.7, 15.6, 7.8],
-        'Nikon D80': [ 23.6, 15.8, 6.05], 'Nikon D90': [ 23.6, 15.8, 5.5], 'Nikon D200': [ 23.6, 15.8, 6.05],
-        'Nikon D300': [ 23.6, 15.8, 5.4], 'Nikon D700': [ 36, 23.9, 8.45], 'Nikon D3000': [ 23.6, 15.8, 5.08],
-        'Nikon D3100': [ 23.1, 15.4, 5.02], 'Nikon D5000': [ 23.1, 15.4, 5.5], 'Nikon D7000': [ 23.6, 15.6, 4.78],
-        'Olympus E-5': [ 17.3, 13, 4.7] }
+    self.camera_list = camera_list
 
     self.camera_select = QtGui.QComboBox(self)
     for i in self.camera_list.keys():
@@ -352,11 +2623,20 @@ class AstroUI(QtGui.QWidget):
     self.pixel_size = QtGui.QLineEdit(self)
     self.choose_camera()
     self.pixel_size.setFixedWidth(50)
+    self.temperature = QtGui.QLineEdit(self)
+    self.temperature.setFixedWidth(50)
+    self.exposure = QtGui.QLineEdit(self)
+    self.exposure.setFixedWidth(50)
+    self.optics = QtGui.QLineEdit(self)
+    self.optics.setFixedWidth(80)
+    self.masters_check = QtGui.QCheckBox('Masters', self)
     self.focal_length = QtGui.QLineEdit(self)
     self.focal_length.setText('1200')
     self.focal_length.setFixedWidth(50)
     self.solve_scale = QtGui.QLineEdit(self)
     self.solve_scale.setFixedWidth(50)
+    self.stretch_select = QtGui.QComboBox(self)
+    self.stretch_select.addItems(['linear', 'asinh', 'auto'])
     self.scale_calculator()
     self.text_line.setText('AstroPhoto ready')
     self.raw_saved = []
@@ -405,6 +2685,15 @@ class AstroUI(QtGui.QWidget):
     hbox1.addWidget(self.pixel_size)
     hbox1.addWidget(QtGui.QLabel(u'\u03bc\u006d'))
     hbox1.addStretch(50)
+    hbox1.addWidget(QtGui.QLabel('Sensor'))
+    hbox1.addWidget(self.temperature)
+    hbox1.addWidget(QtGui.QLabel(u'\u00b0C'))
+    hbox1.addWidget(QtGui.QLabel('Exposure'))
+    hbox1.addWidget(self.exposure)
+    hbox1.addWidget(QtGui.QLabel('s'))
+    hbox1.addWidget(QtGui.QLabel('Optics'))
+    hbox1.addWidget(self.optics)
+    hbox1.addWidget(self.masters_check)
     grid.addLayout(hbox1, 0, 11, 1, 1)
 
     hbox2 = QtGui.QHBoxLayout()
@@ -415,6 +2704,9 @@ class AstroUI(QtGui.QWidget):
     hbox2.addWidget(QtGui.QLabel('Image Scale'))
     hbox2.addWidget(self.solve_scale)
     hbox2.addWidget(QtGui.QLabel('Arcsec/Pixel'))
+    hbox2.addStretch()
+    hbox2.addWidget(QtGui.QLabel('Stretch'))
+    hbox2.addWidget(self.stretch_select)
     grid.addLayout(hbox2, 1, 11, 1, 1)
 
     grid.addWidget(self.check_reference, 1, 3, 1, 1, QtCore.Qt.AlignLeft)
@@ -426,6 +2718,7 @@ class AstroUI(QtGui.QWidget):
     hbox3 = QtGui.QHBoxLayout()
     hbox3.addWidget(self.text_line)
     hbox3.addStretch()
+    hbox3.addWidget(self.live_check)
     hbox3.addWidget(self.batch_button)
 
     grid.addLayout(hbox3,4, 0, 1, 12)
@@ -453,62 +2746,58 @@ class AstroUI(QtGui.QWidget):
     self.camera_select.currentIndexChanged[int].connect(self.choose_camera)
     self.pixel_size.textChanged[str].connect(self.scale_calculator)
     self.focal_length.textChanged[str].connect(self.scale_calculator)
+    self.stretch_select.currentIndexChanged[int].connect(self.choose_stretch)
 
   def paintEvent(self, e):
     if self.image_update:
-      display_image = numpy.copy(self.current_image.rgb16)
+      # The overlays are drawn on the display size picture, the frame itself is never copied
+      display_image = numpy.copy(self.current_image.preview(768, 512, self.stretch))
+      rows, columns = self.current_image.frame_shape()
+      scale_x = 768.0/columns
+      scale_y = 512.0/rows
       if self.show_solve:
-        white = self.current_image.white
-        lines_thickness = 5
+        white = 255
+        lines_thickness = 1
         for i in self.current_image.correlation:
-            cv2.line(display_image, (int(i[4]), int(i[5]-45)), (int(i[4]), int(i[5]-15)), (white, white, white), lines_thickness)
-            cv2.line(display_image, (int(i[4]), int(i[5]+45)), (int(i[4]), int(i[5]+15)), (white, white, white), lines_thickness)
-            cv2.line(display_image, (int(i[4]-45), int(i[5])), (int(i[4]-15), int(i[5])), (white, white, white), lines_thickness)
-            cv2.line(display_image, (int(i[4]+45), int(i[5])), (int(i[4]+15), int(i[5])), (white, white, white), lines_thickness)
+            x = int(i[4]*scale_x)
+            y = int(i[5]*scale_y)
+            cv2.line(display_image, (x, y-9), (x, y-3), (white, white, white), lines_thickness)
+            cv2.line(display_image, (x, y+9), (x, y+3), (white, white, white), lines_thickness)
+            cv2.line(display_image, (x-9, y), (x-3, y), (white, white, white), lines_thickness)
+            cv2.line(display_image, (x+9, y), (x+3, y), (white, white, white), lines_thickness)
         for i in self.current_image.galaxy:
-            cv2.circle(display_image, (i[1], i[2]), i[3], (white, white, white), lines_thickness)
-            cv2.putText(display_image, 'NGC '+str(i[0]), (i[1], i[2]), cv2.FONT_HERSHEY_SIMPLEX, 2.0, (white, white, white), lines_thickness)
+            cv2.circle(display_image, (int(i[1]*scale_x), int(i[2]*scale_y)), max(int(i[3]*scale_x), 1), (white, white, white), lines_thickness)
+            cv2.putText(display_image, 'NGC '+str(i[0]), (int(i[1]*scale_x), int(i[2]*scale_y)), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (white, white, white), lines_thickness)
 
       if self.show_stars:
-        white = self.current_image.white
-        lines_thickness = 5
+        white = 255
+        lines_thickness = 1
         star_number = 0
         for i in self.current_image.stars:
-          cv2.rectangle(display_image, (int(i[1]-30), int(i[0]-30)), (int(i[1]+30), int(i[0]+30)), (white, white, white), lines_thickness)
-          cv2.putText(display_image, str(star_number), (int(i[1]+40),int(i[0]-40)), cv2.FONT_HERSHEY_SIMPLEX, 2.0, (white, white, white), lines_thickness)
+          x = int(i[1]*scale_x)
+          y = int(i[0]*scale_y)
+          cv2.rectangle(display_image, (x-6, y-6), (x+6, y+6), (white, white, white), lines_thickness)
+          cv2.putText(display_image, str(star_number), (x+8, y-8), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (white, white, white), lines_thickness)
           star_number = star_number + 1
 
       if self.show_ref:
-        white = self.current_image.white
-        lines_thickness = 5
+        white = 255
+        lines_thickness = 1
         star_number = 0
         for i in self.ref_stars:
-            cv2.circle(display_image, (int(i[1]), int(i[0])), 30, (white, 0, 0), lines_thickness)
-            cv2.putText(display_image, str(star_number), (int(i[1]+40),int(i[0]-40)), cv2.FONT_HERSHEY_SIMPLEX, 2.0, (white, 0, 0), lines_thickness)
+            x = int(i[1]*scale_x)
+            y = int(i[0]*scale_y)
+            cv2.circle(display_image, (x, y), 6, (white, 0, 0), lines_thickness)
+            cv2.putText(display_image, str(star_number), (x+8, y-8), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (white, 0, 0), lines_thickness)
             star_number = star_number + 1
 
       if self.update_histo:
-        white = self.current_image.white
-        color = ('b', 'g', 'r')
-        fig = matplotlib.pyplot.figure()
-        ax = fig.add_subplot(111)
-        for i, col in enumerate(color):
-          histr = cv2.calcHist([self.current_image.rgb16],[i],None,[white],[0,white])
-          ax.plot(histr, color = col)
-          ax.set_xlim([0,white])
-        fig.canvas.draw()
-        w, h = fig.canvas.get_width_height()
-        display_hist = numpy.fromstring ( fig.canvas.tostring_rgb(), dtype=numpy.uint8 )
-        display_hist.shape = ( h, w, 3 )
-        display_hist = numpy.roll ( display_hist, 3, axis = 2 )
-        display_hist = cv2.resize(display_hist,(384, 254))
-        display_hist = cv2.cvtColor(display_hist, cv2.COLOR_BGR2RGB)
-        self.myHistogram = QtGui.QImage(display_hist.astype(numpy.uint8), 384, 254, QtGui.QImage.Format_RGB888)
+        self.display_histogram = histogram_picture(self.current_image.histogram())
+        self.myHistogram = QtGui.QImage(self.display_histogram, 384, 254, QtGui.QImage.Format_RGB888)
         self.update_histo = False
 
-      display_image = cv2.resize(display_image,(768, 512))
-      display_image = display_image/256
-      self.myImage = QtGui.QImage(display_image.astype(numpy.uint8), 768, 512, QtGui.QImage.Format_RGB888)
+      self.display_image = display_image
+      self.myImage = QtGui.QImage(self.display_image, 768, 512, QtGui.QImage.Format_RGB888)
 
       self.update()
       self.image_update = False
@@ -541,9 +2830,16 @@ class AstroUI(QtGui.QWidget):
       self.show_ref = False
       self.show_stars = False
       self.reference_image = None
+      self.bad_pixels = self.badPixels()
+      self.calibration = self.calibrationMasters()
+      if self.loader is not None:
+        self.loader.close()
+      # Frames are browsed as previews, they are decoded in full when they are processed
+      self.loader = AstroLoader(self.bad_pixels, calibration=self.calibration, profile='preview')
+      self.live = None
       self.text_line.setText('Loading '+str(self.file_list[self.file_current]))
-      self.current_image = AstroImage(str(self.file_list[self.file_current]))
-      self.current_image.openFile()
+      self.current_image = self.loader.get(str(self.file_list[self.file_current]))
+      self.prefetch()
       if not self.current_image.error:
         self.left_arrow_button.setEnabled(True)
         self.right_arrow_button.setEnabled(True)
@@ -557,7 +2853,7 @@ class AstroUI(QtGui.QWidget):
           self.check_reference.setCheckState(QtCore.Qt.Checked)
         else:
           self.check_reference.setCheckState(QtCore.Qt.Unchecked)
-        if self.current_image.is_solved:
+        if self.current_image.is_solved or self.current_image.is_detected:
           self.img_stars_button.setEnabled(True)
           self.check_reference.setEnabled(True)
           if self.reference_image is not None:
@@ -582,6 +2878,46 @@ class AstroUI(QtGui.QWidget):
       self.reference_image = None
       self.text_line.setText('No file selected')
 
+  def badPixels(self):
+    # Map of the selected camera and temperature already in the cache (built from the command line,
+    # from darks or moving light frames), without it every frame is scanned by itself
+    try:
+      temperature = float(self.temperature.text())
+    except ValueError:
+      temperature = None
+    bad_pixels = AstroBadPixels(str(self.camera_select.currentText()), temperature)
+    if bad_pixels.frames == 0:
+      self.text_line.setText('No bad pixel map for this camera, build it with astrophoto.py --darks')
+      return None
+    return bad_pixels
+
+  def calibrationMasters(self):
+    # Masters of the selected camera, exposure, temperature and optics already in the cache (built from
+    # the command line), only when Masters is checked
+    if not self.masters_check.isChecked():
+      return None
+    try:
+      temperature = float(self.temperature.text())
+    except ValueError:
+      temperature = None
+    try:
+      exposure = float(self.exposure.text())
+    except ValueError:
+      exposure = None
+    optics = str(self.optics.text()).strip() or None
+    calibration = AstroCalibration(str(self.camera_select.currentText()), exposure, temperature, optics=optics, reuse=True)
+    if len(calibration.masters) == 0:
+      return None
+    for line in calibration.describe():
+      print line
+    self.text_line.setText('Calibration with master '+', '.join(sorted(calibration.masters.keys())))
+    return calibration
+
+  def prefetch(self):
+    # The neighbours of the current frame are decoded while this one is looked at
+    neighbours = [self.file_current+1, self.file_current-1, self.file_current+2]
+    self.loader.prefetch([str(self.file_list[i]) for i in neighbours if i >= 0 and i < self.file_list.count()])
+
   def previousFile(self):
     if self.file_current > 0:
       self.img_stars_button.setEnabled(False)
@@ -590,8 +2926,8 @@ class AstroUI(QtGui.QWidget):
       self.show_stars = False
       self.file_current = self.file_current - 1
       self.text_line.setText('Loading '+str(self.file_list[self.file_current]))
-      self.current_image = AstroImage(str(self.file_list[self.file_current]))
-      self.current_image.openFile()
+      self.current_image = self.loader.get(str(self.file_list[self.file_current]))
+      self.prefetch()
     if not self.current_image.error:
       if self.file_current == self.reference_image:
         self.check_reference.setCheckState(QtCore.Qt.Checked)
@@ -599,7 +2935,7 @@ class AstroUI(QtGui.QWidget):
         self.check_reference.setCheckState(QtCore.Qt.Unchecked)
       self.check_reference.setEnabled(False)
       self.align_button.setEnabled(False)
-      if self.current_image.is_solved:
+      if self.current_image.is_solved or self.current_image.is_detected:
         self.img_stars_button.setEnabled(True)
         self.check_reference.setEnabled(True)
         if self.reference_image is not None:
@@ -618,8 +2954,8 @@ class AstroUI(QtGui.QWidget):
       self.show_stars = False
       self.file_current = self.file_current + 1
       self.text_line.setText('Loading '+str(self.file_list[self.file_current]))
-      self.current_image = AstroImage(str(self.file_list[self.file_current]))
-      self.current_image.openFile()
+      self.current_image = self.loader.get(str(self.file_list[self.file_current]))
+      self.prefetch()
     if not self.current_image.error:
       if self.file_current == self.reference_image:
         self.check_reference.setCheckState(QtCore.Qt.Checked)
@@ -627,7 +2963,7 @@ class AstroUI(QtGui.QWidget):
         self.check_reference.setCheckState(QtCore.Qt.Unchecked)
       self.check_reference.setEnabled(False)
       self.align_button.setEnabled(False)
-      if self.current_image.is_solved:
+      if self.current_image.is_solved or self.current_image.is_detected:
         self.img_stars_button.setEnabled(True)
         self.check_reference.setEnabled(True)
         if self.reference_image is not None:
@@ -644,6 +2980,7 @@ class AstroUI(QtGui.QWidget):
     if not self.current_image.error:
       self.text_line.setText('Dump saved')
       name, extension = os.path.splitext(str(self.file_list[self.file_current]))
+      self.loader.invalidate(name+'.raw')
       if name+'.raw' not in self.raw_saved:
         self.raw_saved.append(name+'.raw')
       if len(self.raw_saved) > 2:
@@ -662,6 +2999,7 @@ class AstroUI(QtGui.QWidget):
   def flat(self):
     self.text_line.setText('Flatting image')
     if not self.current_image.is_flat:
+      self.loader.invalidate(self.current_image.filename)
       self.current_image.flat()
       self.text_line.setText('Flat done')
       self.image_update = True
@@ -672,6 +3010,12 @@ class AstroUI(QtGui.QWidget):
   def choose_camera(self):
     self.pixel_size.setText(str(self.camera_list[str(self.camera_select.currentText())][2]))
 
+  def choose_stretch(self):
+    self.stretch = str(self.stretch_select.currentText())
+    if hasattr(self, 'current_image') and not self.current_image.error:
+      self.image_update = True
+      self.update()
+
   def scale_calculator(self):
     try:
       pixel_size = float(self.pixel_size.text())
@@ -689,16 +3033,15 @@ class AstroUI(QtGui.QWidget):
   def solve(self):
     self.text_line.setText('Solving image')
     if not self.current_image.is_solved:
+      self.loader.invalidate(self.current_image.filename)
       try:
-        self.current_image.solve(float(self.solve_scale.text()))
+        self.current_image.solve(float(self.solve_scale.text()), hint=self.ref_hint)
       except:
         self.text_line.setText('Please set a correct scale')
         return
       if not self.current_image.is_solved:
         self.text_line.setText('Image not solved')
       else:
-        self.text_line.setText('Hashing stars')
-        self.current_image.stars_hash()
         self.check_reference.setEnabled(True)
         self.img_stars_button.setEnabled(True)
         if self.reference_image is not None:
@@ -718,95 +3061,67 @@ class AstroUI(QtGui.QWidget):
     self.show_stars = True
     if not self.current_image.is_aligned:
       self.text_line.setText('Search best matching stars')
-      ref_tree = scipy.spatial.KDTree(self.ref_hash)
-      best_img_sequence = 0
-      for i in self.current_image.starsHash:
-        match = ref_tree.query(i)
-        if match[0] < 1e-3:
-          break
-        best_img_sequence = best_img_sequence + 1
-      best_ref_sequence = match[1]
-      self.text_line.setText('Reference sequence ' + str(best_ref_sequence) + ' matches image sequence ' + str(best_img_sequence) + ' with an error of ' + str(match[0]))
-      ref_stars = self.ref_sequence[best_ref_sequence].astype(int)
-      img_stars = self.current_image.starsSequence[best_img_sequence].astype(int)
-
-      ref_stars_center = numpy.array([self.ref_stars[ref_stars][:,0].mean(), self.ref_stars[ref_stars][:,1].mean()])
-      img_stars_center = numpy.array([self.current_image.stars[img_stars][:,0].mean(), self.current_image.stars[img_stars][:,1].mean()])
-      shift = numpy.array([self.current_image.width/2.0, self.current_image.height/2.0]) - img_stars_center
-      ref_angle = 0.0
-      max_dist = 0.0
-      for i in ref_stars:
-        distance = (ref_stars_center[0] - self.ref_stars[i][0])**2 + (ref_stars_center[1] - self.ref_stars[i][1])**2
-        if distance > max_dist:
-          max_dist = distance
-          angle_star = i
-      ref_angle = numpy.arctan2(self.ref_stars[angle_star][1]-ref_stars_center[1], self.ref_stars[angle_star][0]-ref_stars_center[0])
-
-      img_angle = 0.0
-      max_dist = 0.0
-      for i in img_stars:
-        distance = (img_stars_center[0] - self.current_image.stars[i][0])**2+(img_stars_center[1] - self.current_image.stars[i][1])**2
-        if distance > max_dist:
-          max_dist = distance
-          angle_star = i
-      img_angle = numpy.arctan2(self.current_image.stars[angle_star][1]-img_stars_center[1], self.current_image.stars[angle_star][0]-img_stars_center[0])
-
-      self.text_line.setText('Align')
-      self.current_image.translate(shift[0], shift[1])
-      self.current_image.rotate(ref_angle-img_angle)  
-      shift = ref_stars_center - numpy.array([self.current_image.width/2.0, self.current_image.height/2.0])
-      self.current_image.translate(shift[0], shift[1])
-      self.current_image.crop()
-      self.text_line.setText('Re-match stars after alignment')
-      self.current_image.stars = numpy.copy(self.ref_stars)
-      j=0
-      for i in self.current_image.stars:
-         self.current_image.stars[j][2] = self.current_image.rgb16[i[0]-30:i[0]+30,i[1]-30:i[1]+30,:].sum()
-         j=j+1
-
-      self.current_image.is_aligned = True
-      self.current_image.is_solved = False
+      self.loader.invalidate(self.current_image.filename)
+      # Detected and solved stars are not the same set, the reference decides
+      if self.ref_detected and not self.current_image.is_detected:
+        self.current_image.detect()
+        if not self.current_image.is_detected:
+          self.text_line.setText('No stars found')
+          return
+      elif not self.ref_detected and (self.current_image.is_detected or not self.current_image.is_solved):
+        # Solved again if its stars were detected since, solve-field answers from its cache
+        self.current_image.is_solved = False
+        try:
+          self.current_image.solve(float(self.solve_scale.text()), hint=self.ref_hint)
+        except:
+          self.text_line.setText('Please set a correct scale')
+          return
+        if not self.current_image.is_solved:
+          self.text_line.setText('Image not solved')
+          return
+      self.current_image.align(self.ref_matcher, index=self.file_current)
+      if not self.current_image.is_aligned:
+        self.text_line.setText('No matching stars with the reference')
+        return
       self.image_update = True
       self.text_line.setText('Alignment done')
+      if self.live_check.isChecked():
+        self.liveStack()
     else:
       self.text_line.setText('Image already aligned')
 
+  def liveStack(self):
+    # Every aligned frame goes in the live stack saved next to the frames, it continues an
+    # interrupted session in the same directory
+    if self.live is None:
+      self.live = AstroLiveStack(os.path.join(os.path.dirname(self.current_image.filename), 'live.raw'))
+    self.live.add(self.current_image)
+    if self.live.error:
+      self.text_line.setText('Live stack failed')
+    else:
+      self.text_line.setText('Alignment done, '+str(len(self.live.frames))+' frames in the live stack')
+      self.stack_button.setEnabled(True)
+
   def stack(self):
     self.show_solve = False
-    average = numpy.empty(shape=self.current_image.rgb16.shape, dtype=float)
-    average.fill(0.0)
-    stdev = numpy.empty(shape=self.current_image.rgb16.shape, dtype=float)
-    stdev.fill(0.0)
-    stack = numpy.empty(shape=self.current_image.rgb16.shape, dtype=float)
-    stack.fill(0.0)
-    count = numpy.empty(shape=self.current_image.rgb16.shape, dtype=float)
-    count.fill(1.0)
-    
-    frame_number = 1.0
-    for filename in self.raw_saved:
-      self.current_image = AstroImage(filename)
+    if self.live_check.isChecked() and self.live is not None and len(self.live.frames) > 0:
+      # The live stack is shown as it is now, the frames are not read again
+      self.text_line.setText('Live stack of '+str(len(self.live.frames))+' frames')
+      rgb16 = self.live.rgb16()
+      self.current_image = AstroImage(self.live.filename)
+    else:
+      self.text_line.setText('Stacking '+str(len(self.raw_saved))+' frames')
+      stacker = AstroStack(self.raw_saved)
+      stacker.stack()
+      if stacker.error:
+        self.text_line.setText('Stack failed')
+        return
+      rgb16 = stacker.rgb16
+      self.current_image = AstroImage(self.raw_saved[-1])
       self.current_image.openFile()
-      print 'Loading '+filename+' for average and stdev calculation'
-
-      delta = self.current_image.rgb16.astype(numpy.float) - average
-      average = average + delta/frame_number
-      stdev = stdev + delta*(self.current_image.rgb16.astype(numpy.float) - average)
-      frame_number = frame_number + 1.0
 
-    stdev = numpy.sqrt(stdev/frame_number)
-      
-    tolerance = 1.5
-    for filename in self.raw_saved:
-      self.current_image = AstroImage(filename)
-      self.current_image.openFile()
-      print 'Loading '+filename+' for stack'
-      mask = (numpy.fabs(self.current_image.rgb16 - average) <= tolerance * stdev).astype(numpy.float)
-      stack = stack + mask*self.current_image.rgb16.astype(numpy.float)
-      count = count + mask
-      #os.remove(filename)
-
-    stack = stack / count
-    self.current_image.rgb16 = stack.astype(numpy.uint16)
+    self.current_image.rgb16 = rgb16
+    self.current_image.revision = self.current_image.revision + 1
     self.current_image.filename = 'final.tiff'
     self.image_update = True
     self.solve()
@@ -822,9 +3137,17 @@ class AstroUI(QtGui.QWidget):
 
   def toggleReference(self, message):
     if self.check_reference.checkState() == QtCore.Qt.Unchecked:
-      self.ref_hash = self.current_image.starsHash
-      self.ref_sequence = self.current_image.starsSequence
+      # The stars of the reference come from the full frame
+      self.loader.invalidate(self.current_image.filename)
+      self.current_image.loadFull()
       self.ref_stars = self.current_image.stars
+      self.ref_detected = self.current_image.is_detected
+      # The other frames are solved around the reference
+      self.ref_hint = self.current_image.solve_hint()
+      # and their quality is compared with the reference in the batch
+      self.current_image.score()
+      self.ref_quality = getattr(self.current_image, 'quality', None)
+      self.ref_matcher = reference_matcher(self.current_image, index=self.file_current)
       self.ref_stars_button.setEnabled(True)
       self.align_button.setEnabled(True)
       self.reference_image = self.file_current
@@ -835,29 +3158,196 @@ class AstroUI(QtGui.QWidget):
       self.ref_stars_button.setEnabled(False)
       self.align_button.setEnabled(False)
       self.reference_image = None
+      self.ref_hint = None
+      self.ref_detected = False
+      self.ref_quality = None
       self.text_line.setText('Reference for alignment removed')
       self.check_reference.setText('Not Set')
       self.check_reference.setCheckState(QtCore.Qt.Unchecked)
     return 0
 
+  def artifactStages(self):
+    # Keys of the stages of the current frame in the batch of the interface, that solves before the
+    # flat: its artifacts are not the ones of the command line. Only the aligned frames are kept.
+    if self.reference_image is None or self.current_image.error:
+      return None
+    try:
+      scale = float(self.solve_scale.text())
+    except ValueError:
+      return None
+    settings = {'scale': scale, 'bad_pixels': self.bad_pixels, 'calibration': self.calibration, 'precision': self.current_image.precision, 'flat_order': 2, 'flat_background': 'polynomial', 'interpolation': 'linear', 'align_stars': 20, 'hint': self.ref_hint, 'pipeline': 'interface'}
+    settings['stars'] = 'solve'
+    if self.ref_detected:
+      settings['stars'] = 'detect'
+    settings['ref_id'] = hashlib.sha1(numpy.ascontiguousarray(self.ref_stars).tostring()).hexdigest()
+    return self.artifacts.stages(self.current_image.filename, settings)
+
   def batch_thread(self):
     for i in range(0, self.file_list.count()):
-      self.solve()
-      if i == 0:
-        self.toggleReference(None)
-      self.flat()
-      self.align()
+      if i > 0 and not self.current_image.error:
+        # Clouds, trailing and bad focus are dropped before the solve
+        self.current_image.score()
+        reason = self.quality.reject(self.current_image.quality, self.ref_quality)
+        if reason is not None:
+          self.text_line.setText('Image '+str(self.file_list[self.file_current])+' rejected: '+reason)
+          self.nextFile()
+          continue
+      stages = None
+      if i > 0:
+        stages = self.artifactStages()
+      if stages is not None and self.artifacts.restore(self.current_image, stages) == len(stages):
+        # Aligned by an earlier batch with the same reference and settings
+        self.loader.invalidate(self.current_image.filename)
+        self.image_update = True
+      else:
+        self.solve()
+        if i == 0:
+          self.toggleReference(None)
+        self.flat()
+        self.align()
+        if stages is not None and self.current_image.is_aligned:
+          self.artifacts.save(self.current_image, stages[-1])
       self.saveDump()
       self.nextFile()
 
+    if not self.current_image.error:
+      self.artifacts.prune(self.artifacts.session_limit(self.file_list.count(), self.current_image.rgb16.nbytes))
     self.stack()
     self.saveTiff()
+    if profiler.enabled:
+      profiler.save(os.environ['ASTROPHOTO_PROFILE'])
 
   def batch(self):
     tr = threading.Thread(target=self.batch_thread)
     tr.start()
 
+def cache_main(arguments):
+  parser = argparse.ArgumentParser(prog='astrophoto.py cache', description='Show or prune the outcome of the stages kept between the runs.')
+  parser.add_argument('action', choices=['list', 'prune'], help='list the artifacts per stage or remove them')
+  parser.add_argument('--stage', choices=[stage for stage, pixels in artifact_stages], help='prune all the artifacts of this stage')
+  parser.add_argument('--days', type=float, help='prune the artifacts unused for this many days')
+  parser.add_argument('--limit', type=int, help='prune the least recently used artifacts beyond this size in MB')
+  parser.add_argument('--all', action='store_true', help='prune everything')
+  options = parser.parse_args(arguments)
+
+  artifacts = AstroArtifacts()
+  if options.action == 'prune':
+    limit = None
+    if options.limit is not None:
+      limit = options.limit*1024*1024
+    if options.all:
+      limit = 0
+    age = None
+    if options.days is not None:
+      age = options.days*86400
+    print 'Removed '+str(artifacts.prune(limit, options.stage, age))+' artifacts'
+  entries = artifacts.entries()
+  print artifacts.cache
+  for stage, pixels in artifact_stages:
+    selected = [entry for entry in entries if entry['stage'] == stage]
+    if len(selected) > 0:
+      print '%-8s %6d artifacts %10.1f MB, last used %s' % (stage, len(selected), sum([entry['bytes'] for entry in selected])/1048576.0, time.strftime('%Y-%m-%d %H:%M', time.localtime(selected[-1]['used'])))
+  print 'Total    %6d artifacts %10.1f MB' % (len(entries), sum([entry['bytes'] for entry in entries])/1048576.0)
+  return 0
+
+def batch_main(arguments):
+  global solve_field, solve_timeout
+  if len(arguments) > 0 and arguments[0] == 'cache':
+    return cache_main(arguments[1:])
+  parser = argparse.ArgumentParser(description='Process a set of frames without the graphical interface: flat, solve, align and stack them.')
+  parser.add_argument('frames', nargs='+', help='raw frames, the first one is the reference')
+  parser.add_argument('--camera', default='Canon 1000D', choices=sorted(camera_list.keys()))
+  parser.add_argument('--pixel-size', type=float, help='pixel size in micrometers, default from the camera')
+  parser.add_argument('--focal-length', type=float, default=1200.0, help='focal length in mm')
+  parser.add_argument('--temperature', type=float, help='sensor temperature in Celsius, for the bad pixel map')
+  parser.add_argument('--exposure', type=float, help='exposure in seconds, for the master dark')
+  parser.add_argument('--darks', nargs='+', default=[], help='dark frames for the master dark and the bad pixel map')
+  parser.add_argument('--flats', nargs='+', default=[], help='flat frames for the master flat')
+  parser.add_argument('--bias', nargs='+', default=[], help='bias frames for the master bias')
+  parser.add_argument('--optics', help='telescope, filter or session name the master flat is kept for')
+  parser.add_argument('--reuse-masters', action='store_true', help='apply the masters of the cache when no calibration frames are given')
+  parser.add_argument('--output', default='final.tiff', help='stacked tiff')
+  parser.add_argument('--summary', help='per frame outcomes in JSON, default output name with .json')
+  parser.add_argument('--flat-order', type=int, default=2, help='order of the background polynomial')
+  parser.add_argument('--flat-background', default='polynomial', choices=['polynomial', 'mesh'])
+  parser.add_argument('--interpolation', default='linear', choices=sorted(warp_interpolations.keys()), help='resampling of the alignment')
+  parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+  parser.add_argument('--stack-mode', default='sigma', choices=['sigma', 'winsorized', 'median'])
+  parser.add_argument('--memory', type=int, default=512, help='stack memory budget in MB')
+  parser.add_argument('--precision', default='uint16', choices=['uint16', 'float32'], help='pixels while processed, float32 is more precise and takes twice the memory and disk')
+  parser.add_argument('--stars', default='detect', choices=['detect', 'solve'], help='align on the stars found in the frames or run solve-field on every frame')
+  parser.add_argument('--align-stars', type=int, default=20, help='stars of every frame used for the alignment, above 20 they are indexed by triangles')
+  parser.add_argument('--align', default='drift', choices=['drift', 'hash'], help='predict the alignment from the frames before or match the star hashes of every frame')
+  parser.add_argument('--no-reject', action='store_true', help='stack every frame, whatever its quality')
+  parser.add_argument('--min-stars', type=int, default=5, help='frames with less stars are rejected')
+  parser.add_argument('--max-fwhm-ratio', type=float, default=1.5, help='frames with stars larger than this times the reference are rejected')
+  parser.add_argument('--max-eccentricity', type=float, default=0.75, help='frames with more elongated stars are rejected')
+  parser.add_argument('--weighted', action='store_true', help='weight the stack by the FWHM and the noise of the frames')
+  parser.add_argument('--no-artifacts', action='store_true', help='do not keep nor use the outcome of the stages of earlier runs')
+  parser.add_argument('--artifacts-limit', type=int, help='size of the cache of the stages in MB, by default the size of the session, see python astrophoto.py cache --help')
+  parser.add_argument('--artifacts-stages', nargs='+', default=['decode'], choices=[stage for stage, pixels in artifact_stages], help='stages kept in the cache')
+  parser.add_argument('--live', help='live stack file: every aligned frame is added to it and a later run continues from it')
+  parser.add_argument('--solve-field', default=solve_field, help='path of solve-field')
+  parser.add_argument('--solve-timeout', type=float, default=solve_timeout, help='seconds before a solve-field run is killed')
+  parser.add_argument('--profile', default=os.environ.get('ASTROPHOTO_PROFILE'), help='time and memory of every stage of every frame in this file')
+  parser.add_argument('--profile-format', choices=['json', 'chrome'], help='json or chrome (chrome://tracing), default chrome for the names ending with .trace')
+  options = parser.parse_args(arguments)
+
+  solve_field = options.solve_field
+  solve_timeout = options.solve_timeout
+  profiler.enabled = options.profile is not None
+
+  pixel_size = options.pixel_size
+  if pixel_size is None:
+    pixel_size = camera_list[options.camera][2]
+  scale = pixel_size / options.focal_length * 206.265
+  bad_pixels = AstroBadPixels(options.camera, options.temperature)
+  raw_frames = [frame for frame in options.frames if os.path.splitext(frame)[1] != '.raw']
+  sample = []
+  if len(options.darks) == 0:
+    sample = bad_pixels_sample(bad_pixels, raw_frames)
+    if len(sample) > 0 and not frames_moved(sample):
+      print 'The stars do not move between the frames, the bad pixel map needs --darks'
+      sample = []
+  bad_pixels.update(options.darks + sample)
+  if bad_pixels.frames == 0:
+    bad_pixels = None
+  # The bias first, the flat is measured above it
+  calibration = AstroCalibration(options.camera, options.exposure, options.temperature, memory=options.memory*1024*1024, optics=options.optics, reuse=options.reuse_masters)
+  calibration.build('bias', options.bias)
+  calibration.build('dark', options.darks)
+  calibration.build('flat', options.flats)
+  for line in calibration.describe():
+    print line
+  quality = None
+  if not options.no_reject:
+    quality = AstroQuality(options.min_stars, max_fwhm_ratio=options.max_fwhm_ratio, max_eccentricity=options.max_eccentricity)
+  artifacts = None
+  if not options.no_artifacts:
+    limit = None
+    if options.artifacts_limit is not None:
+      limit = options.artifacts_limit*1024*1024
+    artifacts = AstroArtifacts(limit=limit, keep=options.artifacts_stages)
+  live = None
+  if options.live is not None:
+    live = AstroLiveStack(options.live)
+  batch = AstroBatch(options.frames, scale, options.output, workers=options.workers, stack_mode=options.stack_mode, memory=options.memory*1024*1024, bad_pixels=bad_pixels, flat_order=options.flat_order, flat_background=options.flat_background, interpolation=options.interpolation, live=live, stars=options.stars, calibration=calibration, precision=options.precision, quality=quality, weighted=options.weighted, align=options.align, artifacts=artifacts, align_stars=options.align_stars)
+  batch.run()
+  summary = options.summary
+  if summary is None:
+    summary = os.path.splitext(options.output)[0]+'.json'
+  batch.saveSummary(summary)
+  if profiler.enabled:
+    profiler.save(options.profile, options.profile_format)
+  if batch.error:
+    print 'Batch failed, see '+summary
+    return 1
+  print 'Stack saved in '+os.path.splitext(options.output)[0]+'.tiff'
+  return 0
+
 def main():
+    if len(sys.argv) > 1:
+        sys.exit(batch_main(sys.argv[1:]))
     app = QtGui.QApplication(sys.argv)
     ex = AstroUI()
     sys.exit(app.exec_())
@@ -0,0 +1,80 @@
+import numpy
+
+import astrophoto
+
+
+def field(number, seed=0):
+  rng = numpy.random.RandomState(seed)
+  return numpy.column_stack((rng.uniform(0, 1000, number), rng.uniform(0, 1500, number), rng.uniform(1, 100, number)))
+
+
+def moved(stars, angle=0.3, shift=(12.0, -7.0)):
+  # The stars seen in a frame rotated by angle and shifted by shift (rows, columns)
+  rotation = numpy.exp(1j*angle)
+  points = rotation*(stars[:,1]+1j*stars[:,0])+(shift[1]+1j*shift[0])
+  return numpy.column_stack((points.imag, points.real, stars[:,2]))
+
+
+def test_triangle_hash_few_stars():
+  for number in range(0, 3):
+    starsHash, sequence = astrophoto.triangle_hash(field(number))
+    assert starsHash.shape == (0, 2)
+    assert sequence.shape == (0, 3)
+
+
+def test_matcher_without_hashes():
+  for kind in ('quintuple', 'triangle'):
+    image = astrophoto.AstroImage('missing')
+    image.stars = field(2)
+    image.stars_hash(kind)
+    matcher = astrophoto.AstroMatcher(image.stars, image.starsHash, image.starsSequence, 0, kind=kind)
+    assert matcher.tree is None
+    assert matcher.match(image.stars, image.starsHash, image.starsSequence) == (None, None)
+
+
+def test_triangle_match():
+  reference = astrophoto.AstroImage('missing')
+  reference.stars = field(200)
+  reference.stars_hash('triangle')
+  matcher = astrophoto.AstroMatcher(reference.stars, reference.starsHash, reference.starsSequence, kind='triangle')
+  image = astrophoto.AstroImage('missing')
+  image.stars = moved(reference.stars)
+  image.stars_hash('triangle')
+  matrix, pairs = matcher.match(image.stars, image.starsHash, image.starsSequence)
+  assert matrix is not None
+  assert len(pairs) > 150
+  back = matrix[:,0:2].dot(numpy.vstack((image.stars[:,1], image.stars[:,0])))+matrix[:,2:3]
+  assert numpy.abs(back - numpy.vstack((reference.stars[:,1], reference.stars[:,0]))).max() < 1e-6
+
+
+class Result:
+  def __init__(self, function, arguments):
+    self.function = function
+    self.arguments = arguments
+
+  def get(self):
+    return self.function(*self.arguments)
+
+
+class Pool:
+  # Runs a task when its result is asked for, as a pool with every task still in flight
+  def apply_async(self, function, arguments):
+    return Result(function, arguments)
+
+
+def test_dispatch_shares_tracks(monkeypatch):
+  filenames = ['frame%d.CR2' % i for i in range(0, 12)]
+  known = {}
+
+  def frame(filename, tracks=None):
+    index = filenames.index(filename)
+    known[index] = sorted(tracks.keys())
+    return {'filename': filename, 'status': 'done', 'track': (1.0+0j, index*(1.0+1.0j))}
+  monkeypatch.setattr(astrophoto, 'batch_frame', frame)
+  batch = astrophoto.AstroBatch(filenames, 1.0, 'final.tiff', workers=2)
+  outcomes = list(batch.dispatch(Pool(), filenames[1:]))
+  assert [outcome['filename'] for outcome in outcomes] == filenames[1:]
+  # Four frames in flight, every frame after them knows all the frames aligned before them
+  assert known[1] == [] and known[4] == []
+  for index in range(5, 12):
+    assert known[index] == range(1, index-3)
@@ -0,0 +1,50 @@
+import os
+
+import numpy
+
+import astrophoto
+
+
+def image(directory):
+  filename = str(directory.join('frame.CR2'))
+  open(filename, 'w').write('frame')
+  image = astrophoto.AstroImage(filename)
+  image.rgb16 = numpy.zeros((10, 20, 3), dtype=numpy.uint16)
+  return image
+
+
+def settings():
+  return {'scale': 1.0, 'bad_pixels': None, 'calibration': None, 'precision': 'uint16', 'flat_order': 2, 'flat_background': 'polynomial', 'interpolation': 'linear', 'stars': 'detect', 'align_stars': 20, 'hint': None, 'ref_id': 'reference'}
+
+
+def test_only_kept_stages_saved(tmpdir):
+  artifacts = astrophoto.AstroArtifacts(str(tmpdir.join('artifacts')))
+  frame = image(tmpdir)
+  stages = artifacts.stages(frame.filename, settings())
+  for stage in stages:
+    artifacts.save(frame, stage)
+    # The dumps are tagged with the last stage done, kept or not
+    assert frame.artifact == stage[1]
+  assert [entry['stage'] for entry in artifacts.entries()] == ['decode']
+  restored = astrophoto.AstroImage(frame.filename)
+  assert artifacts.restore(restored, stages) == 1
+
+
+def test_session_limit(tmpdir):
+  artifacts = astrophoto.AstroArtifacts(str(tmpdir.join('artifacts')), keep=('decode', 'stars', 'align'))
+  assert artifacts.session_limit(10, 1000) == 10*(2*1000 + 3*1024*1024)
+  assert astrophoto.AstroArtifacts(limit=5).session_limit(10, 1000) == 5
+
+
+def test_prune_at_limit(tmpdir):
+  artifacts = astrophoto.AstroArtifacts(str(tmpdir.join('artifacts')), keep=('decode', 'flat'))
+  frame = image(tmpdir)
+  stages = artifacts.stages(frame.filename, settings())
+  artifacts.save(frame, stages[0])
+  os.utime(artifacts.path(stages[0][1]), (0, 0))
+  artifacts.save(frame, stages[1])
+  # Saving does not prune, the batch prunes once at the end
+  assert len(artifacts.entries()) == 2
+  assert artifacts.prune() == 0
+  assert artifacts.prune(artifacts.entries()[-1]['bytes']) == 1
+  assert [entry['stage'] for entry in artifacts.entries()] == ['flat']
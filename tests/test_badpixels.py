@@ -0,0 +1,50 @@
+import collections
+
+import numpy
+
+import astrobench
+import astrophoto
+
+Sizes = collections.namedtuple('Sizes', 'height width')
+
+
+class Raw:
+  # Synthetic frames named by their index in the truth
+  def __init__(self, truth, filename):
+    self.truth = truth
+    self.index = int(filename[-5])
+    self.sizes = Sizes(truth['rows'], truth['columns'])
+
+  def postprocess(self, half_size=False, **arguments):
+    frame = astrobench.synthetic_frame(self.truth, self.index)
+    if half_size:
+      frame = frame[::2, ::2]
+    return frame
+
+
+def session(tmpdir, monkeypatch, shifts):
+  truth = astrobench.synthetic_truth(400, 600, len(shifts), 120, 1)
+  truth['frames'] = [{'angle': 0.0, 'shift': list(shift)} for shift in shifts]
+  monkeypatch.setattr(astrophoto.rawpy, 'imread', lambda filename: Raw(truth, filename), raising=False)
+  filenames = []
+  for i in range(0, len(shifts)):
+    filename = str(tmpdir.join('frame%d.CR2' % i))
+    open(filename, 'w').write('frame')
+    filenames.append(filename)
+  return filenames
+
+
+def test_guided_frames_do_not_vote(tmpdir, monkeypatch):
+  # Guided without dithering the stars stay within a pixel
+  filenames = session(tmpdir, monkeypatch, [(0.0, 0.0), (0.4, -0.3), (-0.2, 0.5), (0.3, 0.2)])
+  assert not astrophoto.frames_moved(filenames)
+
+
+def test_dithered_frames_vote(tmpdir, monkeypatch):
+  filenames = session(tmpdir, monkeypatch, [(0.0, 0.0), (15.0, -12.0), (-14.0, 16.0), (12.0, 18.0)])
+  assert astrophoto.frames_moved(filenames)
+
+
+def test_single_frame_does_not_vote(tmpdir, monkeypatch):
+  filenames = session(tmpdir, monkeypatch, [(0.0, 0.0)])
+  assert not astrophoto.frames_moved(filenames)
@@ -0,0 +1,34 @@
+import numpy
+
+import astrophoto
+
+
+def cached(directory, kind, exposure=None, optics=None):
+  calibration = astrophoto.AstroCalibration('Canon 1000D', exposure, 20.0, cache=str(directory), optics=optics)
+  calibration.masters[kind] = numpy.ones((4, 6), dtype=numpy.float32)
+  calibration.sources[kind] = ['/frames/'+kind+'1.CR2', '/frames/'+kind+'2.CR2']
+  calibration.save(kind)
+
+
+def test_masters_reused_on_request(tmpdir):
+  cached(tmpdir, 'bias')
+  cached(tmpdir, 'flat')
+  assert astrophoto.AstroCalibration('Canon 1000D', None, 20.0, cache=str(tmpdir)).masters == {}
+  calibration = astrophoto.AstroCalibration('Canon 1000D', None, 20.0, cache=str(tmpdir), reuse=True)
+  assert sorted(calibration.masters.keys()) == ['bias', 'flat']
+  assert len(calibration.describe()) == 2
+
+
+def test_dark_needs_exposure(tmpdir):
+  cached(tmpdir, 'dark')
+  cached(tmpdir, 'dark', exposure=120)
+  assert 'dark' not in astrophoto.AstroCalibration('Canon 1000D', None, 20.0, cache=str(tmpdir), reuse=True).masters
+  assert 'dark' in astrophoto.AstroCalibration('Canon 1000D', 120, 20.0, cache=str(tmpdir), reuse=True).masters
+  assert 'dark' not in astrophoto.AstroCalibration('Canon 1000D', 60, 20.0, cache=str(tmpdir), reuse=True).masters
+
+
+def test_flat_per_optics(tmpdir):
+  cached(tmpdir, 'flat', optics='refractor')
+  assert 'flat' in astrophoto.AstroCalibration('Canon 1000D', None, 20.0, cache=str(tmpdir), optics='refractor', reuse=True).masters
+  assert 'flat' not in astrophoto.AstroCalibration('Canon 1000D', None, 20.0, cache=str(tmpdir), optics='newton', reuse=True).masters
+  assert 'flat' not in astrophoto.AstroCalibration('Canon 1000D', None, 20.0, cache=str(tmpdir), reuse=True).masters
@@ -0,0 +1,78 @@
+import warnings
+
+import numpy
+
+import astrophoto
+
+
+def loop_hash(stars):
+  # The quintuple hash as it was first written, one combination at a time
+  hash_size = 1
+  for i in range(stars.shape[0], stars.shape[0]-5, -1):
+    hash_size = hash_size * i
+  hash_size = hash_size/120
+  index = 0
+  starsHash = numpy.empty(shape=(hash_size,10))
+  starsSequence = numpy.empty(shape=(hash_size,5), dtype='int')
+  for a in range(0,stars.shape[0]-4):
+    for b in range(a+1,stars.shape[0]-3):
+      for c in range(b+1,stars.shape[0]-2):
+        for d in range (c+1,stars.shape[0]-1):
+          for e in range (d+1,stars.shape[0]):
+            sequence = [a,b,c,d,e]
+            Distance=numpy.zeros(10)
+            k=0
+            for i in range(0,4):
+              for j in range(i+1, 5):
+                Distance[k]=(stars[sequence[i]][0]-stars[sequence[j]][0])**2+(stars[sequence[i]][1]-stars[sequence[j]][1])**2
+                k=k+1
+            Ratios=numpy.zeros(10)
+            for i in range(0, 10):
+              Ratios[i]=Distance[i]/Distance.max()
+            Ratios.sort()
+            starsHash[index]=Ratios
+            starsSequence[index]=sequence
+            index = index + 1
+  return starsHash, starsSequence
+
+
+def compare(stars):
+  image = astrophoto.AstroImage('missing')
+  image.stars = stars
+  with warnings.catch_warnings():
+    # Five stars on the same pixel hash to 0/0 in both
+    warnings.simplefilter('ignore', RuntimeWarning)
+    image.stars_hash('quintuple')
+    starsHash, starsSequence = loop_hash(stars)
+  assert image.starsHash.shape == starsHash.shape
+  assert image.starsSequence.shape == starsSequence.shape
+  # Bit identical, NaN included
+  numpy.testing.assert_array_equal(image.starsHash, starsHash)
+  numpy.testing.assert_array_equal(image.starsSequence, starsSequence)
+
+
+def test_random_stars():
+  rng = numpy.random.RandomState(0)
+  for number in (5, 6, 9, 12):
+    for trial in range(0, 3):
+      compare(numpy.column_stack((rng.uniform(0, 1000, number), rng.uniform(0, 1500, number), rng.uniform(1, 100, number))))
+
+
+def test_ties():
+  # Stars on a grid of integer positions, with repeated distances, and some on the same pixel
+  rng = numpy.random.RandomState(1)
+  for number in (5, 8, 11):
+    for trial in range(0, 3):
+      stars = numpy.column_stack((rng.randint(0, 4, number), rng.randint(0, 4, number), rng.uniform(1, 100, number))).astype(float)
+      compare(stars)
+  compare(numpy.tile([[10.0, 20.0, 5.0]], (6, 1)))
+
+
+def test_few_stars():
+  for number in range(0, 5):
+    compare(numpy.column_stack((numpy.arange(number)*3.0, numpy.arange(number)*7.0, numpy.ones(number))))
+    image = astrophoto.AstroImage('missing')
+    image.stars = numpy.zeros((number, 3))
+    image.stars_hash('quintuple')
+    assert image.starsHash.shape == (0, 10)
+    assert image.starsSequence.shape == (0, 5)
@@ -0,0 +1,29 @@
+import numpy
+
+import astrophoto
+
+
+def test_peak_per_stage():
+  profiler = astrophoto.AstroProfiler(True)
+  with profiler.stage('outer'):
+    with profiler.stage('large'):
+      block = numpy.ones(64*1024*1024, dtype=numpy.uint8)
+      del block
+    with profiler.stage('small'):
+      pass
+  events = dict((event['name'], event) for event in profiler.events)
+  assert events['large']['peak_rss_mb'] > events['small']['peak_rss_mb']
+  # The peak of a stage includes the peaks of the stages inside it
+  assert events['outer']['peak_rss_mb'] >= events['large']['peak_rss_mb']
+  if events['small']['peak_scope'] == 'stage':
+    assert events['large']['peak_rss_mb'] - events['small']['peak_rss_mb'] > 48
+  assert profiler.open == []
+
+
+def test_cpu_of_the_stage():
+  profiler = astrophoto.AstroProfiler(True)
+  with profiler.stage('busy'):
+    numpy.sort(numpy.random.RandomState(0).random_sample(2000000))
+  event = profiler.events[0]
+  assert event['cpu_scope'] in ('thread', 'process')
+  assert 0 < event['cpu'] <= event['wall']*1.5 + 0.01
@@ -0,0 +1,41 @@
+import numpy
+
+import astrophoto
+
+
+class Solver:
+  # Fails every hinted solve, records the calls
+  def __init__(self):
+    self.hints = []
+
+  def solve(self, rgb16, scale, frame=None, hint=None, stars=None, downsample=2):
+    self.hints.append(hint)
+    return None
+
+
+def test_blind_after_hinted_failure(tmpdir):
+  filename = str(tmpdir.join('frame.raw'))
+  rng = numpy.random.RandomState(0)
+  astrophoto.write_dump(filename, {'error': False, 'filename': filename, 'is_loaded': True, 'is_solved': False, 'is_detected': False, 'is_aligned': False, 'is_flat': False, 'rgb16': (rng.standard_normal((64, 96, 3))*10+1000).astype(numpy.uint16)})
+  image = astrophoto.AstroImage(filename)
+  image.openFile()
+  solver = Solver()
+  hint = {'ra': 83.8, 'dec': -5.4, 'radius': 1.0, 'parity': 'pos'}
+  image.solve(1.5, solver, hint)
+  assert solver.hints == [hint, None]
+  assert not image.is_solved
+
+
+def test_hint_in_cache_key(tmpdir):
+  solver = astrophoto.AstroSolver('solve-field', workers=1, cache=str(tmpdir))
+  keys = []
+  # Every key looked up in the cache is found there, nothing runs
+  solver.cached = lambda key, factor: keys.append(key) or {}
+  rgb16 = numpy.zeros((8, 8, 3), dtype=numpy.uint16)
+  stars = numpy.ones((5, 3))
+  solver.solve(rgb16, 1.5, stars=stars)
+  solver.solve(rgb16, 1.5, hint={'ra': 83.8, 'dec': -5.4, 'radius': 1.0, 'parity': 'pos'}, stars=stars)
+  solver.solve(rgb16, 1.5, hint={'ra': 10.0, 'dec': 41.0, 'radius': 1.0, 'parity': 'pos'}, stars=stars)
+  solver.solve(rgb16, 1.5, hint={'parity': 'pos', 'radius': 1.0, 'dec': 41.0, 'ra': 10.0}, stars=stars)
+  assert len(set(keys[0:3])) == 3
+  assert keys[2] == keys[3]
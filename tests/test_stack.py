@@ -0,0 +1,57 @@
+import numpy
+
+import astrophoto
+
+
+def write_frames(directory, dtypes):
+  rng = numpy.random.RandomState(0)
+  filenames = []
+  frames = []
+  for i in range(0, len(dtypes)):
+    rgb16 = (rng.standard_normal((24, 32, 3))*50+5000).astype(dtypes[i])
+    filename = str(directory.join('frame%d.raw' % i))
+    astrophoto.write_dump(filename, {'error': False, 'filename': filename, 'rgb16': rgb16, 'is_aligned': True})
+    filenames.append(filename)
+    frames.append(rgb16.astype(numpy.float64))
+  return filenames, numpy.array(frames)
+
+
+def test_stack_mixed_precision(tmpdir):
+  # The output has the precision asked for, whatever the order of the frames
+  for dtypes in ([numpy.float32, numpy.float32, numpy.uint16], [numpy.uint16, numpy.float32, numpy.float32]):
+    filenames, frames = write_frames(tmpdir, dtypes)
+    stacker = astrophoto.AstroStack(filenames, mode='winsorized', workers=1)
+    stacker.stack()
+    assert not stacker.error
+    assert stacker.rgb16.dtype == numpy.float32
+    assert numpy.abs(stacker.rgb16 - frames.mean(axis=0)).max() < 100
+
+
+def test_stack_uint16(tmpdir):
+  filenames, frames = write_frames(tmpdir, [numpy.uint16]*3)
+  stacker = astrophoto.AstroStack(filenames, mode='median', workers=1)
+  stacker.stack()
+  assert not stacker.error
+  assert stacker.rgb16.dtype == numpy.uint16
+  assert numpy.abs(stacker.rgb16 - numpy.median(frames, axis=0)).max() <= 1
+
+
+def test_stack_sigma_mean():
+  # Frames all equal to 1000 stack to 1000, not to n/(n+1) of it
+  frames = numpy.full((4, 8, 8, 3), 1000.0, dtype=numpy.float32)
+  stack = astrophoto.stack_band(frames, None, 'sigma', 1.5)
+  assert numpy.allclose(stack, 1000.0)
+
+
+def test_stack_unequal_weights():
+  # Only the frame of weight 0.8 covers the last row, the other frames reject a hot pixel
+  frames = numpy.full((3, 6, 8, 3), 1000.0, dtype=numpy.float32)
+  coverage = numpy.ones((3, 6, 8), dtype=bool)
+  coverage[1:,5] = False
+  frames[2,2,3] = 60000.0
+  weights = numpy.array([0.8, 0.9, 1.3])
+  for mode in ('sigma', 'winsorized'):
+    stack = astrophoto.stack_band(frames, coverage, mode, 1.0, weights)
+    assert numpy.allclose(stack[5], 1000.0)
+  stack = astrophoto.stack_band(frames, coverage, 'sigma', 1.0, weights)
+  assert numpy.allclose(stack, 1000.0)